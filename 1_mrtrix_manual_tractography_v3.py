@@ -1,5 +1,9 @@
-import os, sys, glob
+import os, sys, csv, glob, time
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from command_executor import runCommand, startDetached, setResourceSlots
+from pipeline_trace import writeTrace
+from subject_index import getSubjectList
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
 """
@@ -20,55 +24,223 @@ There are two modes for this script:
         "Mrtrix_manual_tractography.py <data folder> AIS_L 01-1021 L_AF"
         
       - note that this will ask you to manually input the # of streamlines you want to select (I found I wanted to change this often in practice)
+
+    3 - batch: produce the tract of every Manual_Tractography/<tract>/ folder with a seed roi, for every subject in a data folder
+        "Mrtrix_manual_tractography.py batch <data folder>"
+        Tracts whose .tck is newer than all their rois are skipped. tckgen jobs run side by side, tckgen_threads threads each,
+        with at most thread_budget threads in use.
      
 - VERSIONS -
 
 v1: Works as described above
 v2: Changed to accept a subject folder as well to accept and place data in a custom folder
 v3: Light refinements to make the script easier to use on any computer
+    - tckgen is timed through pipeline_trace.py, with a trace_manual_tractography_<date>.json saved in the tract folder
+    - mrview and tckgen run as argument lists through command_executor.py; tckgen's exit code is checked and
+      the tract is retried if no .tck was written
+    - batch mode (see above). The streamline target and seed limit are now select_target and max_seeds below.
+      Seeding runs in rounds of seeds_per_round: it stops as soon as select_target streamlines are accepted, and in
+      batch mode also when the acceptance rate so far means max_seeds could not reach hopeless_fraction of the
+      target (a single tract run interactively still gets all max_seeds, as before). Every round is
+      logged in tckgen_seeds_log.csv in the tract folder (seeds tried vs streamlines accepted). If a round fails, the
+      rounds are discarded and no tract file is written, so a partial tract never looks like a finished one. If
+      tckedit cannot join the rounds, they are kept (tckgen_round_<n>.tck) and no tract file is written either.
     
 """
 
-input = sys.argv[1:]
-data_dir = input[0]
-subject = input[1]
-tract = input[2]
+"""
+VARIABLES THAT CONTROL THIS SCRIPT
+"""
+# tckgen stops once select_target streamlines are accepted, and never tries more than max_seeds seeds
+select_target = 5000
+max_seeds = 1000000
+# seeds per tckgen round; after each round the acceptance rate decides whether seeding more is worth it
+seeds_per_round = 100000
+# batch mode gives up on a tract when max_seeds would not even reach this fraction of select_target at the current
+# rate; a single tract always gets max_seeds
+hopeless_fraction = 0.1
+# batch mode: threads per tckgen job and for all jobs together
+tckgen_threads = 4
+thread_budget = os.cpu_count()
 
-logging.info("...the inputs sent to script were data folder: "+data_dir+' subject: '+subject+' tract: '+tract)
+seeds_log_name = 'tckgen_seeds_log.csv'
 
-#subject_data_dir = '/Volumes/Venus/Kirton_Diffusion_Processing/1_Tractoflow_Singleshell/'+bin+'/'+subject+'/Extract_DTI_Shell/'
-subject_data_dir = data_dir
-subject_dwi = subject_data_dir+'/Extract_DTI_Shell/'+subject+'__dwi_dti.nii.gz'
-subject_rgb = subject_data_dir+'/DTI_Metrics/'+subject+'__rgb.nii.gz'
-subject_bval = subject_data_dir+'/Extract_DTI_Shell/'+subject+'__bval_dti'
-subject_bvec = subject_data_dir+'/Extract_DTI_Shell/'+subject+'__bvec_dti'
+# FUNCTION: number of streamlines written (count) and generated (total_count) from the header of a .tck file
+def tckCounts(tck_file):
+    counts = dict()
+    with open(tck_file, 'rb') as file:
+        for line in file:
+            line = line.decode('utf-8', 'replace').strip()
+            if line == 'END':
+                break
+            key, _, value = line.partition(':')
+            if key in ['count', 'total_count']:
+                counts[key] = int(value.strip())
+    return counts.get('count', 0), counts.get('total_count')
 
-tract_dir = subject_data_dir+'/Manual_Tractography/'+tract+'/'
+# FUNCTION: add one round to the tract folder's seeds log
+def logSeeds(tract_dir, tract_output, round_number, seeds, accepted, stop_reason):
+    log_file = tract_dir+seeds_log_name
+    new_log = not os.path.isfile(log_file)
+    with open(log_file, 'a', newline='') as file:
+        writer = csv.writer(file)
+        if new_log:
+            writer.writerow(['date', 'output', 'round', 'seeds_tried', 'accepted', 'acceptance_rate', 'stopped'])
+        writer.writerow([time.strftime('%Y-%m-%d %H:%M:%S'), os.path.basename(tract_output), round_number, seeds, accepted,
+                         round(accepted/seeds, 6) if seeds else '', stop_reason])
 
-if len(input) > 3:
-    stage = input[3]
-    if stage == 'initialize':
-        os.makedirs(tract_dir, exist_ok = True)
-        command = 'mrview '+subject_dwi+' -overlay.load '+subject_rgb+' &'
-        os.system(command)
-    else:
-        logging.error('looks like you added a stage but the input does not match initialize')
-else:
-    os.chdir(tract_dir)
-    
-    # find seed roi
-    seed_roi = glob.glob('*seed*.mif')
-    and_roi_list = glob.glob('*and*.mif')
-    not_roi_list = glob.glob('*not*.mif')
-    
+def tractPaths(subject_data_dir, subject, tract):
+    tract_dir = subject_data_dir+'/Manual_Tractography/'+tract+'/'
+    seed_roi = sorted(glob.glob(tract_dir+'*seed*.mif'))
+    and_roi_list = sorted(glob.glob(tract_dir+'*and*.mif'))
+    not_roi_list = sorted(glob.glob(tract_dir+'*not*.mif'))
     tract_output = tract_dir+subject+'_'+tract+'_'+str(len(and_roi_list))+'and_'+str(len(not_roi_list))+'not.tck'
-    command = 'tckgen '+subject_dwi+' '+tract_output+' -algorithm Tensor_Prob -fslgrad '+subject_bvec+' '+subject_bval+' -select 5000 -seeds 1000000 -seed_image '+seed_roi[0]+' -force'
-    
+    return tract_dir, seed_roi, and_roi_list, not_roi_list, tract_output
+
+# FUNCTION: run tckgen with the seed, all and, and all not rois of a tract folder, in rounds of seeds_per_round
+# seeds, until select_target streamlines are accepted or max_seeds are used. With early_stop (batch mode) it also
+# gives up when the acceptance rate is hopeless. Returns (streamlines accepted, seeds tried, why seeding stopped).
+def generateTract(subject_data_dir, subject, tract, threads, early_stop=False):
+    subject_dwi = subject_data_dir+'/Extract_DTI_Shell/'+subject+'__dwi_dti.nii.gz'
+    subject_bval = subject_data_dir+'/Extract_DTI_Shell/'+subject+'__bval_dti'
+    subject_bvec = subject_data_dir+'/Extract_DTI_Shell/'+subject+'__bvec_dti'
+    tract_dir, seed_roi, and_roi_list, not_roi_list, tract_output = tractPaths(subject_data_dir, subject, tract)
+    if not seed_roi:
+        logging.error('No seed roi in '+tract_dir)
+        return 0, 0, 'no seed roi'
+
+    options = ['-algorithm', 'Tensor_Prob', '-fslgrad', subject_bvec, subject_bval, '-seed_image', seed_roi[0], '-nthreads', str(threads), '-force']
     for roi in and_roi_list:
-        command = command+' -include '+roi
-        
+        options = options+['-include', roi]
     for roi in not_roi_list:
-        command = command+' -exclude '+roi
-        
-    print(command)
-    os.system(command)
\ No newline at end of file
+        options = options+['-exclude', roi]
+
+    round_outputs = list()
+    accepted_total = 0
+    seeds_total = 0
+    stop_reason = ''
+    while seeds_total < max_seeds:
+        round_seeds = min(seeds_per_round, max_seeds - seeds_total)
+        round_output = tract_dir+'tckgen_round_'+str(len(round_outputs)+1)+'.tck'
+        command = ['tckgen', subject_dwi, round_output] + options + ['-select', str(select_target - accepted_total), '-seeds', str(round_seeds)]
+        print(' '.join(command))
+        if not runCommand(command, 'tckgen', cores=threads, outputs=[round_output], subject=subject, tract=tract):
+            stop_reason = 'tckgen failed'
+            break
+        round_outputs.append(round_output)
+        accepted, tried = tckCounts(round_output)
+        tried = tried or round_seeds
+        accepted_total += accepted
+        seeds_total += tried
+
+        # stop early: target reached, or (early_stop) at this acceptance rate the remaining seeds cannot get close to it
+        projected = accepted_total + accepted_total/seeds_total*(max_seeds - seeds_total)
+        if accepted_total >= select_target:
+            stop_reason = 'target reached'
+        elif early_stop and projected < hopeless_fraction*select_target:
+            stop_reason = 'hopeless acceptance rate'
+        elif seeds_total >= max_seeds:
+            stop_reason = 'max seeds'
+        else:
+            stop_reason = ''
+        logSeeds(tract_dir, tract_output, len(round_outputs), tried, accepted, stop_reason)
+        if stop_reason:
+            break
+
+    # a failed round leaves the tract incomplete: drop every round, including the failed one, and write no tract file
+    if stop_reason == 'tckgen failed':
+        for round_output in round_outputs + [round_output]:
+            if os.path.isfile(round_output):
+                os.remove(round_output)
+        logging.error(subject+' '+tract+': tckgen failed after '+str(len(round_outputs))+' rounds, no tract written')
+        return accepted_total, seeds_total, stop_reason
+
+    # join the rounds into the tract file; if tckedit fails the rounds stay for a retry and no tract file is written
+    if len(round_outputs) == 1:
+        os.replace(round_outputs[0], tract_output)
+    elif round_outputs:
+        if not runCommand(['tckedit'] + round_outputs + [tract_output, '-force'], 'tckedit', outputs=[tract_output], subject=subject, tract=tract):
+            if os.path.isfile(tract_output):
+                os.remove(tract_output)
+            logging.error(subject+' '+tract+': tckedit could not join the '+str(len(round_outputs))+' rounds, they are kept in '+tract_dir+', no tract written')
+            return accepted_total, seeds_total, 'tckedit failed'
+    for round_output in round_outputs:
+        if os.path.isfile(round_output):
+            os.remove(round_output)
+
+    logging.info(subject+' '+tract+': '+str(accepted_total)+' streamlines accepted from '+str(seeds_total)+' seeds ('+stop_reason+')')
+    if stop_reason == 'hopeless acceptance rate':
+        logging.warning(subject+' '+tract+': acceptance rate too low to reach '+str(select_target)+' streamlines, check the rois')
+    return accepted_total, seeds_total, stop_reason
+
+# FUNCTION: every (subject folder, subject, tract) under data_dir with a Manual_Tractography/<tract>/ folder
+# holding a seed roi, and whose tract file is missing or older than one of its rois
+def findTractFolders(data_dir):
+    jobs = list()
+    for subject_folder in getSubjectList(data_dir):
+        subject = os.path.basename(subject_folder)
+        for tract_dir in sorted(glob.glob(subject_folder+'/Manual_Tractography/*/')):
+            tract = os.path.basename(os.path.dirname(tract_dir))
+            tract_dir, seed_roi, and_roi_list, not_roi_list, tract_output = tractPaths(subject_folder, subject, tract)
+            if not seed_roi:
+                continue
+            rois = seed_roi + and_roi_list + not_roi_list
+            if os.path.isfile(tract_output) and os.path.getmtime(tract_output) >= max(os.path.getmtime(roi) for roi in rois):
+                logging.info(tract_output+' is up to date, moving on.')
+                continue
+            jobs.append((subject_folder, subject, tract))
+    return jobs
+
+# FUNCTION: generate every tract found by findTractFolders(), several at once, with at most thread_budget
+# tckgen threads running in total
+def runBatch(data_dir):
+    jobs = findTractFolders(data_dir)
+    threads = min(tckgen_threads, thread_budget)
+    setResourceSlots('cpu', thread_budget)
+    logging.info('Batch tractography: '+str(len(jobs))+' tracts, '+str(threads)+' threads per tckgen, '+str(thread_budget)+' threads in total')
+
+    n_done = 0
+    with ThreadPoolExecutor(max_workers=max(1, thread_budget // threads)) as pool:
+        futures = {pool.submit(generateTract, subject_folder, subject, tract, threads, early_stop=True): subject+' '+tract
+                   for subject_folder, subject, tract in jobs}
+        for future in as_completed(futures):
+            n_done += 1
+            try:
+                accepted, seeds, stop_reason = future.result()
+                logging.info('['+str(n_done)+'/'+str(len(jobs))+'] '+futures[future]+': '+str(accepted)+' streamlines / '+str(seeds)+' seeds ('+stop_reason+')')
+            except Exception:
+                logging.exception('['+str(n_done)+'/'+str(len(jobs))+'] failed on '+futures[future])
+    writeTrace(data_dir, 'manual_tractography_batch')
+
+if __name__ == '__main__':
+    input = sys.argv[1:]
+
+    if input[0] == 'batch':
+        runBatch(input[1])
+        sys.exit()
+
+    data_dir = input[0]
+    subject = input[1]
+    tract = input[2]
+
+    logging.info("...the inputs sent to script were data folder: "+data_dir+' subject: '+subject+' tract: '+tract)
+
+    #subject_data_dir = '/Volumes/Venus/Kirton_Diffusion_Processing/1_Tractoflow_Singleshell/'+bin+'/'+subject+'/Extract_DTI_Shell/'
+    subject_data_dir = data_dir
+    subject_dwi = subject_data_dir+'/Extract_DTI_Shell/'+subject+'__dwi_dti.nii.gz'
+    subject_rgb = subject_data_dir+'/DTI_Metrics/'+subject+'__rgb.nii.gz'
+
+    tract_dir = subject_data_dir+'/Manual_Tractography/'+tract+'/'
+
+    if len(input) > 3:
+        stage = input[3]
+        if stage == 'initialize':
+            os.makedirs(tract_dir, exist_ok = True)
+            # started in the background, like the old 'mrview ... &'
+            startDetached(['mrview', subject_dwi, '-overlay.load', subject_rgb], 'mrview', subject=subject, tract=tract)
+        else:
+            logging.error('looks like you added a stage but the input does not match initialize')
+    else:
+        # tckgen is multithreaded, let it have every core
+        generateTract(subject_data_dir, subject, tract, os.cpu_count())
+        writeTrace(tract_dir, 'manual_tractography')
@@ -17,16 +17,81 @@ VERSIONS:
      - Make a list in main() and allow user to modify as they like? 
        Or better yet a dict so that the key-value pair is initial and final name elements?
  - v4 added one note on line 22 to identify the only line that needs changing to work on a new computer / dataset.
+ - v4 stages now skip per artifact instead of comparing file counts. A build manifest (atlas_manifest.json in the tract
+   folder, see build_manifest.py) records the input hashes, commands and outputs of every file each stage makes, so a
+   rerun only rebuilds what is missing or stale, e.g. a single new exemplar tract and everything downstream of it.
+ - v4 the flipped-t1 and mni registrations go through the shared registration cache (registration_cache.py), so a
+   registration already computed for the same images is copied in instead of rerunning ANTs.
+ - v4 tck to trk conversion streams the streamlines in chunks (streamline_io.py) instead of loading whole tracts.
+ - v4 every external command and python stage is timed (pipeline_trace.py); a trace_atlas_build_<date>.json
+   is saved in the tract folder with the slowest stages and subjects logged at the end.
+ - v4 flipFuseTracts() works in-process: each tract is loaded once, the x-flip and the flipped-to-original affine are
+   applied as one matrix, and the contralateral tract is joined in memory. flip/*_flip.trk files are no longer written,
+   and tracts are fused in parallel (fuse_workers processes).
+ - v4 commands are argument lists run through the shared command executor (command_executor.py), with exit codes checked
+   and failed commands stopping their artifact. The manifest still records each command as its space-joined string, so existing
+   artifacts stay up to date. The copies in renameAtlasTracts() run concurrently.
+ - v4 validated/ and downsample/ tracts are kept in the compact .cstr format (compact_streamlines.py: quantized,
+   block-compressed, memory-mapped) since only flipFuseTracts() reads them. Existing .trk builds are packed and moved
+   over in the manifest on the first run, without rebuilding anything. The stages that feed scilpy tools (fuse/,
+   manually_clean/, smooth_clean/, coregistered/) stay .trk, and final_renamed/ holds hard links to the coregistered
+   tracts instead of copies.
+ - v4 near-duplicate removal can run in-process (remove_similar.py, similar_engine = 'native') instead of calling
+   scil_remove_similar_streamlines.py, with the same thresholds and averaging: streamlines are resampled once, only
+   spatially close candidates (KD-tree) are compared, and the clusters are spread over all cores when downsampling.
+   Each pass clusters what is left again and averages as scilpy does; scilpy's own clustering order is random, so
+   the two are compared on a fixture (python remove_similar.py --compare) and similar_engine = 'scilpy' stays the
+   default until that comparison passes with the scilpy that built the atlas. Switching engines changes the recorded commands, so the downsampled tracts and everything after them are
+   rebuilt once.
+ - v4 stages 1 to 8 run as a dependency graph of per-artifact steps (stage_graph.py, graph_workers at once) instead of
+   one stage after the other: the flipped-t1 and mni registrations run alongside the tract chains, and each tract goes
+   on to fusing, clustering, smoothing and coregistration as soon as its own inputs are built. The manual cluster
+   check only holds up the tracts waiting on it; they are asked for one at a time as their clusters are ready.
+   Tracts are smoothed through their own temporary file, so the smoothed and coregistered tracts are rebuilt once.
+   Set graph_workers = 0 to run the stages in order as before.
+ - v4 the clusters of every fused tract are summarised once they are computed (cluster_triage.py; count, lengths,
+   distance to the two tracts it was fused from, overlap with a fixed reference of the tract), saved in
+   manually_clean/<tract>_summary.json. Clear-cut clusters are accepted or rejected automatically, with the reason
+   logged, and the manual check only shows the others, with their summaries. A tract whose clusters are all decided
+   is not checked by hand at all. Tracts already checked in full stay checked. The triage thresholds are recorded with
+   a triaged check, so it is done again when they change, or in full when cluster_triage = False (every cluster shown).
 
 Note:
-Change line 55 to work on your computer. This line specifies where a T1 reference image can be found for each participant with exemplar tracts
+Change the t1_reference line in t1Fix() to work on your computer. This line specifies where a T1 reference image can be found for each participant with exemplar tracts
 """
 
-import os, sys, re, glob, logging
-from dipy.io.streamline import load_tck, save_tractogram
+import os, sys, re, glob, queue, shutil, logging, threading
+import numpy as np
+import nibabel as nib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dipy.tracking.streamline import transform_streamlines
+from streamline_io import convertStreaming, saveStreamlines, saveStreamlineChunks, loadStreamlines
+from compact_streamlines import loadCompact, packTrk
+from remove_similar import removeSimilarStreamlines
+from build_manifest import loadManifest, saveManifest, isStale, recordArtifact, hashFile, manifest_lock
+from registration_cache import cachedRegistration
+from command_executor import runCommand
+from pipeline_trace import traceStage, writeTrace, addEvents, eventsSince, events
+from stage_graph import StageGraph
+from cluster_triage import summarizeClusters, saveSummary, loadSummary, triageClusters, summaryTable, clusterFiles, triageSettings
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# worker processes for flipping and fusing tracts (one tract per worker)
+fuse_workers = os.cpu_count()
+# steps of the stage graph running at once (0 runs the stages one after the other, the whole folder at a time)
+graph_workers = os.cpu_count()
+# summarise the clusters of each fused tract and accept or reject the clear-cut ones before the manual check,
+# which then only shows the rest (cluster_triage.py); False shows every cluster as before
+cluster_triage = True
+# 'scilpy' runs scil_remove_similar_streamlines.py; 'native' removes similar streamlines in-process (remove_similar.py),
+# much faster; keep 'scilpy' until remove_similar.py --compare has shown the same streamlines with your scilpy
+similar_engine = 'scilpy'
+# packs .trk files into the compact format, and removes similar streamlines when downsampling; absolute, since
+# main() changes into the tract folder
+compact_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'compact_streamlines.py')
+remove_similar_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'remove_similar.py')
+
 def getTractFolder():
     # Just set this directory for the purposes of testing out the full script, saves me some time dragging and dropping
     directory = input('Which folder of tracts to process into atlas tracts? ')
@@ -46,133 +111,594 @@ def getSubjectTags():
     
     return tag_list
 
-def t1Fixes(tract_directory):
+# Arguments with a * are expanded to the matching files (sorted), as the shell did for the old command strings
+def expandGlobs(args):
+    expanded = list()
+    for arg in args:
+        expanded.extend((sorted(glob.glob(arg)) or [arg]) if '*' in arg else [arg])
+    return expanded
+
+# A command as recorded in the manifest. The python interpreter and the path of our own scripts depend on the
+# machine, so they are written as 'python compact_streamlines.py' to keep the recorded commands portable.
+def commandText(command):
+    if command[0] == sys.executable:
+        command = ['python', os.path.basename(command[1])] + list(command[2:])
+    return ' '.join(command)
+
+# Run the commands (argument lists) that build one artifact, one after the other, unless the manifest says
+# it is up to date. The commands are stored as the artifact's parameters, so changing a flag rebuilds it too.
+# Stops at the first command that fails. Returns True if the artifact was (re)built.
+def buildArtifact(manifest, stage, artifact, inputs, commands, outputs=None, retries=None):
+    missing = [path for path in inputs if not os.path.exists(path)]
+    if missing:
+        logging.error('Missing input for '+artifact+': '+str(missing)+', not building it.')
+        return False
+    params = {'commands': [commandText(command) for command in commands]}
+    if not isStale(manifest, artifact, inputs, params, outputs):
+        logging.info(artifact+' is up to date, moving on.')
+        return False
+
+    logging.info('Building '+artifact+' ('+stage+')')
+    # remove stale output files first, so a failed command can never leave an old file that looks freshly built
+    for output in outputs or [artifact]:
+        if os.path.isfile(output):
+            os.remove(output)
+    tag = re.findall(r'\d\d-\d\d\d\d', artifact)
+    for command in commands:
+        if not runCommand(expandGlobs(command), stage, retries=retries, subject=tag[0] if tag else None, artifact=artifact):
+            break
+
+    if all(os.path.exists(output) for output in outputs or [artifact]):
+        recordArtifact(manifest, artifact, stage, inputs, params, outputs)
+        saveManifest(manifest)
+    else:
+        logging.error(artifact+' was not produced by '+stage+'.')
+    return True
+
+def t1Fix(manifest, tag):
+    # find t1 file, pass through mrtrix, and save in tracts folder
+    t1_reference = '/Volumes/Venus/Imaging/Kirton_Diffusion_Processing/1_Tractoflow_Singleshell/TDC/'+tag+'/Register_T1/'+tag+'__t1_warped.nii.gz'
+    t1_reference_fixed = tag+'__t1_warped_trk_reference.nii.gz'
+    command = ['mrconvert', t1_reference, t1_reference_fixed, '-force']
+    buildArtifact(manifest, 't1 fix', t1_reference_fixed, [t1_reference], [command])
+
+def t1Fixes(manifest):
     
     tag_list = getSubjectTags()
     
     for tag in tag_list:
-        # find t1 file, pass through mrtrix, and save in tracts folder
-        t1_reference = '/Volumes/Venus/Imaging/Kirton_Diffusion_Processing/1_Tractoflow_Singleshell/TDC/'+tag+'/Register_T1/'+tag+'__t1_warped.nii.gz'
-        t1_reference_fixed = tag+'__t1_warped_trk_reference.nii.gz'
+        t1Fix(manifest, tag)
+
+# Convert one tck file to trk. Returns False if the subject's fixed T1 is missing.
+def convertTrk(manifest, file):
+    filename = file.split('.')[0]        
+    
+    tag_regex = re.compile('\d\d-\d\d\d\d')
+    tag = tag_regex.findall(filename)[0]
+    t1_reference_fixed = tag+'__t1_warped_trk_reference.nii.gz'
+    trk_save_name = filename+'.trk'
+    params = {'bbox_valid_check': False}
     
-        if not os.path.isfile(t1_reference_fixed):
-            logging.info('Passing t1 image through mrtrix to get it to work with dipy commands, saved in '+tract_directory)
-            command = 'mrconvert '+t1_reference+' '+t1_reference_fixed
-            os.system(command)
-        else:
-            logging.info('T1 reference image already exists for '+tag+', moving on.')
+    if not os.path.isfile(t1_reference_fixed):
+        print(t1_reference_fixed)
+        logging.error('Fixed T1 image not found, conversion not executed.')
+        return False
+    elif not isStale(manifest, trk_save_name, [file, t1_reference_fixed], params):
+        logging.info(trk_save_name+' is up to date, no need to convert tck file.')
+    else:
+        logging.info('T1 image found, converting '+file+' to trk.')
+        # streamed chunk by chunk, with the t1 as the trk header reference
+        with traceStage('tck to trk', subject=tag, artifact=trk_save_name):
+            convertStreaming(file,trk_save_name,reference=t1_reference_fixed)
+        recordArtifact(manifest, trk_save_name, 'tck to trk', [file, t1_reference_fixed], params)
+        saveManifest(manifest)
 
-def convertTrks(tract_directory):
+def convertTrks(manifest):
 
-    for file in os.listdir(tract_directory):
+    for file in sorted(os.listdir('.')):
         if file.endswith(".tck"):
-            
-            filename = file.split('.')[0]        
-            
-            tag_regex = re.compile('\d\d-\d\d\d\d')
-            tag = tag_regex.findall(filename)[0]
-            t1_reference_fixed = tag+'__t1_warped_trk_reference.nii.gz'
-            
-            if os.path.isfile(filename+'.trk'):
-                logging.info(filename+'.trk found, no need to convert tck file.')
-            elif not os.path.isfile(filename+'.trk'):
-                if os.path.isfile(t1_reference_fixed):
-                    logging.info('T1 image found, converting '+file+' to trk.')
-                    temp_tck = load_tck(file,reference=t1_reference_fixed,bbox_valid_check=False)
-                    trk_save_name = filename+'.trk'
-                    save_tractogram(temp_tck,trk_save_name,bbox_valid_check=False)
-                else:
-                    print(t1_reference_fixed)
-                    logging.error('Fixed T1 image not found, conversion not executed.')
-                    exit()
-
-def clean_and_downsample():
-    command = "for i in *.trk; do echo ${i}; base_name=$(basename ${i}); tag=$(echo $base_name | cut -d'_' -f 1);"+\
-        "scil_remove_invalid_streamlines.py --reference ${tag}__t1_warped_trk_reference.nii.gz ${i} ${i/.trk/_valid.trk};"+\
-        "scil_remove_similar_streamlines.py ${i/.trk/_valid.trk} 2 downsample/${base_name/.trk/_downsample.trk} -f -v;"+\
-        "mv ${i/.trk/_valid.trk} validated/; done"
-    os.system(command)
+            if convertTrk(manifest, file) is False:
+                exit()
+
+# Pack a .trk intermediate into the compact format and point every manifest entry that was built from the .trk
+# at the packed file instead, so nothing downstream is rebuilt just because the file format changed.
+def migrateToCompact(manifest, trk, cstr):
+    old_hash = hashFile(trk, manifest['hashes'])
+    packTrk(trk, cstr, remove=True)
+    new_hash = hashFile(cstr, manifest['hashes'])
+    for entry in manifest['artifacts'].values():
+        if entry['inputs'].get(trk) == old_hash:
+            del entry['inputs'][trk]
+            entry['inputs'][cstr] = new_hash
+
+def cleanDownsample(manifest, trk):
+    base_name = trk[:-4]
+    tag = base_name.split('_')[0]
+    t1_reference_fixed = tag+'__t1_warped_trk_reference.nii.gz'
+    inputs = [trk, t1_reference_fixed]
+    downsampled_trk = 'downsample/'+base_name+'_downsample.trk'
+    downsampled = downsampled_trk[:-4]+'.cstr'
+    validated = 'validated/'+base_name+'_valid.cstr'
+    # scilpy writes .trk, packed afterwards (only flipFuseTracts reads these); remove_similar.py writes .cstr itself
+    remove_invalid = ['scil_remove_invalid_streamlines.py', '--reference', t1_reference_fixed, trk, base_name+'_valid.trk', '-f']
+    scil_remove_similar = ['scil_remove_similar_streamlines.py', base_name+'_valid.trk', '2', downsampled_trk, '-f', '-v']
+    if similar_engine == 'native':
+        commands = [remove_invalid,
+                    [sys.executable, remove_similar_script, base_name+'_valid.trk', '2', downsampled],
+                    [sys.executable, compact_script, 'pack', base_name+'_valid.trk', validated, '--remove']]
+    else:
+        commands = [remove_invalid, scil_remove_similar,
+                    [sys.executable, compact_script, 'pack', base_name+'_valid.trk', validated, '--remove'],
+                    [sys.executable, compact_script, 'pack', downsampled_trk, downsampled, '--remove']]
+
+    # a build from before the compact format: if it is still up to date, pack it instead of redoing it
+    old_outputs = [downsampled_trk, 'validated/'+base_name+'_valid.trk']
+    old_commands = [remove_invalid, scil_remove_similar, ['mv', base_name+'_valid.trk', 'validated/']]
+    if (similar_engine == 'scilpy' and not os.path.isfile(downsampled) and os.path.isfile(downsampled_trk) and downsampled_trk in manifest['artifacts']
+            and not isStale(manifest, downsampled_trk, inputs, {'commands': [commandText(command) for command in old_commands]}, old_outputs)):
+        logging.info('Packing '+downsampled_trk+' and its validated tract into the compact format.')
+        with traceStage('pack to compact', subject=tag, artifact=downsampled), manifest_lock:
+            migrateToCompact(manifest, downsampled_trk, downsampled)
+            migrateToCompact(manifest, old_outputs[1], validated)
+            del manifest['artifacts'][downsampled_trk]
+        recordArtifact(manifest, downsampled, 'clean and downsample', inputs,
+                       {'commands': [commandText(command) for command in commands]}, [downsampled, validated])
+        saveManifest(manifest)
+
+    buildArtifact(manifest, 'clean and downsample', downsampled, inputs, commands, [downsampled, validated])
+
+def clean_and_downsample(manifest):
+    for trk in sorted(glob.glob('*.trk')):
+        cleanDownsample(manifest, trk)
 
 
 # --- 3 --- find, flip, and register t1 files for all subjects in the folder
-def t1FlipRegister(tracts_dir):    
+def t1FlipRegisterSubject(manifest, tag):
+    #fixed t1 reference has already been created in converTrks() function above
+    t1_reference_fixed = tag+'__t1_warped_trk_reference.nii.gz'
+    t1_reference_flipped = 'flip/'+t1_reference_fixed[:-7]+'_flipped.nii.gz'
+    flip_affine = 'flip/'+tag+'_output_0GenericAffine.mat'
+    buildArtifact(manifest, 't1 flip', t1_reference_flipped, [t1_reference_fixed],
+                  [['scil_flip_volume.py', t1_reference_fixed, t1_reference_flipped, 'x', '-f']])
+    if os.path.isfile(t1_reference_flipped):
+        cachedRegistration(t1_reference_fixed, t1_reference_flipped, 'r', 'flip/'+tag+'_output_')
+        buildArtifact(manifest, 'affine to txt', flip_affine[:-4]+'.txt', [flip_affine],
+                      [['ConvertTransformFile', '3', flip_affine, flip_affine[:-4]+'.txt', '--hm', '--ras']])
+
+def t1FlipRegister(manifest):    
     
     tag_list = getSubjectTags()
     
     for tag in tag_list:
-        #fixed t1 reference has already been created in converTrks() function above
-        t1_reference_fixed = tag+'__t1_warped_trk_reference.nii.gz'
-        t1_reference_flipped = 'flip/'+t1_reference_fixed[:-7]+'_flipped.nii.gz'
-    
-        if os.path.isfile(t1_reference_fixed) and not os.path.isfile(t1_reference_flipped):
-            logging.info('Found t1 reference for: '+tag+', flipping and registering t1')
-            command = 'scil_flip_volume.py '+t1_reference_fixed+' '+t1_reference_flipped+' x'
-            os.system(command)
-            command = 'antsRegistrationSyNQuick.sh -d 3 -f '+t1_reference_fixed+' -m '+t1_reference_flipped+' -t r -o '+tag+'_output_ -n 4'
-            os.system(command)
-            command = 'mv *output* flip/'
-            os.system(command)
-        elif os.path.isfile(t1_reference_flipped):
-            logging.info('Flipped t1 reference found for: '+tag+', moving on.')
-
-def flipFuseTracts():
+        t1FlipRegisterSubject(manifest, tag)
+
+# How fused tracts are averaged: what the scil_remove_similar_streamlines.py command did (1 mm, --avg, --min_cluster_size 2)
+fuse_similar_params = {'min_distance': 1, 'average': True, 'min_cluster_size': 2}
+
+# Name of the tract on the other side of the brain. Same pairing as the old bash loops, which
+# replaced the first L with R (L tracts) and then the first R with L (R tracts, run last so they win).
+def contralateralName(base_name):
+    if 'R' in base_name:
+        return base_name.replace('R', 'L', 1)
+    return base_name.replace('L', 'R', 1)
+
+# Matrix that mirrors rasmm points along x inside a voxel grid, the same flip scil_flip_streamlines.py does
+# (voxel i goes to voxel dim_x-1-i)
+def flipMatrix(affine, shape):
+    flip_vox = np.diag([-1.0, 1.0, 1.0, 1.0])
+    flip_vox[0, 3] = shape[0] - 1
+    return affine @ flip_vox @ np.linalg.inv(affine)
+
+# Flip a tract across the midline and bring it back into the subject's t1 space in one matrix product:
+# x-flip on the t1 grid, then the inverse of the flipped-to-original t1 registration (ConvertTransformFile
+# --hm --ras output, i.e. what scil_apply_transform_to_tractogram.py --inverse applies). Streamlines leaving
+# the t1 grid are removed, like --remove_invalid.
+def flipToNative(streamlines, t1_reference, flip_affine_txt):
+    t1_image = nib.load(t1_reference)
+    shape = np.asarray(t1_image.shape[:3])
+    transform = np.linalg.inv(np.loadtxt(flip_affine_txt)) @ flipMatrix(t1_image.affine, shape)
+
+    flipped = transform_streamlines(streamlines, transform)
+    corner_vox = nib.affines.apply_affine(np.linalg.inv(t1_image.affine), flipped.get_data()) + 0.5
+    point_valid = np.all((corner_vox >= 0) & (corner_vox <= shape), axis=1)
+    lengths = np.asarray(flipped._lengths, dtype=np.int64)
+    if len(lengths) == 0:
+        return flipped
+    streamline_valid = np.add.reduceat(point_valid.astype(np.int64), np.cumsum(lengths) - lengths) == lengths
+    return flipped[np.flatnonzero(streamline_valid & (lengths > 1))]
+
+# One fused tract, run in a worker process: the tract and the flipped contralateral tract (both .cstr) are joined
+# in memory and only the averaged result is written to fused, by remove_similar.py in this process (command None)
+# or by the scil_remove_similar_streamlines.py command.
+# Returns the trace events recorded in the worker, so the main process can add them to the run's trace.
+def fuseTract(trk, contralateral_trk, t1_reference, flip_affine_txt, fused, command):
+    n_events = len(events)
+    tag = os.path.basename(trk)[:7]
+    concatenated = fused[:-4]+'_concatenated.trk'
+    try:
+        with traceStage('flip and fuse (python)', subject=tag, artifact=fused):
+            streamlines = loadCompact(trk)
+            streamlines.extend(flipToNative(loadCompact(contralateral_trk), t1_reference, flip_affine_txt))
+            if command is None:
+                # one core per tract: the tracts themselves are fused side by side
+                averaged = removeSimilarStreamlines(streamlines, **fuse_similar_params, processes=1)
+                saveStreamlines(averaged, fused, t1_reference)
+            else:
+                saveStreamlines(streamlines, concatenated, t1_reference)
+        if command is not None:
+            runCommand([concatenated if arg == '{concatenated}' else arg for arg in command], 'remove similar streamlines',
+                       outputs=[fused], subject=tag, artifact=fused)
+    finally:
+        if os.path.isfile(concatenated):
+            os.remove(concatenated)
+    return eventsSince(n_events)
+
+# What a downsampled tract is fused from: itself, its contralateral tract, and the t1 and flipped-to-original
+# registration its contralateral tract is flipped with
+def fuseInputs(trk):
+    contralateral_trk = 'downsample/'+contralateralName(os.path.basename(trk)[:-5])+'.cstr'
+    tag = os.path.basename(contralateral_trk)[:7]
+    return [trk, contralateral_trk, tag+'__t1_warped_trk_reference.nii.gz', 'flip/'+tag+'_output_0GenericAffine.txt']
+
+# The fuse job of one downsampled tract: (inputs, params, fused, command), or None if the fused tract is up to date
+# or cannot be built. Each tract is fused with the flipped copy of its contralateral tract.
+def fuseJob(manifest, trk):
+    base_name = os.path.basename(trk)[:-5]
+    fused = 'fuse/'+base_name+'_fuse.trk'
+    inputs = fuseInputs(trk)
+    if similar_engine == 'native':
+        command = None
+        params = {'flip': 'x', 'remove_similar': dict(fuse_similar_params, engine='native')}
+    else:
+        command = ['scil_remove_similar_streamlines.py', '{concatenated}', '1', fused, '--avg', '--processes', '1', '--min_cluster_size', '2', '-v', '-f']
+        params = {'flip': 'x', 'commands': [commandText(command)]}
+
+    missing = [path for path in inputs if not os.path.exists(path)]
+    if missing:
+        logging.error('Missing input for '+fused+': '+str(missing)+', not building it.')
+        return None
+    if not isStale(manifest, fused, inputs, params):
+        logging.info(fused+' is up to date, moving on.')
+        return None
+    if os.path.isfile(fused):
+        os.remove(fused)
+    return (inputs, params, fused, command)
+
+# Record a fuse job once its worker is done with it
+def recordFuse(manifest, job, future):
+    inputs, params, fused, command = job
+    try:
+        addEvents(future.result())
+    except Exception:
+        logging.exception('Fusing '+fused+' failed.')
+        return
+    if os.path.isfile(fused):
+        recordArtifact(manifest, fused, 'flip and fuse', inputs, params)
+        saveManifest(manifest)
+    else:
+        logging.error(fused+' was not produced by flip and fuse.')
+
+# Only lateralised tracts (an L or R in the name) have a contralateral tract to be fused with
+def hasContralateral(trk):
+    base_name = os.path.basename(trk)[:-5]
+    return 'L' in base_name or 'R' in base_name
+
+# One tract's fuse job, run in pool (the stage graph's shared ProcessPoolExecutor)
+def flipFuseTract(manifest, trk, pool):
+    job = fuseJob(manifest, trk)
+    if job is not None:
+        inputs, params, fused, command = job
+        recordFuse(manifest, job, pool.submit(fuseTract, *inputs, fused, command))
+
+def flipFuseTracts(manifest):
     
-    command = 'for i in flip/*output*.mat; do echo ${i}; base_name=$(basename ${i}); ConvertTransformFile 3 ${i} flip/${base_name/.mat/.txt} --hm --ras; done'
-    os.system(command)
-    # smart steps are here onwards, will need to re-evaluate the 4 lines up above to get the antsRegistraion command to output a file of format: "03-3095_output_0GenericAffine.mat"
-    command = 'for i in downsample/*.trk; do echo ${i}; base_name=$(basename ${i}); scil_flip_streamlines.py ${i} flip/flip.trk x; tag=$(basename ${base_name} | cut -c1-7); scil_apply_transform_to_tractogram.py flip/flip.trk ${tag}__t1_warped_trk_reference.nii.gz flip/${tag}_output_0GenericAffine.mat flip/${base_name/.trk/_flip.trk} --inverse --remove_invalid; rm flip/flip.trk; done'
-    os.system(command)
+    # Every stale fused tract is one job, and the jobs run side by side in fuse_workers processes.
+    jobs = [fuseJob(manifest, trk) for trk in sorted(glob.glob('downsample/*.cstr')) if hasContralateral(trk)]
+    jobs = [job for job in jobs if job is not None]
     
-    # 3.5: Fuse tracts
-   
-    # Currently configured to fuse L with R tracts separately from R with L
-    # L tracts
-    command = 'for i in downsample/*L*.trk; do echo ${i}; base_name=$(basename ${i}); R_flip=${base_name/L/R}; R_flip=${R_flip/.trk/_flip.trk}; scil_streamlines_math.py concatenate ${i} flip/${R_flip} fuse/fuse.trk; scil_remove_similar_streamlines.py fuse/fuse.trk 1 fuse/${base_name/.trk/_fuse.trk} --avg --processes 1 --min_cluster_size 2 -v; rm fuse/fuse.trk; done'
-    os.system(command)
-    # R tracts
-    command = 'for i in downsample/*R*.trk; do echo ${i}; base_name=$(basename ${i}); L_flip=${base_name/R/L}; L_flip=${L_flip/.trk/_flip.trk}; scil_streamlines_math.py concatenate ${i} flip/${L_flip} fuse/fuse.trk; scil_remove_similar_streamlines.py fuse/fuse.trk 1 fuse/${base_name/.trk/_fuse.trk} --avg --processes 1 --min_cluster_size 2 -v; rm fuse/fuse.trk; done'
-    os.system(command)
-
-def tractClusters():
+    if not jobs:
+        return
+    logging.info('Flipping and fusing '+str(len(jobs))+' tracts with '+str(fuse_workers)+' workers.')
+    with ProcessPoolExecutor(max_workers=fuse_workers) as pool:
+        futures = {pool.submit(fuseTract, *inputs, fused, command): (inputs, params, fused, command) for inputs, params, fused, command in jobs}
+        for future in as_completed(futures):
+            recordFuse(manifest, futures[future], future)
+
+def tractCluster(manifest, trk):
+    base_name = os.path.basename(trk)[:-4]
+    cluster_dir = 'manually_clean/'+base_name
+    # clear out old clusters first, so a rebuilt tract never keeps clusters from the last run
+    commands = [['rm', '-rf', cluster_dir],
+                ['scil_compute_qbx.py', trk, '4', cluster_dir+'/']]
+    buildArtifact(manifest, 'clusters', cluster_dir, [trk], commands)
+
+def tractClusters(manifest):
     
-    # mkdir manually_clean;
-    command = 'for i in fuse/*.trk; do echo ${i}; base_name=$(basename ${i} .trk); scil_compute_qbx.py ${i} 4 manually_clean/${base_name}/; done'
-    os.system(command)
+    for trk in sorted(glob.glob('fuse/*.trk')):
+        tractCluster(manifest, trk)
+
+# Commands for the interactive check of one fused tract's clusters (kept clusters go to manually_clean/<tract>.trk)
+def checkCommands(base_name):
+    return [['scil_clean_qbx_clusters.py', 'manually_clean/'+base_name+'/*.trk', 'manually_clean/'+base_name+'.trk', 'manually_clean/'+base_name+'_.trk', '--min_cluster_size', '5', '-f'],
+            ['rm', 'manually_clean/'+base_name+'_.trk']]
+
+def checkParams(base_name):
+    return {'commands': [commandText(command) for command in checkCommands(base_name)]}
+
+# A triaged check is recorded with the triage thresholds as well, so it only counts as done while triage is on and the
+# thresholds have not changed
+def triageParams(base_name):
+    return dict(checkParams(base_name), triage=triageSettings())
+
+# A tract checked by hand in full stays checked; one checked after triage is checked again once triage is turned off
+# or its thresholds change
+def needsCheck(manifest, base_name):
+    cluster_dir = 'manually_clean/'+base_name
+    return (isStale(manifest, cluster_dir+'.trk', [cluster_dir], checkParams(base_name)) and
+            (not cluster_triage or isStale(manifest, cluster_dir+'.trk', [cluster_dir], triageParams(base_name))))
+
+def summaryPath(base_name):
+    return 'manually_clean/'+base_name+'_summary.json'
+
+# The fixed reference the clusters of a tract are triaged against: the tract as a person first checked it in full,
+# copied to triage_reference/ once and never updated by the build (replace the file to change the reference). None
+# until there is one.
+def atlasReference(manifest, base_name):
+    reference = 'triage_reference/'+base_name+'.trk'
+    checked = 'manually_clean/'+base_name+'.trk'
+    if not os.path.isfile(reference) and os.path.isfile(checked):
+        entry = manifest['artifacts'].get(checked)
+        if entry is not None and entry['params'] == checkParams(base_name):
+            os.makedirs('triage_reference/', exist_ok = True)
+            shutil.copyfile(checked, reference+'.tmp')
+            os.replace(reference+'.tmp', reference)
+            logging.info('Keeping '+checked+' as the triage reference of '+base_name)
+    return reference if os.path.isfile(reference) else None
+
+# Summarise the clusters of one fused tract (cluster_triage.py) into manually_clean/<tract>_summary.json, against the
+# two tracts it was fused from and the tract's fixed reference
+def clusterSummary(manifest, base_name):
+    cluster_dir = 'manually_clean/'+base_name
+    summary_json = summaryPath(base_name)
+    trk, contralateral_trk, t1_reference, flip_affine_txt = fuseInputs('downsample/'+base_name[:-len('_fuse')]+'.cstr')
+    atlas_trk = atlasReference(manifest, base_name) or 'triage_reference/'+base_name+'.trk'
+    inputs = [path for path in [cluster_dir, trk, contralateral_trk, t1_reference, flip_affine_txt, atlas_trk] if os.path.exists(path)]
+    if not os.path.isdir(cluster_dir):
+        logging.error('No clusters for '+base_name+', nothing to summarise.')
+        return False
+    if not isStale(manifest, summary_json, inputs):
+        logging.info(summary_json+' is up to date, moving on.')
+        return
+
+    with traceStage('cluster summary', subject=base_name[:7], artifact=summary_json):
+        ipsilateral = loadCompact(trk) if trk in inputs else None
+        contralateral = None
+        if all(path in inputs for path in [contralateral_trk, t1_reference, flip_affine_txt]):
+            contralateral = flipToNative(loadCompact(contralateral_trk), t1_reference, flip_affine_txt)
+        saveSummary(summarizeClusters(cluster_dir, ipsilateral, contralateral, atlas_trk if atlas_trk in inputs else None), summary_json)
+    recordArtifact(manifest, summary_json, 'cluster summary', inputs)
+    saveManifest(manifest)
+
+def clusterSummaries(manifest):
+    for trk in sorted(glob.glob('fuse/*.trk')):
+        clusterSummary(manifest, os.path.basename(trk)[:-4])
+
+# The summary of a fused tract's clusters and the automatic decision on each of them, or (None, None) when the
+# clusters are checked without triage
+def clusterDecisions(base_name):
+    if not cluster_triage or not os.path.isfile(summaryPath(base_name)):
+        return None, None
+    summary = loadSummary(summaryPath(base_name))
+    if sorted(cluster['file'] for cluster in summary['clusters']) != clusterFiles('manually_clean/'+base_name):
+        logging.warning(summaryPath(base_name)+' does not match the clusters of '+base_name+', checking all of them.')
+        return None, None
+    return summary, triageClusters(summary)
+
+# True if a person has to look at some of the tract's clusters
+def needsReview(base_name):
+    summary, decisions = clusterDecisions(base_name)
+    return decisions is None or any(decision == 'review' for decision, reason in decisions.values())
+
+# Join tracts (.trk) into one, with the header of header_source
+def joinTracts(tracts, out, header_source):
+    header = nib.streamlines.load(header_source, lazy_load=True).header
+    saveStreamlineChunks(lambda: (loadStreamlines(tract) for tract in tracts), out, header=header)
+
+def checkClusters(manifest, base_name):
+    cluster_dir = 'manually_clean/'+base_name
+    checked = cluster_dir+'.trk'
+    summary, decisions = clusterDecisions(base_name)
+    if decisions is None:
+        # interactive, never repeated automatically
+        buildArtifact(manifest, 'manual cluster check', checked, [cluster_dir], checkCommands(base_name), retries=0)
+        return
+
+    to_review = sorted(file for file in decisions if decisions[file][0] == 'review')
+    accepted = sorted(file for file in decisions if decisions[file][0] == 'accept')
+    logging.info(base_name+': '+str(len(accepted))+' clusters accepted and '+str(len(decisions)-len(accepted)-len(to_review))+
+                 ' rejected automatically, '+str(len(to_review))+' left to check.')
+    for file in sorted(decisions):
+        if decisions[file][0] != 'review':
+            logging.info('  '+os.path.basename(file)+': '+decisions[file][0]+' ('+decisions[file][1]+')')
+    if os.path.isfile(checked):
+        os.remove(checked)
 
-def manualClusterChecks():
+    reviewed = cluster_dir+'_reviewed.trk'
+    if to_review:
+        logging.info('Clusters of '+base_name+' to check:\n'+summaryTable(summary, to_review))
+        # only the clusters the triage left open are shown; the ones the reviewer keeps go to reviewed
+        commands = [['scil_clean_qbx_clusters.py'] + to_review + [reviewed, cluster_dir+'_.trk', '--min_cluster_size', '5', '-f'],
+                    ['rm', cluster_dir+'_.trk']]
+        for command in commands:
+            if not runCommand(command, 'manual cluster check', retries=0, subject=base_name[:7], artifact=checked):
+                return
+        if os.path.isfile(reviewed):
+            accepted.append(reviewed)
+
+    with traceStage('join checked clusters', subject=base_name[:7], artifact=checked):
+        joinTracts(accepted, checked, clusterFiles(cluster_dir)[0])
+    if os.path.isfile(reviewed):
+        os.remove(reviewed)
+    recordArtifact(manifest, checked, 'manual cluster check', [cluster_dir], triageParams(base_name))
+    saveManifest(manifest)
+
+def manualClusterChecks(manifest):
+    
+    to_check = list()
+    for trk in sorted(glob.glob('fuse/*.trk')):
+        base_name = os.path.basename(trk)[:-4]
+        if os.path.isdir('manually_clean/'+base_name) and needsCheck(manifest, base_name):
+            to_check.append(base_name)
+    
+    # tracts whose clusters were all accepted or rejected automatically need no one at the screen
+    for base_name in [base_name for base_name in to_check if not needsReview(base_name)]:
+        checkClusters(manifest, base_name)
+        to_check.remove(base_name)
     
+    if not to_check:
+        logging.info('All folders have had manual cluster checks performed, moving on.')
+        return
+    
+    logging.info('Manual cluster checks to be performed on: '+str(to_check))
     ready_bool = input('Are you ready to begin manual cluster checks? (y/n) ')
     
     if ready_bool == 'y':
-        command = "for i in fuse/*.trk; do echo ${i}; base_name=$(basename ${i} .trk); echo ${base_name}; "+\
-        "scil_clean_qbx_clusters.py manually_clean/${base_name}/*.trk manually_clean/${base_name}.trk manually_clean/${base_name}_.trk --min_cluster_size 5; done;"
-        os.system(command)
-        command = 'rm manually_clean/*_.trk'
-        os.system(command)
+        for base_name in to_check:
+            checkClusters(manifest, base_name)
     elif ready_bool == 'n':
         logging.error('Not ready for manual cluster checks, run this script again when you are ready.')
         exit()
 
-def smoothClean():
-    command = 'for i in manually_clean/*.trk; do echo ${i}; base_name=$(basename ${i}); scil_smooth_streamlines.py ${i} smooth_clean/smooth.trk --gaussian 10 -e 0.05; scil_outlier_rejection.py smooth_clean/smooth.trk smooth_clean/${base_name/.trk/_smooth_clean.trk} --alpha 0.5; rm smooth_clean/smooth.trk; done;'
-    os.system(command)
+# CLASS: the manual cluster checks of a stage graph run. The check step of a tract that needs one hands it over here
+# and waits; the main thread runs the checks one at a time, as the tracts' clusters become ready, while the rest of
+# the graph carries on. The ready question is asked once, at the first tract; answering anything but y leaves every
+# tract that needs a check (and only those) for the next run.
+class ClusterReview:
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.requests = queue.Queue()
+        self.ready = None
+        self.closed = False
+        self.lock = threading.Lock()
+
+    # Called by a check step: blocks until the tract was checked. Returns True if it was, False if it was not or the
+    # checks have stopped.
+    def request(self, base_name):
+        done = threading.Event()
+        result = dict()
+        with self.lock:
+            if self.closed:
+                return False
+            self.requests.put((base_name, done, result))
+        done.wait()
+        return result.get('checked', False)
+
+    # Called when the graph has finished, so serve() returns
+    def close(self):
+        self.requests.put(None)
+
+    def check(self, base_name):
+        if self.ready is None:
+            logging.info('Manual cluster checks to be performed, starting with: '+base_name)
+            try:
+                self.ready = input('Are you ready to begin manual cluster checks? (y/n) ') == 'y'
+            except EOFError:
+                self.ready = False
+            if not self.ready:
+                logging.error('Not ready for manual cluster checks: the tracts waiting on one stop there, run this script again when you are ready.')
+        if not self.ready:
+            return False
+        checkClusters(self.manifest, base_name)
+        return os.path.isfile('manually_clean/'+base_name+'.trk')
+
+    def serve(self):
+        try:
+            while True:
+                request = self.requests.get()
+                if request is None:
+                    return
+                base_name, done, result = request
+                try:
+                    result['checked'] = self.check(base_name)
+                except Exception:
+                    # one check going wrong leaves that tract unchecked, the others still get theirs
+                    logging.exception('Manual cluster check of '+base_name+' failed.')
+                finally:
+                    done.set()
+        finally:
+            # whatever stopped serving (Ctrl-C included), no check step may be left waiting on it
+            with self.lock:
+                self.closed = True
+            while True:
+                try:
+                    request = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is not None:
+                    request[1].set()
+
+# The check step of one fused tract in the stage graph
+def checkTract(manifest, base_name, review):
+    if not os.path.isdir('manually_clean/'+base_name):
+        logging.error('No clusters for '+base_name+', cannot check them.')
+        return False
+    if not needsCheck(manifest, base_name):
+        logging.info(base_name+' has had its manual cluster check, moving on.')
+    elif needsReview(base_name):
+        return review.request(base_name)
+    else:
+        checkClusters(manifest, base_name)
+
+def smoothCleanTract(manifest, trk):
+    base_name = os.path.basename(trk)[:-4]
+    smoothed = 'smooth_clean/'+base_name+'_smooth_clean.trk'
+    # a temporary file per tract, so tracts can be smoothed side by side
+    smooth_tmp = 'smooth_clean/'+base_name+'_smooth.trk'
+    commands = [['scil_smooth_streamlines.py', trk, smooth_tmp, '--gaussian', '10', '-e', '0.05', '-f'],
+                ['scil_outlier_rejection.py', smooth_tmp, smoothed, '--alpha', '0.5', '-f'],
+                ['rm', smooth_tmp]]
+    buildArtifact(manifest, 'smooth and clean', smoothed, [trk], commands)
 
-def coregisterSmoothedTracts(tract_directory):
+def smoothClean(manifest):
+    for trk in sorted(glob.glob('manually_clean/*.trk')):
+        smoothCleanTract(manifest, trk)
+
+# relative to the tract folder (the working directory), so the recorded commands do not depend on how it was typed in
+mni_template = 'mni_masked.nii.gz'
+
+def mniRegistration(tag):
+    t1_reference = tag+'__t1_warped_trk_reference.nii.gz'
+    if os.path.isfile(t1_reference):
+        cachedRegistration(mni_template, t1_reference, 'r', 'coregistered/'+tag+'_mni_output_')
+
+def coregisterTract(manifest, trk):
+    base_name = os.path.basename(trk)[:-4]
+    tag = base_name[:7]
+    mni_affine = 'coregistered/'+tag+'_mni_output_0GenericAffine.mat'
+    coregistered = 'coregistered/'+base_name+'_coregistered.trk'
+    command = ['scil_apply_transform_to_tractogram.py', trk, mni_template, mni_affine, coregistered, '--remove_invalid', '--inverse', '-f']
+    buildArtifact(manifest, 'coregister', coregistered, [trk, mni_template, mni_affine], [command])
+
+def coregisterSmoothedTracts(manifest):
     
     tag_list = getSubjectTags()
-    mni_template = tract_directory+'/mni_masked.nii.gz'
     
     for tag in tag_list:
+        mniRegistration(tag)
         
-        t1_reference = tag+'__t1_warped_trk_reference.nii.gz'
-        
-        if not os.path.isfile('coregistered/'+tag+'_mni_output_0GenericAffine.mat'):
-            command = 'antsRegistrationSyNQuick.sh -d 3 -f '+mni_template+' -m '+t1_reference+' -t r -o coregistered/'+tag+'_mni_output_ -n 4'
-            os.system(command)
-        
-    command = 'for i in smooth_clean/*.trk; do echo ${i}; base_name=$(basename ${i}); tag=$(basename ${base_name} | cut -c1-7); scil_apply_transform_to_tractogram.py ${i} '+mni_template+' coregistered/${tag}_mni_output_0GenericAffine.mat coregistered/${base_name/.trk/_coregistered.trk} --remove_invalid --inverse -f; done'
-    os.system(command)
+    for trk in sorted(glob.glob('smooth_clean/*_smooth_clean.trk')):
+        coregisterTract(manifest, trk)
         
+# final_renamed/ holds hard links to the coregistered tracts rather than copies (a copy where the
+# file system cannot link, e.g. across devices)
+def linkTract(tract_file, renamed):
+    if os.path.lexists(renamed):
+        os.remove(renamed)
+    try:
+        os.link(tract_file, renamed)
+    except OSError:
+        shutil.copy2(tract_file, renamed)
+
 def renameAtlasTracts():
     tag_list = getSubjectTags()
     
@@ -188,87 +714,144 @@ def renameAtlasTracts():
             logging.info(tract_file)
             logging.info('Renaming '+tag+' '+tract_name)
 
-            command = 'cp '+tract_file+' final_renamed/subj_'+str(i)+'/'+tract_name+'.trk'
-            os.system(command)
+            renamed = 'final_renamed/subj_'+str(i)+'/'+tract_name+'.trk'
+            with traceStage('rename atlas tracts', subject=tag, tract=tract_name):
+                linkTract(tract_file, renamed)
 
 
-def main():
-    
-    tract_directory = getTractFolder()
-    
-    os.chdir(tract_directory)
-    
-    tag_list = getSubjectTags()
+def runStages(manifest):
     
     # --- 1 --- Pass t1 images through mrtrix to get into the right format to serve as a reference
-    if len(glob.glob('*t1*reference.nii.gz')) == len(tag_list):
-        logging.info('Found a t1 reference file for each subject tag in '+tract_directory+'. moving on.')
-    else:
-        logging.info('Passing t1 images through mrtrix for '+str(tag_list))
-        t1Fixes(tract_directory)
+    logging.info('Passing t1 images through mrtrix where needed.')
+    t1Fixes(manifest)
     
     # --- 2 --- Convert tck to trk files
-    if len(glob.glob('*.tck')) == len(glob.glob('*.trk')):
-        logging.info('Looks like all .tck files have a matching .trk file, skipping tract conversion.')
-    else:
-        logging.info('Stepping into tract conversion function!')
-        convertTrks(tract_directory)
+    logging.info('Stepping into tract conversion function!')
+    convertTrks(manifest)
     
     # --- 3 --- Downsample trk files
     os.makedirs('validated/', exist_ok = True)
     os.makedirs('downsample/', exist_ok = True)
-    if len(glob.glob('downsample/*.trk')) == len(glob.glob('*.trk')):
-        logging.info('Looks like all .trk files have been downsampled, moving on.')
-    else:
-        logging.info('Downsampling tracts!')
-        clean_and_downsample()
+    logging.info('Downsampling tracts!')
+    clean_and_downsample(manifest)
      
     # --- 4 --- Flip t1 images, register flipped to original,
     os.makedirs('flip/', exist_ok = True)
-    if len(glob.glob('flip/*.mat')) == len(glob.glob('*t1*.nii.gz')):
-        logging.info('Looks like t1 images have been flipped and affine registrations have been calculated, moving on.')
-    else:
-        logging.info('Flipping and registering t1 images.')
-        t1FlipRegister(tract_directory)
+    logging.info('Flipping and registering t1 images.')
+    t1FlipRegister(manifest)
         
     # --- 5 --- Flip downsampled trk files, fuse with ipsi-hemisphere tract
     os.makedirs('fuse/', exist_ok = True)
-    if len(glob.glob('fuse/*.trk')) == len(glob.glob('downsample/*.trk')):
-        logging.info('Looks like downsample/trks have all been flipped and fused, moving on.')
-    else:
-        logging.info('Flipping and fusing downsample/trk files!')
-        flipFuseTracts()
+    logging.info('Flipping and fusing downsample/cstr files!')
+    flipFuseTracts(manifest)
     
     # --- 6 --- Compute clusters for fused tracts, then manually check
     os.makedirs('manually_clean/', exist_ok = True)
-    if len(glob.glob('manually_clean/*downsample_fuse/')) == len(glob.glob('fuse/*.trk')):
-        logging.info('Looks like clusters have been computed for all fused tracts, moving on.')
-    else:
-        logging.info('Computing clusters for fuse/*.trk files.')
-        tractClusters()
-        logging.info('Clusters have been computed, now you''ll need to manually check them.')
-        
-    if len(glob.glob('manually_clean/*.trk')) == len(glob.glob('manually_clean/*downsample_fuse/')):
-        logging.info('All folders have had manual cluster checks performed, moving on.')
-    else:
-        logging.info('Manual cluster checks to be performed on all tracts in manually_clean/ folder.')
-        manualClusterChecks()
+    logging.info('Computing clusters for fuse/*.trk files.')
+    tractClusters(manifest)
+    if cluster_triage:
+        logging.info('Summarising the clusters of fuse/*.trk files.')
+        clusterSummaries(manifest)
+    manualClusterChecks(manifest)
     
     # --- 7 --- Smooth and clean the manually checked tracts
     os.makedirs('smooth_clean/', exist_ok = True)
-    if len(glob.glob('smooth_clean/*.trk')) == len(glob.glob('manually_clean/*.trk')):
-        logging.info('Tracts have been smoothed and cleaned, moving on.')
-    else:
-        logging.info('Smoothing and cleaning manually checked tracts.')
-        smoothClean()
+    logging.info('Smoothing and cleaning manually checked tracts.')
+    smoothClean(manifest)
     
     # --- 8 --- Coregister smoothed atlas tracts
     os.makedirs('coregistered/', exist_ok = True)
-    if len(glob.glob('coregistered/*.trk')) == len(glob.glob('smooth_clean/*.trk')):
-        logging.info('Final atlas tracts have been coregistered to mni!')
+    logging.info('Coregistering smoothed/cleaned atlast tracts to mni template')
+    coregisterSmoothedTracts(manifest)
+
+# The per-artifact steps of stages 1 to 8 and what each one needs. The t1 registrations of a subject only wait
+# for its fixed t1, and each tract's chain (convert, downsample, fuse, clusters, check, smooth, coregister) only
+# waits for its own subject's steps and, when fusing, for its contralateral tract.
+def buildStageGraph(manifest, review, fuse_pool):
+    graph = StageGraph()
+    tag_regex = re.compile('\d\d-\d\d\d\d')
+    for tag in sorted(getSubjectTags()):
+        graph.add('t1 fix '+tag, t1Fix, manifest, tag, outputs=[tag+'__t1_warped_trk_reference.nii.gz'])
+        graph.add('t1 flip register '+tag, t1FlipRegisterSubject, manifest, tag, after=['t1 fix '+tag],
+                  outputs=['flip/'+tag+'_output_0GenericAffine.txt'])
+        graph.add('mni registration '+tag, mniRegistration, tag, after=['t1 fix '+tag],
+                  outputs=['coregistered/'+tag+'_mni_output_0GenericAffine.mat'])
+
+    base_names = sorted(set(file[:-4] for file in os.listdir('.') if file.endswith('.tck') or file.endswith('.trk')))
+    for base_name in base_names:
+        tag = tag_regex.findall(base_name)
+        if not tag:
+            logging.warning('No subject tag in '+base_name+', left out of the atlas build.')
+            continue
+        after = ['t1 fix '+tag[0]]
+        if os.path.isfile(base_name+'.tck'):
+            graph.add('convert '+base_name, convertTrk, manifest, base_name+'.tck', after=after, outputs=[base_name+'.trk'])
+            after = ['convert '+base_name]
+        graph.add('downsample '+base_name, cleanDownsample, manifest, base_name+'.trk', after=after,
+                  outputs=['downsample/'+base_name+'_downsample.cstr', 'validated/'+base_name+'_valid.cstr'])
+
+    for base_name in base_names:
+        downsampled = 'downsample/'+base_name+'_downsample.cstr'
+        if not graph.has('downsample '+base_name) or not hasContralateral(downsampled):
+            continue
+        contralateral = contralateralName(base_name+'_downsample')[:-len('_downsample')]
+        fused_name = base_name+'_downsample_fuse'
+        # a missing contralateral tract or registration is reported by the fuse step itself
+        after = [name for name in ['downsample '+base_name, 'downsample '+contralateral, 't1 flip register '+contralateral[:7]] if graph.has(name)]
+        graph.add('fuse '+base_name, flipFuseTract, manifest, downsampled, fuse_pool, after=after, outputs=['fuse/'+fused_name+'.trk'])
+        graph.add('clusters '+base_name, tractCluster, manifest, 'fuse/'+fused_name+'.trk', after=['fuse '+base_name],
+                  outputs=['manually_clean/'+fused_name])
+        check_after = ['clusters '+base_name]
+        if cluster_triage:
+            graph.add('cluster summary '+base_name, clusterSummary, manifest, fused_name, after=['clusters '+base_name],
+                      outputs=[summaryPath(fused_name)])
+            check_after = ['cluster summary '+base_name]
+        graph.add('cluster check '+base_name, checkTract, manifest, fused_name, review, after=check_after,
+                  outputs=['manually_clean/'+fused_name+'.trk'], gate=True)
+        graph.add('smooth '+base_name, smoothCleanTract, manifest, 'manually_clean/'+fused_name+'.trk', after=['cluster check '+base_name],
+                  outputs=['smooth_clean/'+fused_name+'_smooth_clean.trk'])
+        after = [name for name in ['smooth '+base_name, 'mni registration '+base_name[:7]] if graph.has(name)]
+        graph.add('coregister '+base_name, coregisterTract, manifest, 'smooth_clean/'+fused_name+'_smooth_clean.trk', after=after,
+                  outputs=['coregistered/'+fused_name+'_smooth_clean_coregistered.trk'])
+    return graph
+
+# Stages 1 to 8 as one graph run with graph_workers workers. The manual cluster checks are served on this thread
+# while the graph runs on another.
+def runStageGraph(manifest):
+    for directory in ['validated/', 'downsample/', 'flip/', 'fuse/', 'manually_clean/', 'smooth_clean/', 'coregistered/']:
+        os.makedirs(directory, exist_ok = True)
+    review = ClusterReview(manifest)
+    with ProcessPoolExecutor(max_workers=fuse_workers) as fuse_pool:
+        # start the fuse workers now, before any thread is running: forking next to busy threads can copy a held lock
+        fuse_pool.submit(int).result()
+        graph = buildStageGraph(manifest, review, fuse_pool)
+        logging.info('Running '+str(len(graph.steps))+' atlas build steps with '+str(graph_workers)+' workers.')
+        status = dict()
+        def runGraph():
+            try:
+                status.update(graph.run(graph_workers))
+            finally:
+                review.close()
+        graph_thread = threading.Thread(target=runGraph)
+        graph_thread.start()
+        review.serve()
+        graph_thread.join()
+    return status
+
+def main():
+    
+    tract_directory = getTractFolder()
+    
+    os.chdir(tract_directory)
+    
+    # every stage checks each of its artifacts against the manifest and only rebuilds the stale ones
+    manifest = loadManifest()
+    
+    if graph_workers:
+        # --- 1 to 8 --- as one dependency graph, every artifact built as soon as what it needs is there
+        runStageGraph(manifest)
     else:
-        logging.info('Coregistering smoothed/cleaned atlast tracts to mni template')
-        coregisterSmoothedTracts(tract_directory)
+        runStages(manifest)
 
     # --- 9 --- Rename tracts to atlas naming conventions
     os.makedirs('final_renamed/', exist_ok = True)
@@ -276,8 +859,12 @@ def main():
     for i in range(1,6):
         os.makedirs('final_renamed/subj_'+str(i), exist_ok = True)
         
-    logging.info('Going ahead with the final renaming process (copying L/R AF & UF tracts from coregistered).')
+    logging.info('Going ahead with the final renaming process (linking L/R AF & UF tracts from coregistered).')
     renameAtlasTracts()
     
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    finally:
+        # saved in the tract folder (main changes into it first)
+        writeTrace('.', 'atlas_build')
@@ -28,13 +28,44 @@ atlas tracts from the Rheault Zenodo example (5 mystery subjects, all kinds of t
        
 5: Modified script to accept AIS_R and PVI_R participants, and to process new data from the
    RH_and_extra tractoflow run on ARC (see language work log for details on that sub-cohort)
+
+6: Added a parallel scheduler (run_parallel below). Several subjects are processed at once, and every
+   ANTs (-n) and RecoX (--processes) call borrows its cores from one shared budget (total_cores) so the
+   machine is never oversubscribed. Progress is logged per subject as [done/total].
+   - the ANTs registration now goes through the shared registration cache (registration_cache.py), keyed by the
+     image contents, so reruns copy the existing transform instead of registering again.
+   - subject folders are found through the persistent subject index (subject_index.py), which only re-lists
+     folders whose modification time changed, instead of an os.walk over the whole data tree.
+   - every ANTs and RecoX command is timed (pipeline_trace.py); trace_recobundlesX_<date>.json is saved in dir_RecoX
+     and the slowest stages and subjects are logged at the end.
+   - commands run as argument lists through the shared command executor (command_executor.py) instead of os.system.
+     The executor's cpu slots (set to total_cores) replace the CoreBudget class, and a
+     subject whose registration or RecoX still fails is logged as failed instead of looking finished.
+   - the whole-brain clustering RecoX computes is cached per subject (reuse_clustering, see clustering_cache.py), keyed
+     by the streamlines and clustering parameters, so reruns with another atlas, config or minimal vote load it.
+   - the votes of every candidate streamline can be kept in <tag>/2_recox_votes/ (record_votes, see recox_votes.py;
+     off by default, it needs the VotingScheme of scilpy 2.x and stops RecoX from starting with any other).
+     Bundles for another minimal vote are written with 'python recox_votes.py materialize', and a report of streamline
+     counts per threshold (recox_vote_report_<date>.csv in dir_RecoX) is saved at the end of every run.
+   - optional job backend (job_backend = 'slurm' or 'local', see job_backend.py): the subjects' registration and RecoX,
+     and with tractometry_data_dir set the mask and metrics stages of script 4 as well, run as a per-subject DAG of
+     job arrays on the ARC cluster (SLURM), or with the local executor on one machine. The vote report and the
+     tractometry table are written by a gather job once every subject has finished.
+     Single stages can be run by hand: python 3_recobundlesX_tractography_v6.py job <register|recox> <subject folder> <dir_RecoX>
 --------------------
 """
 
 """
 MODULE IMPORTS
 """
-import os, re, logging, glob
+import os, re, sys, logging, glob, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from registration_cache import cachedRegistration
+from command_executor import runCommand, setResourceSlots
+from pipeline_trace import traceStage, writeTrace
+from recox_votes import voteReport
+from job_backend import Stage, makeBackend
+from subject_index import getSubjectList # subject folders come from the persistent subject index, not os.walk
 
 """
 LOGGING INITIALIZATION
@@ -46,17 +77,6 @@ logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %
 """
 FUNCTIONS SECTION BELOW
 """
-# FUNCTION: for all folders in a directory, if the full path ends with
-# a subject tag, add that full path to a list
-def getSubjectList(data_dir):
-    all_folders = [x[0] for x in os.walk(data_dir)]
-    subject_folder_regex = re.compile(r'\d\d-\d\d\d\d\Z') #2 digits, dash, 4 digits at very end of string (\Z)
-    subject_folder_list = list()
-    for directory in all_folders:
-        if subject_folder_regex.search(directory):
-            subject_folder_list.append(directory)
-    return subject_folder_list
-
 # FUNCTION: input a full folder path, find the subject tag (format: XX-XXXX)
 # and return that tag
 def getSubjectTag(subject_directory):
@@ -73,7 +93,7 @@ def getSubjectTag(subject_directory):
 
 # FUNCTION: if registration of subject t1 to recox mni template has not been done,
 # do it!
-def antsRegistration(group, tag, t1, dir_atlas, dir_ants_registrations):
+def antsRegistration(group, tag, t1, dir_atlas, dir_ants_registrations, n_threads=4):
     recox_atlas_template = dir_atlas+'/mni_masked.nii.gz'
     ants_warps = dir_ants_registrations+tag+'_to_mni_'
     ants_affine_mat = ants_warps+'0GenericAffine.mat'
@@ -81,88 +101,219 @@ def antsRegistration(group, tag, t1, dir_atlas, dir_ants_registrations):
     
     logging.info('ANTs registration beginning for: '+group+', '+tag)
     
-    if not os.path.isfile(ants_affine_mat):
-        command = 'antsRegistrationSyN.sh -d 3 -f '+recox_atlas_template+' -m '+t1+' -o '+ants_warps+' -t a -n 4'
-        os.system(command)
-        os.system(command)
+    # shared registration cache: only runs ANTs if these two images were never registered before
+    cachedRegistration(recox_atlas_template, t1, 'a', ants_warps, 'antsRegistrationSyN.sh', n_threads, subject=tag, group=group)
         
-    if not os.path.isfile(ants_affine_txt):
-        command = 'ConvertTransformFile 3 '+ants_affine_mat+' '+ants_affine_txt+' --hm --ras'
-        os.system(command)
+    if not os.path.isfile(ants_affine_mat):
+        raise FileNotFoundError('ANTs registration failed for '+group+', '+tag+', no '+ants_affine_mat)
+    if not os.path.isfile(ants_affine_txt) or os.path.getmtime(ants_affine_txt) < os.path.getmtime(ants_affine_mat):
+        command = ['ConvertTransformFile', '3', ants_affine_mat, ants_affine_txt, '--hm', '--ras']
+        runCommand(command, 'ConvertTransformFile', outputs=[ants_affine_txt], check=True, subject=tag, group=group)
         
     return ants_affine_txt
 
-def executeRecoX(group, tag, tractogram, dir_atlas, affine, dir_recox_tracts, recox_script_location):
+def executeRecoX(group, tag, tractogram, dir_atlas, affine, dir_recox_tracts, recox_script_location, n_processes=8, dir_votes=None):
     
     config = dir_atlas+'anna_recox_config_v1.json'
-    dir_tract_templates = dir_atlas+'atlas/*'
+    dir_tract_templates = sorted(glob.glob(dir_atlas+'atlas/*')) # what the shell used to expand atlas/* to
     
     logging.info('RecobundlesX beginning for: '+group+', '+tag)
     
-    command = recox_script_location+' '+tractogram+' '+config+' '+dir_tract_templates+' '+affine+' --out_dir '+ \
-        dir_recox_tracts+' --log_level DEBUG --minimal_vote 0.50 --multi_parameters 18 --tractogram_clustering 10 12 --processes 8 --seeds 0 -f'
-    os.system(command)
+    # RecoX runs inside recox_runner.py when its clustering is reused or its votes are kept (dir_votes)
+    launcher = list()
+    if reuse_clustering or dir_votes:
+        launcher = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recox_runner.py')]
+        launcher += ['--cache_clustering'] if reuse_clustering else []
+        launcher += ['--votes_dir', dir_votes] if dir_votes else []
+    command = launcher + [recox_script_location, tractogram, config] + dir_tract_templates + [affine, '--out_dir', dir_recox_tracts,
+        '--log_level', 'DEBUG', '--minimal_vote', '0.50', '--multi_parameters', '18', '--tractogram_clustering', '10', '12',
+        '--processes', str(n_processes), '--seeds', '0', '-f']
+    # raises CommandError if RecoX fails, so the subject is reported as failed
+    runCommand(command, 'recobundlesX', cores=n_processes, check=True, subject=tag, group=group)
+
+# FUNCTION: run registration and RecoX for one subject folder. The ANTs (ants_threads) and
+# RecoX (recox_processes) commands each wait for that many of the command executor's cpu
+# slots, so subjects running side by side never use more than the slots between them.
+# A job of the job backend runs one of the stages ('register' or 'recox') on its own.
+def processSubject(parent_directory, dir_RecoX, ants_threads=4, recox_processes=8, stages=('register', 'recox')):
+
+    group, tag = getSubjectTag(parent_directory)
+    logging.info('processing '+parent_directory)
+    logging.info(' group found: '+group+', subject tag found: '+tag)
+
+    # Do RecobundlesX below
+
+    # Initialize file locations and save directories
+
+    ## Subject's files from tractoflow
+    subj_t1 = parent_directory+'/Register_T1/'+tag+'__t1_warped.nii.gz'
+    subj_dwi_tracking = parent_directory+'/Tracking/'+tag+'__tracking.trk'
+
+    # Where to save files: base = dir_RecoX initialized above
+    os.makedirs(dir_RecoX, exist_ok = True)
+    dir_ants_registrations = dir_RecoX+'4_RecoX_outputs/'+group+'/'+tag+'/0_ants_registrations/'
+    os.makedirs(dir_ants_registrations, exist_ok = True)
+    dir_recox_tracts = dir_RecoX+'4_RecoX_outputs/'+group+'/'+tag+'/1_recox_tracts/'
+    os.makedirs(dir_recox_tracts, exist_ok = True)
+
+    dir_atlas = dir_RecoX+'3_recox_atlas/'
+
+    #perform registration, convert generic affine mat to txt
+    if 'register' in stages:
+        ants_affine = antsRegistration(group, tag, subj_t1, dir_atlas, dir_ants_registrations, ants_threads)
+    else:
+        ants_affine = dir_ants_registrations+tag+'_to_mni_0GenericAffine.txt'
+        if 'recox' in stages and not os.path.isfile(ants_affine):
+            raise FileNotFoundError('No registration for '+group+', '+tag+' ('+ants_affine+'), run the register stage first')
+
+    #try recobundlesX after registration is done
+    if 'recox' in stages:
+        if glob.glob(dir_recox_tracts+'/*.trk'):
+            logging.info('Found trk files for '+group+' '+tag)
+        else:
+            dir_votes = dir_RecoX+'4_RecoX_outputs/'+group+'/'+tag+'/2_recox_votes/' if record_votes else None
+            executeRecoX(group, tag, subj_dwi_tracking, dir_atlas, ants_affine, dir_recox_tracts, recox_script_location, recox_processes, dir_votes)
+
+    return group, tag
+
+# FUNCTION: process all subject folders at once, with at most total_cores cores in use
+# by ANTs and RecoX together. Logs a [done/total] line as each subject finishes.
+def processSubjectsParallel(subject_folders_list, dir_RecoX, total_cores, ants_threads, recox_processes):
+
+    setResourceSlots('cpu', total_cores)
+    # enough workers that the cpu slots (not the pool) are what limits how many stages run
+    n_workers = max(1, total_cores // max(1, min(ants_threads, recox_processes)))
+    n_subjects = len(subject_folders_list)
+    n_done = 0
+    start_time = time.time()
+
+    logging.info('Parallel scheduler: '+str(n_subjects)+' subjects, '+str(total_cores)+' cores, '+\
+        str(ants_threads)+' ANTs threads and '+str(recox_processes)+' RecoX processes per subject, '+str(n_workers)+' workers')
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = {pool.submit(processSubject, folder, dir_RecoX, ants_threads, recox_processes): folder
+                   for folder in subject_folders_list}
+        for future in as_completed(futures):
+            n_done += 1
+            elapsed = str(round((time.time() - start_time)/60, 1))
+            try:
+                group, tag = future.result()
+                logging.info('['+str(n_done)+'/'+str(n_subjects)+'] finished '+group+' '+tag+' ('+elapsed+' min elapsed)')
+            except Exception:
+                logging.exception('['+str(n_done)+'/'+str(n_subjects)+'] failed on '+futures[future]+' ('+elapsed+' min elapsed)')
+
+# FUNCTION: run every subject through the job backend (job_backend.py) as a DAG of per-subject stages:
+# register -> recox, then mask -> metrics of script 4 if tractometry_data_dir is set. The vote report and
+# the tractometry table are written by the gather step once all subjects have finished.
+def submitSubjectJobs(subject_folders_list, dir_RecoX):
+    script_directory = os.path.dirname(os.path.abspath(__file__))
+    this_script = os.path.abspath(__file__)
+    tractometry_script = os.path.join(script_directory, '4_tractometry_v4.py')
+
+    stages = [Stage('register', cores=ants_threads), Stage('recox', after=['register'], cores=recox_processes)]
+    gather_commands = [[sys.executable, this_script, 'gather', dir_RecoX]] if record_votes else list()
+    if tractometry_data_dir:
+        stages += [Stage('mask', after=['recox']), Stage('metrics', after=['mask'])]
+        gather_commands.append([sys.executable, tractometry_script, 'gather', os.path.abspath(tractometry_data_dir)])
+
+    def taskCommand(stage, parent_directory):
+        if stage in ['register', 'recox']:
+            return [sys.executable, this_script, 'job', stage, parent_directory, dir_RecoX]
+        group, tag = getSubjectTag(parent_directory)
+        subject_folder = dir_RecoX+'4_RecoX_outputs/'+group+'/'+tag
+        return [sys.executable, tractometry_script, 'job', stage, subject_folder, os.path.abspath(tractometry_data_dir)]
+
+    job_dir = dir_RecoX+'5_jobs/'+time.strftime('%Y-%m-%d_%H%M%S')
+    makeBackend(job_backend, job_dir).run(stages, subject_folders_list, taskCommand, gather_commands)
+
+# FUNCTION: one stage for one subject, as run by a job of the job backend. Exits non-zero if the stage
+# failed, so the subject's later stages are not run.
+def runJob(stage, parent_directory, dir_RecoX):
+    group, tag = getSubjectTag(parent_directory)
+    try:
+        with traceStage('job '+stage, subject=tag, group=group):
+            processSubject(parent_directory, dir_RecoX, ants_threads, recox_processes, stages=(stage,))
+    finally:
+        writeTrace(dir_RecoX+'4_RecoX_outputs/'+group+'/'+tag+'/', 'recobundlesX_'+stage)
 
 
 """
 VARIABLES WHICH CONTROL THIS SCRIPT
 """
+# jobs and the gather step of the job backend get dir_RecoX as their last argument instead of asking
+command_line_mode = __name__ == '__main__' and sys.argv[1:2] in [['job'], ['gather']]
 #dir_data = '/Volumes/Venus/Kirton_Diffusion_Processing/1_Tractoflow_Singleshell/'
-dir_data = input("Enter folder of data for processing: ") #'/Volumes/Venus/Imaging/Kirton_Diffusion_Processing/1_Tractoflow_Singleshell/'
+dir_data = None if command_line_mode else input("Enter folder of data for processing: ") #'/Volumes/Venus/Imaging/Kirton_Diffusion_Processing/1_Tractoflow_Singleshell/'
 #dir_data = '/Volumes/Venus/Kirton_Diffusion_Processing/1_Tractoflow_RH_and_extras/'
-dir_RecoX = input("Enter parent folder where atlas tracts are stored: ") #Anna/3_Recobundlex/2_CPC_CTC_test/
+dir_RecoX = sys.argv[-1] if command_line_mode else input("Enter parent folder where atlas tracts are stored: ") #Anna/3_Recobundlex/2_CPC_CTC_test/
 #dir_RecoX = '/Volumes/Venus/Kirton_Diffusion_Processing/2_RecobundlesX/'
 
 recox_script_location = '/Users/Bryce/bin/Scilpy/scilpy/scripts/scil_recognize_multi_bundles.py'
 
+# Parallel scheduler: process several subjects at once, sharing total_cores between the
+# ANTs (-n) and RecoX (--processes) stages. Set run_parallel to False for the old serial loop.
+run_parallel = True
+total_cores = os.cpu_count()
+ants_threads = 4
+recox_processes = 8
+
+# Run the subjects as per-subject jobs instead (job_backend.py): 'slurm' submits job arrays to the cluster
+# (partition and account from RECOX_SLURM_PARTITION / RECOX_SLURM_ACCOUNT), 'local' runs the same jobs on this
+# machine, None keeps the scheduler above. With tractometry_data_dir set (the data folder script 4 asks for), the
+# jobs go on to the masks and metrics of script 4 and the tractometry table is written at the end.
+job_backend = None
+tractometry_data_dir = None
+
+# Load the tractogram clustering of earlier RecoX runs on the same tractogram (clustering_cache.py)?
+reuse_clustering = True
+# Keep every candidate streamline's votes, for materializing other minimal votes without rerunning RecoX
+# (recox_votes.py)? vote_report_thresholds are the thresholds in the report saved at the end of the run.
+# Needs scilpy 2.x: with another scilpy version, RecoX fails to start rather than run without the votes.
+record_votes = False
+vote_report_thresholds = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.75, 0.8, 0.9]
+
 """
 --------------
 MAIN CODE BODY
 --------------
 """
 def main():
+    dir_RecoX_absolute = os.path.abspath(dir_RecoX)+'/'
     subject_folders_list = getSubjectList(dir_data)
     
     print(subject_folders_list)
 
-    for parent_directory in subject_folders_list:
-        
-        print(parent_directory)
-        group, tag = getSubjectTag(parent_directory)
-        logging.info('processing '+parent_directory)
-        logging.info(' group found: '+group+', subject tag found: '+tag)
-    
-        os.chdir(parent_directory)
-    
-        # Do RecobundlesX below
-        
-        # Initialize file locations and save directories
-        
-        ## Subject's files from tractoflow
-        subj_t1 = parent_directory+'/Register_T1/'+tag+'__t1_warped.nii.gz'
-        subj_dwi_tracking = parent_directory+'/Tracking/'+tag+'__tracking.trk'
-        
-        # Where to save files: base = dir_RecoX initialized above
-        if not os.path.isdir(dir_RecoX):
-            os.makedirs(dir_RecoX)
-        dir_ants_registrations = dir_RecoX+'4_RecoX_outputs/'+group+'/'+tag+'/0_ants_registrations/'
-        if not os.path.isdir(dir_ants_registrations):
-            os.makedirs(dir_ants_registrations)
-        dir_recox_tracts = dir_RecoX+'4_RecoX_outputs/'+group+'/'+tag+'/1_recox_tracts/'
-        if not os.path.isdir(dir_recox_tracts):
-            os.makedirs(dir_recox_tracts)
+    if job_backend:
+        # the vote report is written by the gather step when the jobs are done
+        submitSubjectJobs(subject_folders_list, dir_RecoX_absolute)
+        return
+    elif run_parallel:
+        # subjects run side by side, so resolve dir_RecoX once here instead of relying on os.chdir
+        processSubjectsParallel(subject_folders_list, dir_RecoX_absolute, total_cores, ants_threads, recox_processes)
+    else:
+        for parent_directory in subject_folders_list:
             
-        dir_atlas = dir_RecoX+'3_recox_atlas/'
-    
-        #perform registration, convert generic affine mat to txt
-        ants_affine = antsRegistration(group, tag, subj_t1, dir_atlas, dir_ants_registrations)
-    
-        #try recobundlesX after registration is done
-        if glob.glob(dir_recox_tracts+'/*.trk'):
-            logging.info('Found trk files for '+group+' '+tag)
-        else:
-            executeRecoX(group, tag, subj_dwi_tracking, dir_atlas, ants_affine, dir_recox_tracts, recox_script_location)
+            print(parent_directory)
+            os.chdir(parent_directory)
+            try:
+                processSubject(parent_directory, dir_RecoX, ants_threads, recox_processes)
+            except Exception:
+                logging.exception('failed on '+parent_directory)
+
+    # streamline counts per minimal vote for every subject with recorded votes
+    if record_votes:
+        voteReport(dir_RecoX_absolute, vote_report_thresholds)
 
 if __name__ == '__main__':
-    main()
-    
+    if command_line_mode and len(sys.argv) == 5 and sys.argv[1] == 'job':
+        runJob(sys.argv[2], sys.argv[3], os.path.abspath(sys.argv[4])+'/')
+    elif command_line_mode and len(sys.argv) == 3:
+        voteReport(os.path.abspath(dir_RecoX)+'/', vote_report_thresholds)
+    elif command_line_mode:
+        logging.error('usage: python 3_recobundlesX_tractography_v6.py job <register|recox> <subject folder> <dir_RecoX> | gather <dir_RecoX>')
+        sys.exit(2)
+    else:
+        try:
+            main()
+        finally:
+            writeTrace(dir_RecoX, 'recobundlesX')
\ No newline at end of file
@@ -20,7 +20,7 @@ Note directory is set in getParentFolder() below.
 ----- Outputs -----
 
 'tractometry_<date>.csv'
-    - data table with columns of subject, tract, and all pulled measures
+    - data table with columns of subject, tract, and all pulled measures (means, then std and count of each)
     - output dir is csv_save variable at the bottom of the main() function.
 
 ----- Versions -----
@@ -35,16 +35,68 @@ change measure_map variable declaration (currently line 98) in appendMeansToList
 
 - v3: added registration of multishell Tractoflow datasets to single-shell Tractoflow datasets (these are not aligned for whatever reason)
 
+- v4: added an in-process metrics engine (metrics_engine = 'native'). Each measure map is loaded once per subject
+      and mean/std/count are computed for every tract mask in one vectorized pass, with the same -ignorezero
+      semantics as mrstats. Set metrics_engine = 'mrstats' to go back to one mrstats call per tract and measure.
+    - added direct masking (mask_engine = 'native'): RecoX .trk streamlines are voxelized straight onto the DWI grid,
+      writing <tract>.nii (binary) and <tract>_density.nii (streamline counts) together, without the trk -> tck ->
+      tckmap round trip. The .tck copies are only written if write_tck_copies = True.
+    - added along-tract profiles (compute_profiles = True). Each tract is resampled to profile_points points per
+      streamline, the points are assigned to the nearest node of the bundle centroid, and every measure is sampled by
+      trilinear interpolation in one batch per tract. Saved as tractometry_profiles_<date>.csv (one row per point).
+    - the multishell to singleshell registration goes through the shared registration cache (registration_cache.py)
+      and the NODDI maps are only resampled again when they are older than their inputs.
+    - subject folders are found once per run through the persistent subject index (subject_index.py) instead of
+      one os.walk per group.
+    - tractograms are streamed in chunks of streamlines (streamline_io.py) for the tck conversion, masking and profile
+      stages, so peak memory no longer grows with tractogram size.
+    - results go to a result store (result_store.py, 3_Tractometry/tractometry_results.sqlite) keyed by group, subject,
+      tract and measure, with a fingerprint of the inputs. A run only computes missing or stale rows, and the csv is
+      written from the store, now with std and count columns next to the means.
+    - every external command and python stage is timed (pipeline_trace.py); trace_tractometry_<date>.json is saved in
+      3_Tractometry with the slowest stages and subjects logged at the end.
+    - commands run as argument lists through the shared command executor (command_executor.py): exit codes are
+      checked, failed reads retried, and independent commands run concurrently (the ficvf and odi AntsApplyTransforms
+      calls, and the mrstats calls of a subject).
+    - optional job backend (job_backend = 'slurm' or 'local', see job_backend.py): each subject's masks and metrics run
+      as a chain of jobs (mask -> metrics), as SLURM job arrays on the cluster or on this machine. A metrics job leaves
+      its results in 3_Tractometry/pending_results/, and the gather job adds them to the result store and writes
+      the csv tables, so the cluster jobs never write to the SQLite store at the same time.
+      Single stages: python 4_tractometry_v4.py job <mask|metrics> <subject folder> <data folder>, then gather <data folder>
+    - the native metrics and the profiles read the measure maps from a per-subject metric stack (metric_stack.py,
+      3_Tractometry/metric_stacks/): every map is decompressed once into one uncompressed memory-mapped array, which
+      is rebuilt only when a source map changes or appears. Set use_metric_stack = False to read the .nii.gz maps.
+    - every tract is also kept as a sparse voxel index (<tract>_voxels.npz: flat voxel indices and streamline density
+      weights), and the native metrics only gather those voxels from the maps, so the cost follows the size of the
+      tract rather than of the brain. A density-weighted mean is saved next to the binary-mask mean (weighted_mean in
+      the store, <measure>_wmean columns in the csv).
+    - the NODDI maps are resampled onto the singleshell grid in-process (resample_engine = 'native') instead of one
+      AntsApplyTransforms call per map: the multishell to singleshell affine is read once, the sampling coordinates
+      and trilinear weights are computed once per subject, every map is interpolated in the same pass, and the
+      coregistered maps are written side by side. The maps are listed in noddi_maps, so a new NODDI or DKI map is
+      resampled by adding it there; any map that exists is resampled, not only when both ficvf and odi do.
+      Set resample_engine = 'ants' to go back to AntsApplyTransforms.
+
 """
 
 """
 MODULE & LOGGING INITIALIZATION
 """
-import os, re, logging
+import os, re, sys, glob, json, time, logging
 import pandas as pd
-import subprocess
+import numpy as np
+import nibabel as nib
 from datetime import date
-from dipy.io.streamline import load_trk, load_tck, save_tractogram
+from concurrent.futures import ThreadPoolExecutor
+from streamline_io import iterStreamlineChunks, convertStreaming, tractogramGrid, densePoints
+from dipy.tracking.streamline import set_number_of_points, transform_streamlines
+from registration_cache import cachedRegistration
+from result_store import openStore, inputFingerprint, staleKeys, saveMetrics, saveProfiles
+from metric_stack import metricStack
+from command_executor import Command, runCommand, runCommands, transient_retries
+from pipeline_trace import traceStage, writeTrace
+from job_backend import Stage, makeBackend
+from subject_index import getSubjectList # subject folders come from the persistent subject index, not os.walk
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -66,16 +118,6 @@ def getDataFolder():
     directory = directory.strip() # remove leading or trailing whitespaces
     return directory
 
-# -- Find all paths that end in a subject tag (so find all subject subfolders in group folder)
-def getSubjectList(data_dir):
-    all_folders = [x[0] for x in os.walk(data_dir)]
-    subject_folder_regex = re.compile(r'\d\d-\d\d\d\d\Z') #2 digits, dash, 4 digits at very end of string (\Z)
-    subject_folder_list = list()
-    for directory in all_folders:
-        if subject_folder_regex.search(directory):
-            subject_folder_list.append(directory)
-    return subject_folder_list
-
 # -- For a given path, pull out the group and tag information using regex
 def getSubjectTag(subject_directory):
     
@@ -101,9 +143,8 @@ def convertAndMaskTrks(dir_data, subject_tracts_folder, group, tag):
             #get filename of .trk file
             filename = file.split('.')[0]
             if not os.path.isfile(filename+'.tck'):
-                #load trk and save as tck (no reference image needed)
-                temp_trk = load_trk(file,'same',bbox_valid_check=False)
-                save_tractogram(temp_trk,filename+'.tck',bbox_valid_check=False)
+                #stream trk into tck, chunk by chunk (no reference image needed)
+                convertStreaming(file,filename+'.tck')
                 logging.info('saved: '+filename+'.tck and produced '+filename+'.nii mask')
             elif os.path.isfile(filename+'.tck'):
                 logging.info(filename+'.tck already exists')
@@ -113,140 +154,584 @@ def convertAndMaskTrks(dir_data, subject_tracts_folder, group, tag):
                 logging.info('Producing binary .nii mask')
                 #reference image is required for tckmap, so let's specify where we expect to find the dwi image
                 dwi_template = dir_data+'/'+group+'/'+tag+'/Extract_DTI_Shell/'+tag+'__dwi_dti.nii.gz'
-                command = 'tckmap '+filename+'.tck '+filename+'.nii -template '+dwi_template
-                os.system(command)
+                command = ['tckmap', filename+'.tck', filename+'.nii', '-template', dwi_template]
+                runCommand(command, 'tckmap', outputs=[filename+'.nii'], subject=tag, group=group, tract=filename)
     
+# -- Streamline count per voxel for a set of streamlines given in voxel coordinates (voxel centres at
+# integer positions). Segments are resampled at quarter-voxel steps so every voxel a streamline passes
+# through is hit, and each streamline is counted once per voxel (like tckmap's default TDI).
+def streamlineDensity(streamlines_vox, shape):
+    n_voxels = int(np.prod(shape))
+    samples, sample_ids = densePoints(streamlines_vox, 0.25, per_axis=True)
+    if samples.shape[0] == 0:
+        return np.zeros(n_voxels, dtype=np.float32)
+
+    voxels = np.floor(samples + 0.5).astype(np.int64)
+    inside = np.all((voxels >= 0) & (voxels < np.asarray(shape[:3])), axis=1)
+    flat = np.ravel_multi_index(tuple(voxels[inside].T), shape[:3])
+    visits = np.unique(sample_ids[inside]*n_voxels + flat)
+    return np.bincount(visits % n_voxels, minlength=n_voxels).astype(np.float32)
+
+# -- Single-pass replacement for convertAndMaskTrks(): each .trk is streamed in chunks and voxelized onto
+# the subject's DWI grid, writing the binary mask (<tract>.nii) and density map (<tract>_density.nii)
+# together. A .tck copy is only written if write_tck is True. Memory stays at one chunk of streamlines.
+def voxelizeTrks(dir_data, subject_tracts_folder, group, tag, write_tck=False):
+
+    dwi_template = dir_data+'/'+group+'/'+tag+'/Extract_DTI_Shell/'+tag+'__dwi_dti.nii.gz'
+    reference = nib.load(dwi_template) if os.path.isfile(dwi_template) else None
+
+    for file in os.listdir(subject_tracts_folder):
+        if file.endswith(".trk"):
+            filename = file.split('.')[0]
+            need_tck = write_tck and not os.path.isfile(filename+'.tck')
+            need_masks = not os.path.isfile(filename+'.nii') or not os.path.isfile(filename+'_density.nii')
+            if not need_tck and not need_masks:
+                logging.info(filename+' masks already exist')
+                continue
+
+            if need_tck:
+                convertStreaming(file,filename+'.tck')
+                logging.info('saved: '+filename+'.tck')
+
+            if need_masks:
+                # tckmap used the dwi as template, fall back on the trk header if it is missing
+                if reference is not None:
+                    affine, shape = reference.affine, reference.shape[:3]
+                else:
+                    logging.warning('No dwi found at '+dwi_template+', using the grid in the '+file+' header')
+                    affine, shape = tractogramGrid(file)
+                # chunks hold whole streamlines, so adding up their densities still counts each streamline once per voxel
+                density = np.zeros(int(np.prod(shape)), dtype=np.float32)
+                for streamlines in iterStreamlineChunks(file):
+                    density += streamlineDensity(transform_streamlines(streamlines, np.linalg.inv(affine)), shape)
+                density = density.reshape(shape)
+
+                nib.save(nib.Nifti1Image(density, affine), filename+'_density.nii')
+                nib.save(nib.Nifti1Image((density > 0).astype(np.uint8), affine), filename+'.nii')
+                saveTractVoxels(filename, density, affine)
+                logging.info('produced '+filename+'.nii mask and '+filename+'_density.nii from '+file)
+
+# -- Save a tract as a sparse voxel index, <tract>_voxels.npz: the flat (C order) indices of its voxels, the
+# streamline density of each as weight, and the grid (shape, affine) they index into
+def saveTractVoxels(tract, density, affine):
+    flat_density = np.asarray(density).reshape(-1)
+    indices = np.flatnonzero(flat_density)
+    np.savez(tract+'_voxels.npz', indices=indices.astype(np.int64), weights=flat_density[indices].astype(np.float32),
+             shape=np.asarray(np.shape(density)[:3]), affine=affine)
+
+# -- A tract's sparse voxel index (indices, weights, shape), None if the tract has no mask. Built from the mask
+# files when the index is missing or older than the mask (e.g. masks from tckmap or from before the index
+# existed): from <tract>_density.nii if it is there, else from <tract>.nii with equal weights.
+def tractVoxels(tract):
+    if not os.path.isfile(tract+'.nii'):
+        return None
+    if not os.path.isfile(tract+'_voxels.npz') or os.path.getmtime(tract+'_voxels.npz') < os.path.getmtime(tract+'.nii'):
+        density_file = tract+'_density.nii'
+        if os.path.isfile(density_file) and os.path.getmtime(density_file) >= os.path.getmtime(tract+'.nii'):
+            image = nib.load(density_file)
+            saveTractVoxels(tract, np.asanyarray(image.dataobj), image.affine)
+        else:
+            image = nib.load(tract+'.nii')
+            saveTractVoxels(tract, (np.asanyarray(image.dataobj) != 0).astype(np.float32), image.affine)
+    with np.load(tract+'_voxels.npz') as voxels:
+        return voxels['indices'], voxels['weights'], tuple(int(size) for size in voxels['shape'])
+
 """
 3 -- Register Multishell tractoflow dataset to single shell tractoflow data for appropriate NODDI metric calculations
 """
 # -- For a given subject tag, if the directory with NODDI metric maps has data for that person, register their
 # multishell data to single shell FA maps.
+# -- ANTs affine (.mat, as antsRegistration writes it) as a 4x4 matrix taking RAS points of the fixed image to RAS
+# points of the moving image, which is what AntsApplyTransforms -t <affine> applies. ITK stores the matrix, the
+# translation and the centre of rotation in LPS coordinates.
+def antsAffineRas(affine_path):
+    from scipy.io import loadmat
+    transform = loadmat(affine_path)
+    parameters = np.asarray([value for key, value in transform.items() if key.startswith('AffineTransform')][0], dtype=np.float64).ravel()
+    matrix, translation = parameters[:9].reshape(3, 3), parameters[9:12]
+    centre = np.asarray(transform['fixed'], dtype=np.float64).ravel()
+    affine_lps = np.eye(4)
+    affine_lps[:3, :3] = matrix
+    affine_lps[:3, 3] = translation + centre - matrix @ centre
+    lps_to_ras = np.diag([-1.0, -1.0, 1.0, 1.0])
+    return lps_to_ras @ affine_lps @ lps_to_ras
+
+# -- Resample maps (all on one grid, map_affine) onto a reference grid, like AntsApplyTransforms with its default
+# linear interpolation: transform takes reference RAS points to map RAS points. The sampling coordinates and the
+# interpolation weights are computed once, and all maps are interpolated together in the same pass. Points that fall
+# outside the maps get 0, as with AntsApplyTransforms. Returns an array (maps, x, y, z).
+def resampleMaps(volumes, map_affine, reference_shape, reference_affine, transform, chunk=1000000):
+    to_map = np.linalg.inv(map_affine) @ transform @ reference_affine
+    stack = np.stack(volumes)
+    n_voxels = int(np.prod(reference_shape[:3]))
+    values = np.zeros((len(volumes), n_voxels), dtype=np.float64)
+    # in chunks of reference voxels, to bound the memory of the corner indices and weights
+    for start in range(0, n_voxels, chunk):
+        voxels = np.stack(np.unravel_index(np.arange(start, min(start+chunk, n_voxels)), reference_shape[:3]), axis=1)
+        corners, inside = trilinearWeights(stack.shape[1:], voxels @ to_map[:3, :3].T + to_map[:3, 3])
+        for index, weights in corners:
+            values[:, start:start+len(voxels)] += weights*stack[:, index[:, 0], index[:, 1], index[:, 2]]
+        values[:, start:start+len(voxels)][:, ~inside] = 0
+    return values.reshape((len(volumes),)+tuple(reference_shape[:3]))
+
+# -- Resample the NODDI maps of jobs [(map, coregistered map), ...] onto the singleshell FA grid through the multishell
+# to singleshell affine, in this process. Each map is loaded once, and the coregistered maps are written side by side.
+def resampleNoddiMaps(fa_singleshell, affine, jobs, group, tag):
+    with traceStage('resample NODDI maps (native)', subject=tag, group=group):
+        reference = nib.load(fa_singleshell)
+        transform = antsAffineRas(affine)
+        # maps of one fit share a grid and so one set of sampling coordinates; a map on another grid gets its own pass
+        grids = dict()
+        for subj_map, map_coreg in jobs:
+            image = nib.load(subj_map)
+            grids.setdefault((image.shape[:3], image.affine.tobytes()), list()).append((image, map_coreg))
+        outputs = list()
+        for grid_maps in grids.values():
+            volumes = [image.get_fdata().reshape(image.shape[:3]) for image, map_coreg in grid_maps]
+            resampled = resampleMaps(volumes, grid_maps[0][0].affine, reference.shape, reference.affine, transform)
+            outputs += [(map_coreg, data) for (image, map_coreg), data in zip(grid_maps, resampled)]
+
+        header = reference.header.copy()
+        header.set_data_dtype(np.float32)
+        # under a temporary name first: an interrupted write must not look newer than its inputs
+        def writeMap(map_coreg, data):
+            nib.save(nib.Nifti1Image(data.astype(np.float32), reference.affine, header), map_coreg[:-4]+'.tmp.nii')
+            os.replace(map_coreg[:-4]+'.tmp.nii', map_coreg)
+        with ThreadPoolExecutor(max_workers=len(outputs)) as pool:
+            list(pool.map(lambda output: writeMap(*output), outputs))
+
 def tractoflowRegistration(dir_data, group, tag):
 
     dir_noddi_metrics = dir_data+'/4_NODDI/1_metric_maps/'
     dir_multishell_registration = dir_data+'/4_NODDI/2_multishell_to_singleshell_warps/'
     
-    subj_ficvf = dir_noddi_metrics+tag+'_fitted_ficvf.nii'
-    subj_odi = dir_noddi_metrics+tag+'_fitted_odi.nii'
+    subj_maps = {measure: dir_noddi_metrics+tag+'_fitted_'+measure+'.nii' for measure in noddi_maps}
+    subj_maps = {measure: subj_map for measure, subj_map in subj_maps.items() if os.path.isfile(subj_map)}
     
-    #if ficvf and odi maps exist, do a quick ants registration to align FA images (multishell to singleshell)
-    if os.path.isfile(subj_ficvf) and os.path.isfile(subj_odi):
+    #if NODDI maps exist, do a quick ants registration to align FA images (multishell to singleshell)
+    if subj_maps:
         #logging.info('NODDI files found for '+tag+'! registering multishell FA to single shell FA map')
-        logging.critical('NODDI files found for '+tag+'! registering multishell FA to single shell FA map')
+        logging.critical('NODDI files found for '+tag+' ('+', '.join(sorted(subj_maps))+')! registering multishell FA to single shell FA map')
         
         fa_singleshell = dir_data+'/1_Tractoflow_Singleshell/'+group+'/'+tag+'/DTI_Metrics/'+tag+'__fa.nii.gz'
         fa_multishell = dir_data+'/1_Tractoflow_Multishell/'+tag+'/DTI_Metrics/'+tag+'__fa.nii.gz'
             
         warp_outputs = dir_multishell_registration+tag+'_multi_to_singleshell_'
-        dir_coregistered = dir_data+'/4_NODDI/3_metric_maps_coregistered/'
-        ficvf_coreg = dir_coregistered+tag+'_ficvf_coreg.nii'
-        odi_coreg = dir_coregistered+tag+'_odi_coreg.nii'
         
-        # Ants registration warps computed
-        command = 'AntsRegistrationSyNQuick.sh -d 3 -f '+fa_singleshell+' -m '+fa_multishell+' -o '+warp_outputs+' -t a -n 4'
-        os.system(command)
-
-        # Register ficvf
-        command = 'AntsApplyTransforms -d 3 -r '+fa_singleshell+' -i '+subj_ficvf+' -o '+ficvf_coreg+' -t '+warp_outputs+'0GenericAffine.mat'
-        os.system(command)
-        # Register odi
-        command = 'AntsApplyTransforms -d 3 -r '+fa_singleshell+' -i '+subj_odi+' -o '+odi_coreg+' -t '+warp_outputs+'0GenericAffine.mat'
-        os.system(command)
-        
-        del(subj_ficvf,subj_odi,command,fa_singleshell,fa_multishell,warp_outputs,dir_coregistered,ficvf_coreg,odi_coreg)
+        # Ants registration warps computed (or copied from the shared registration cache)
+        affine = cachedRegistration(fa_singleshell, fa_multishell, 'a', warp_outputs, subject=tag, group=group)
+        if not os.path.isfile(affine):
+            logging.error('No multishell to singleshell affine for '+tag+', skipping NODDI map registration.')
+            return
+
+        # Resample each map, unless the coregistered map is already newer than its inputs
+        jobs = list()
+        for measure, subj_map in sorted(subj_maps.items()):
+            map_coreg = getMeasureMapPath(dir_data, group, tag, measure)
+            newest_input = max(os.path.getmtime(path) for path in [subj_map, fa_singleshell, affine])
+            if os.path.isfile(map_coreg) and os.path.getmtime(map_coreg) >= newest_input:
+                logging.info(map_coreg+' is up to date, no need to resample it.')
+                continue
+            jobs.append((subj_map, map_coreg))
+        if not jobs:
+            return
+
+        if resample_engine == 'native':
+            resampleNoddiMaps(fa_singleshell, affine, jobs, group, tag)
+        else:
+            # the maps do not depend on each other, so the AntsApplyTransforms calls run at the same time
+            runCommands([Command(['AntsApplyTransforms', '-d', '3', '-r', fa_singleshell, '-i', subj_map, '-o', map_coreg, '-t', affine],
+                                 'AntsApplyTransforms', outputs=[map_coreg], subject=tag, group=group) for subj_map, map_coreg in jobs])
     else:
-        logging.info('NODDI maps (ficvf, odi, or both) missing for '+tag+', skipping registration.')
+        logging.info('NODDI maps ('+', '.join(noddi_maps)+') missing for '+tag+', skipping registration.')
     
 
 """
-4 -- Extract mean, sd, streamline count, save to individual list vars
+4 -- Extract mean, sd, streamline count for each tract and measure
 """
-# -- For each tract in tract_order_list, calculate mean/sd/count for each metric
-# and add to lists. If either tract mask or measure map does not exist, add 'no tract'
-# or 'no map' instead to mark the cause of the missing value.
-def calculateMetrics(dir_data, subject_folder, group, tag):
+# -- Every (tract, measure) key for this script's tract_order_list and measure_means_list
+def allKeys():
+    return [(tract, measure) for tract in tract_order_list for measure in measure_means_list]
+
+# -- For each (tract, measure) in keys (all of them by default), calculate mean/sd/count with mrstats.
+# Returns a dict of key -> (mean, std, count). If either tract mask or measure map does not exist, the
+# value is 'no tract' or 'no map' instead to mark the cause of the missing value.
+def calculateMetrics(dir_data, subject_folder, group, tag, keys=None):
     
-    for tract in tract_order_list:
-        
-        list_subj.append(tag)
-        list_group.append(group)
-        list_tract.append(tract)
+    results = dict()
+    commands = dict()
+    for tract, measure in keys or allKeys():
         
         tract_mask = tract+'.nii'
+        measure_map = getMeasureMapPath(dir_data, group, tag, measure)
         
-        if os.path.isfile(tract_mask):
-            logging.info('Found '+tract_mask+', calculating metrics!')
-            for measure in measure_means_list:
-                if not measure == 'ficvf' and not measure == 'odi':
-                    measure_map = dir_data+'/1_Tractoflow_Singleshell/'+group+'/'+tag+'/DTI_Metrics/'+tag+'__'+measure+'.nii.gz'
-                    if os.path.isfile(measure_map):
-                        logging.info('Found '+measure+' map for '+tag+' at '+measure_map+', calculating mean and SD')
-                        measure_output = subprocess.run(['mrstats',measure_map,'-mask',tract_mask,'-output','mean','-output','std','-output','count','-ignorezero'], stdout=subprocess.PIPE)
-                        measure_output_re = re.compile(r'\d\S*') # terminal output looks like "", we want only the groups
-                                                                 # that start with a number and end with a space (our 3
-                                                                 # requested metrics).
-                        measure_output_values = measure_output_re.findall(measure_output.stdout.decode('utf-8'))
-                        appendMeasures(measure, measure_output_values)
-                        del(measure_output_values)
-                    else:
-                        logging.error('Could not find '+measure+' map for '+tag+', adding na values')
-                        measure_output_values = ['no map','no map','no map']
-                        appendMeasures(measure, measure_output_values)
-                        del(measure_output_values)
-                elif measure == 'ficvf' or measure == 'odi':
-                    measure_map = dir_data+'/4_NODDI/3_metric_maps_coregistered/'+tag+'_'+measure+'_coreg.nii'
-                    if os.path.isfile(measure_map):
-                        logging.info('Found '+measure+' map for '+tag+' at '+measure_map+', calculating mean and SD')
-                        measure_output = subprocess.run(['mrstats',measure_map,'-mask',tract_mask,'-output','mean','-output','std','-output','count','-ignorezero'], stdout=subprocess.PIPE)
-                        measure_output_re = re.compile(r'\d\S*') # terminal output looks like "", we want only the groups
-                                                                 # that start with a number and end with a space (our 3
-                                                                 # requested metrics).
-                        measure_output_values = measure_output_re.findall(measure_output.stdout.decode('utf-8'))
-                        appendMeasures(measure,measure_output_values)
-                        del(measure_output_values)
-                    else:
-                        logging.error('Could not find '+measure+' map for '+tag+', adding na values')
-                        measure_output_values = ['no map','no map','no map']
-                        appendMeasures(measure, measure_output_values)
-                        del(measure_output_values)
-        else:
+        if not os.path.isfile(tract_mask):
             logging.error('Could not find tract mask: '+tract_mask+' for '+tag+', adding na values')
-            for measure in measure_means_list:
-                measure_output_values = ['no tract','no tract','no tract']
-                appendMeasures(measure, measure_output_values)
-                del(measure_output_values)
-
-# -- Add measures calculated above to relevant lists (essentially a switch case
-# function replacement)
-def appendMeasures(measure, values):
-    
-    if measure in measure_means_list:
-        if measure == 'fa':
-            list_FA_mean.append(values[0])
-            list_FA_std.append(values[1])
-            list_FA_count.append(values[2])
-        elif measure == 'md':
-            list_MD_mean.append(values[0])
-            list_MD_std.append(values[1])
-            list_MD_count.append(values[2])
-        elif measure == 'ad':
-            list_AD_mean.append(values[0])
-            list_AD_std.append(values[1])
-            list_AD_count.append(values[2])
-        elif measure == 'rd':
-            list_RD_mean.append(values[0])
-            list_RD_std.append(values[1])
-            list_RD_count.append(values[2])
-        elif measure == 'ficvf':
-            list_NDI_mean.append(values[0])
-            list_NDI_std.append(values[1])
-            list_NDI_count.append(values[2])
-        elif measure == 'odi':
-            list_ODI_mean.append(values[0])
-            list_ODI_std.append(values[1])
-            list_ODI_count.append(values[2])
+            results[(tract, measure)] = 'no tract'
+        elif not os.path.isfile(measure_map):
+            logging.error('Could not find '+measure+' map for '+tag+', adding na values')
+            results[(tract, measure)] = 'no map'
+        else:
+            logging.info('Found '+measure+' map for '+tag+' at '+measure_map+', calculating mean and SD in '+tract_mask)
+            commands[(tract, measure)] = Command(['mrstats',measure_map,'-mask',tract_mask,'-output','mean','-output','std','-output','count','-ignorezero'],
+                                                 'mrstats', retries=transient_retries, capture_output=True, subject=tag, group=group, tract=tract, measure=measure)
+
+    # the mrstats calls are independent, run them side by side
+    runCommands(list(commands.values()))
+    for key, command in commands.items():
+        measure_output_values = (command.output or '').split() if command.succeeded else [] # mean, std and count in metrics_order
+        results[key] = (parseNumber(measure_output_values, 0), parseNumber(measure_output_values, 1), parseNumber(measure_output_values, 2))
+    return results
+
+# -- One number from mrstats output (nan if mrstats printed nothing or N/A for it)
+def parseNumber(values, index):
+    try:
+        return float(values[index])
+    except (IndexError, ValueError):
+        return float('nan')
+
+# -- Path to a subject's map for one measure: DTI measures come from the single shell
+# tractoflow outputs, NODDI measures from the coregistered multishell maps.
+def getMeasureMapPath(dir_data, group, tag, measure):
+    if measure in noddi_maps:
+        return dir_data+'/4_NODDI/3_metric_maps_coregistered/'+tag+'_'+measure+'_coreg.nii'
+    return dir_data+'/1_Tractoflow_Singleshell/'+group+'/'+tag+'/DTI_Metrics/'+tag+'__'+measure+'.nii.gz'
+
+# -- A subject's measure maps as (volume, affine) by measure, for the maps that exist: views of the subject's
+# metric stack (decompressed once, memory-mapped), or the maps loaded from their files if use_metric_stack is False.
+# Volumes are read lazily, so asking for all of them costs nothing until voxels are used.
+def measureVolumes(dir_data, group, tag):
+    measure_paths = {measure: getMeasureMapPath(dir_data, group, tag, measure) for measure in measure_means_list}
+    if use_metric_stack:
+        stack = metricStack(dir_data+'/3_Tractometry/metric_stacks/', group, tag, measure_paths)
+        return {measure: (stack.volume(measure), stack.affine) for measure in measure_means_list if stack.has(measure)}
+    images = {measure: nib.load(path) for measure, path in measure_paths.items() if os.path.isfile(path)}
+    return {measure: (image.dataobj, image.affine) for measure, image in images.items()}
+
+# -- Mean, std and voxel count of one measure map inside one tract, reading only the tract's voxels (indices into
+# the flattened map). Like mrstats -ignorezero, voxels where the map is zero (or not finite) are left out; std is the
+# sample std (n-1) that mrstats reports. The fourth value is the mean weighted by streamline density, so voxels many
+# streamlines pass through count for more (the plain mean again for an index built from a binary mask, see tractVoxels).
+def tractStatsSparse(measure_data, indices, weights):
+    values = np.asarray(measure_data.reshape(-1)[indices], dtype=np.float64)
+    valid = np.isfinite(values) & (values != 0)
+    values = values[valid]
+    weights = np.asarray(weights, dtype=np.float64)[valid]
+    count = len(values)
+    mean = values.mean() if count > 0 else float('nan')
+    std = values.std(ddof=1) if count > 1 else float('nan')
+    weighted_mean = np.average(values, weights=weights) if count > 0 and weights.sum() > 0 else float('nan')
+    return (float(mean), float(std), int(count), float(weighted_mean))
+
+# -- Native replacement for calculateMetrics(): every measure map needed for keys is opened once, and for
+# each tract only the voxels of its sparse voxel index are read from it. Returns the same dict as
+# calculateMetrics, with the density-weighted mean as a fourth value.
+def calculateMetricsNative(dir_data, subject_folder, group, tag, keys=None):
+
+    keys = keys or allKeys()
+    tracts = [tract for tract in tract_order_list if any(key[0] == tract for key in keys)]
+    tract_voxels = {tract: tractVoxels(tract) for tract in tracts}
+    found_tracts = [tract for tract in tracts if tract_voxels[tract] is not None]
+    if found_tracts:
+        logging.info('Found '+str(found_tracts)+' masks, calculating metrics!')
+
+    volumes = measureVolumes(dir_data, group, tag) if found_tracts else dict()
+    results = dict()
+    for measure in measure_means_list:
+        measure_keys = [key for key in keys if key[1] == measure]
+        if not measure_keys:
+            continue
+
+        # (mean, std, count, weighted mean) by found tract, or None if the map is missing
+        measure_stats = None
+        if measure in volumes:
+            logging.info('Found '+measure+' map for '+tag+', calculating mean and SD')
+            measure_data = np.asanyarray(volumes[measure][0])
+            on_grid = [tract for tract in found_tracts if tract_voxels[tract][2] == measure_data.shape[:3]]
+            if len(on_grid) < len(found_tracts):
+                logging.error(measure+' map for '+tag+' is not on the tract mask grid of '+str([tract for tract in found_tracts if tract not in on_grid])+', adding na values')
+            measure_stats = {tract: tractStatsSparse(measure_data, *tract_voxels[tract][:2]) for tract in on_grid}
+
+        for tract, measure in measure_keys:
+            if tract not in found_tracts:
+                logging.error('Could not find tract mask: '+tract+'.nii for '+tag+', adding na values')
+                results[(tract, measure)] = 'no tract'
+            elif measure_stats is None:
+                logging.error('Could not find '+measure+' map for '+tag+', adding na values')
+                results[(tract, measure)] = 'no map'
+            elif tract not in measure_stats:
+                results[(tract, measure)] = 'no map'
+            else:
+                results[(tract, measure)] = measure_stats[tract]
+    return results
+
+# -- Fingerprints of the inputs behind each whole-tract result (mask, measure map, engine)
+def metricFingerprints(dir_data, group, tag):
+    return {(tract, measure): inputFingerprint([os.path.abspath(tract+'.nii'), getMeasureMapPath(dir_data, group, tag, measure)],
+                                               {'engine': metrics_engine, 'weighted_mean': metrics_engine == 'native'})
+            for tract, measure in allKeys()}
+
+"""
+5 -- Along-tract profiles
+"""
+# -- Resample every streamline of a tract file to n_points (chunk by chunk, so only the resampled points
+# are kept), orient them all the same way, and assign each point to the nearest node of the bundle centroid.
+# Returns the points (streamlines*n_points x 3, in rasmm) and the centroid segment (0 to n_points-1) of each
+# point, or None for an empty tract. Everything is done on whole arrays, no per-streamline loop.
+def tractProfilePoints(tract_file, n_points):
+    points = [np.asarray(set_number_of_points(chunk, n_points).get_data()).reshape(-1, n_points, 3)
+              for chunk in iterStreamlineChunks(tract_file)]
+    if not points:
+        return None
+    points = np.concatenate(points)
+
+    # flip streamlines that run the other way to the reference, then use the mean as the new reference
+    reference = points[0]
+    for iteration in range(2):
+        direct = np.linalg.norm(points - reference, axis=2).mean(axis=1)
+        flipped = np.linalg.norm(points[:, ::-1] - reference, axis=2).mean(axis=1)
+        points = np.where((flipped < direct)[:, None, None], points[:, ::-1], points)
+        reference = points.mean(axis=0)
+    centroid = reference
+
+    points = points.reshape(-1, 3)
+    segments = np.empty(len(points), dtype=np.int64)
+    chunk = 100000 # keeps the points x nodes distance matrix small for very large bundles
+    for start in range(0, len(points), chunk):
+        distances = ((points[start:start+chunk, None, :] - centroid[None, :, :])**2).sum(axis=2)
+        segments[start:start+chunk] = distances.argmin(axis=1)
+    return points, segments
+
+# -- Trilinear interpolation weights for many voxel coordinates at once (voxel centres at integer positions): the
+# voxel indices and weights of each of the 8 corners, and which points are inside a volume of this shape. Every
+# volume sampled at the same coordinates can share them.
+def trilinearWeights(shape, points_vox):
+    shape = np.asarray(shape[:3])
+    inside = np.all((points_vox >= 0) & (points_vox <= shape - 1), axis=1)
+    base = np.clip(np.floor(points_vox).astype(np.int64), 0, np.maximum(shape - 2, 0))
+    fraction = points_vox - base
+
+    corners = list()
+    for corner in np.ndindex(2, 2, 2):
+        corner = np.asarray(corner)
+        weights = np.prod(np.where(corner, fraction, 1 - fraction), axis=1)
+        corners.append((np.minimum(base + corner, shape - 1), weights))
+    return corners, inside
+
+# -- Trilinear interpolation of a volume at many voxel coordinates at once. Points outside the volume get nan.
+def trilinearSample(volume, points_vox):
+    corners, inside = trilinearWeights(volume.shape, points_vox)
+    values = np.zeros(len(points_vox), dtype=np.float64)
+    for index, weights in corners:
+        values += weights*volume[index[:, 0], index[:, 1], index[:, 2]]
+    values[~inside] = np.nan
+    return values
+
+# -- Mean of each measure along each tract, one value per centroid segment. Tract .trk files are streamed
+# once, measure maps are loaded once per subject, and all points of a tract are sampled in one batch.
+# Like -ignorezero, samples that are zero or not finite are left out. Returns a dict of (tract, measure)
+# -> list of n_points values (or 'no tract' / 'no map'), for keys (all of them by default).
+def calculateProfiles(dir_data, group, tag, n_points, keys=None):
+
+    keys = keys or allKeys()
+    tract_points = dict()
+    for tract in tract_order_list:
+        if any(key[0] == tract for key in keys) and os.path.isfile(tract+'.trk'):
+            profile_points = tractProfilePoints(tract+'.trk', n_points)
+            if profile_points is not None:
+                tract_points[tract] = profile_points
+
+    volumes = measureVolumes(dir_data, group, tag) if tract_points else dict()
+    profiles = dict()
+    for measure in measure_means_list:
+        measure_keys = [key for key in keys if key[1] == measure]
+        if not measure_keys:
+            continue
+        measure_data, measure_affine = volumes.get(measure, (None, None))
+
+        for tract, measure in measure_keys:
+            if tract not in tract_points:
+                profiles[(tract, measure)] = 'no tract'
+            elif measure_data is None:
+                profiles[(tract, measure)] = 'no map'
+            else:
+                points, segments = tract_points[tract]
+                values = trilinearSample(np.asanyarray(measure_data), nib.affines.apply_affine(np.linalg.inv(measure_affine), points))
+                valid = np.isfinite(values) & (values != 0)
+                sums = np.bincount(segments, weights=np.where(valid, values, 0), minlength=n_points)
+                counts = np.bincount(segments, weights=valid, minlength=n_points)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    profiles[(tract, measure)] = [float(value) for value in sums/counts]
+    return profiles
+
+# -- Fingerprints of the inputs behind each profile (streamlines, measure map, number of points)
+def profileFingerprints(dir_data, group, tag, n_points):
+    return {(tract, measure): inputFingerprint([os.path.abspath(tract+'.trk'), getMeasureMapPath(dir_data, group, tag, measure)],
+                                               {'points': n_points})
+            for tract, measure in allKeys()}
+
+"""
+6 -- Tables from the result store
+"""
+# -- Column name for each measure in the saved tables
+measure_labels = {'fa':'FA','md':'MD','ad':'AD','rd':'RD','ficvf':'NDI','odi':'ODI'}
+
+# -- Position of a value in an ordering list (unknown values go last), for sorting tables like main() loops
+def orderKey(column, order):
+    return column.map(lambda value: order.index(value) if value in order else len(order))
+
+# -- One row per group/subject/tract with the mean of every measure, followed by the std and count columns.
+# Missing values hold the reason ('no tract' / 'no map'), like the old table.
+def metricsTable(connection):
+    rows = pd.read_sql_query('SELECT * FROM metrics', connection)
+    rows = rows[rows['tract'].isin(tract_order_list) & rows['measure'].isin(measure_means_list)]
+
+    dataframe = rows[['group_name','subject','tract']].drop_duplicates()
+    for output, suffix in [('mean',''),('std','_std'),('count','_count'),('weighted_mean','_wmean')]:
+        for measure in measure_means_list:
+            measure_rows = rows[rows['measure'] == measure]
+            values = measure_rows[output].astype(object).where(measure_rows['status'] == 'ok', measure_rows['status'])
+            column = measure_rows[['group_name','subject','tract']].assign(**{measure_labels.get(measure, measure.upper())+suffix: values})
+            dataframe = dataframe.merge(column, on=['group_name','subject','tract'], how='left')
+    dataframe = dataframe.rename(columns={'group_name':'Group','subject':'Subject','tract':'Tract'})
+
+    # same order as the loops in main(): group_order_list, subject, tract_order_list
+    dataframe = dataframe.sort_values(['Group','Subject','Tract'], key=lambda column: orderKey(column, group_order_list) if column.name == 'Group'
+                                      else orderKey(column, tract_order_list) if column.name == 'Tract' else column)
+    return dataframe.reset_index(drop=True)
+
+# -- One row per group/subject/tract/measure/point, missing values hold the reason like metricsTable
+def profilesTable(connection):
+    rows = pd.read_sql_query('SELECT group_name, subject, tract, measure, point, value, status FROM profiles', connection)
+    rows = rows[rows['tract'].isin(tract_order_list) & rows['measure'].isin(measure_means_list)]
+    rows['value'] = rows['value'].astype(object).where(rows['status'] == 'ok', rows['status'])
+    rows = rows.drop(columns='status').rename(columns={'group_name':'Group','subject':'Subject','tract':'Tract',
+                                                       'measure':'Measure','point':'Point','value':'Value'})
+    rows = rows.sort_values(['Group','Subject','Tract','Measure','Point'], key=lambda column: orderKey(column, group_order_list) if column.name == 'Group'
+                            else orderKey(column, tract_order_list) if column.name == 'Tract'
+                            else orderKey(column, measure_means_list) if column.name == 'Measure' else column)
+    return rows.reset_index(drop=True)
+
+"""
+7 -- One subject at a time (main loop and job backend)
+"""
+# -- Step 1 for one subject: tract masks from the RecoX .trk files
+def maskSubject(dir_data, subject_folder, group, tag):
+    logging.info('Step 1: Trk conversion')
+    #change working directory to tracts folder, so masks are saved in the right place
+    os.chdir(subject_folder+'/1_recox_tracts/')
+    with traceStage('masks ('+mask_engine+')', subject=tag, group=group):
+        if mask_engine == 'native':
+            voxelizeTrks(dir_data, subject_folder+'/1_recox_tracts/', group, tag, write_tck_copies)
+        else:
+            convertAndMaskTrks(dir_data, subject_folder+'/1_recox_tracts/', group, tag)
+
+# -- Steps 2 to 4 for one subject: NODDI registration, then the metrics and profiles that are missing or stale in
+# the store. Returns the new results as (results, fingerprints) for saveMetrics and saveProfiles, None when up to date.
+def metricsSubject(dir_data, subject_folder, group, tag, store):
+    os.chdir(subject_folder+'/1_recox_tracts/')
+
+    # --- 2 --- If NODDI available: register multishell to single shell tractoflow dataset
+    logging.info('Step 2: Checking for NODDI maps. If they exist, registering multishell to singleshell tractoflow maps.')
+    with traceStage('tractoflow registration', subject=tag, group=group):
+        tractoflowRegistration(dir_data, group, tag)
+
+    # --- 3 --- Measure means for the rows that are missing or stale in the result store
+    metrics = None
+    fingerprints = metricFingerprints(dir_data, group, tag)
+    stale = staleKeys(store, 'metrics', group, tag, fingerprints)
+    if stale:
+        logging.info('Step 3: Extracting measure means for '+str(len(stale))+' stale rows')
+        with traceStage('metrics ('+metrics_engine+')', subject=tag, group=group):
+            if metrics_engine == 'native':
+                metrics = (calculateMetricsNative(dir_data, subject_folder, group, tag, stale), fingerprints)
+            else:
+                metrics = (calculateMetrics(dir_data, subject_folder, group, tag, stale), fingerprints)
     else:
-        logging.error('Measure string not in measure_means_list')
+        logging.info('Step 3: Measure means for '+tag+' are up to date, moving on.')
+
+    # --- 4 --- Along-tract profiles
+    profiles = None
+    if compute_profiles:
+        fingerprints = profileFingerprints(dir_data, group, tag, profile_points)
+        stale = staleKeys(store, 'profiles', group, tag, fingerprints)
+        if stale:
+            logging.info('Step 4: Extracting along-tract profiles for '+str(len(stale))+' stale rows')
+            with traceStage('profiles', subject=tag, group=group):
+                profiles = (calculateProfiles(dir_data, group, tag, profile_points, stale), fingerprints)
+        else:
+            logging.info('Step 4: Along-tract profiles for '+tag+' are up to date, moving on.')
+    return metrics, profiles
+
+# -- Results of a metrics job, waiting in 3_Tractometry/pending_results/ for the gather step.
+# (tract, measure) keys are stored as [tract, measure, value, fingerprint] lists, since json has no tuple keys.
+def savePendingResults(dir_data, group, tag, metrics, profiles):
+    pending = {'group': group, 'subject': tag, 'profile_points': profile_points}
+    for name, result in [('metrics', metrics), ('profiles', profiles)]:
+        if result is not None:
+            values, fingerprints = result
+            pending[name] = [[key[0], key[1], value, fingerprints[key]] for key, value in values.items()]
+    dir_pending = dir_data+'/3_Tractometry/pending_results/'
+    os.makedirs(dir_pending, exist_ok = True)
+    # written under a temporary name, so the gather step never reads half a file
+    with open(dir_pending+group+'_'+tag+'.json.tmp', 'w') as file:
+        json.dump(pending, file)
+    os.replace(dir_pending+group+'_'+tag+'.json.tmp', dir_pending+group+'_'+tag+'.json')
+
+# -- Add every pending result to the store (the gather step); each file is removed once it is saved
+def gatherPendingResults(dir_data, store):
+    pending_files = sorted(glob.glob(dir_data+'/3_Tractometry/pending_results/*.json'))
+    for pending_file in pending_files:
+        with open(pending_file) as file:
+            pending = json.load(file)
+        for name in ['metrics', 'profiles']:
+            if name not in pending:
+                continue
+            values = {(tract, measure): value if isinstance(value, str) else tuple(value) for tract, measure, value, fingerprint in pending[name]}
+            fingerprints = {(tract, measure): fingerprint for tract, measure, value, fingerprint in pending[name]}
+            if name == 'metrics':
+                saveMetrics(store, pending['group'], pending['subject'], values, fingerprints)
+            else:
+                saveProfiles(store, pending['group'], pending['subject'], values, fingerprints, pending['profile_points'])
+        os.remove(pending_file)
+    logging.info('Gathered the results of '+str(len(pending_files))+' subjects into the result store.')
+
+# -- One stage ('mask' or 'metrics') for one RecoX subject folder, as run by a job of the job backend
+def runJob(stage, subject_folder, dir_data):
+    group, tag = getSubjectTag(subject_folder)
+    try:
+        with traceStage('job '+stage, subject=tag, group=group):
+            if stage == 'mask':
+                maskSubject(dir_data, subject_folder, group, tag)
+            elif stage == 'metrics':
+                # the store is only read here; the gather step writes to it
+                store = openStore(dir_data+'/3_Tractometry/')
+                metrics, profiles = metricsSubject(dir_data, subject_folder, group, tag, store)
+                store.close()
+                savePendingResults(dir_data, group, tag, metrics, profiles)
+            else:
+                raise ValueError('Unknown tractometry stage '+stage)
+    finally:
+        writeTrace(dir_data+'/3_Tractometry/traces/', 'tractometry_'+stage+'_'+tag)
+
+# -- Step 5: the csv tables from the result store
+def saveTables(dir_data, store):
+    logging.info('Step 5: Creating a dataframe with all measure means')
+    csv_save = dir_data+'/3_Tractometry/tractometry_'+str(date.today())+'.csv'
+    metricsTable(store).to_csv(csv_save)
+    logging.info('Script completed! Results saved at: '+csv_save)
+
+    if compute_profiles:
+        profiles_save = dir_data+'/3_Tractometry/tractometry_profiles_'+str(date.today())+'.csv'
+        profilesTable(store).to_csv(profiles_save)
+        logging.info('Along-tract profiles saved at: '+profiles_save)
+
+# -- The gather step: pending results into the store, then the tables
+def gather(dir_data):
+    store = openStore(dir_data+'/3_Tractometry/')
+    gatherPendingResults(dir_data, store)
+    saveTables(dir_data, store)
+    store.close()
 
 """
 VARIABLES THAT CONTROL THIS SCRIPT
@@ -257,17 +742,32 @@ group_order_list = ['TDC','AIS_L','AIS_R','PVI_L','PVI_R']
 tract_order_list = ['AF_L_m','AF_R_m','UF_L_m','UF_R_m']
 # which measure maps to find and record means for (per tract)?
 measure_means_list = ['fa','md','ad','rd','ficvf','odi']
+# multishell maps (<tag>_fitted_<map>.nii in 4_NODDI/1_metric_maps/) resampled onto the singleshell grid by
+# tractoflowRegistration(); a new NODDI/DKI map only needs adding here and to measure_means_list
+noddi_maps = ['ficvf','odi']
+# 'native' resamples all of a subject's maps in-process in one pass, 'ants' runs one AntsApplyTransforms per map
+resample_engine = 'native'
 # order of metrics output by mrstats (used in calculateMetrics)
 metrics_order = ['mean','std','count']
+# 'native' computes all tracts per measure map in-process, 'mrstats' runs one mrstats call per tract and measure
+metrics_engine = 'native'
+# 'native' voxelizes the .trk files directly, 'tckmap' converts to .tck and runs tckmap per tract
+mask_engine = 'native'
+# read the measure maps from the per-subject metric stack (metric_stack.py) rather than the .nii.gz files?
+use_metric_stack = True
+# keep writing .tck copies of the RecoX tracts when mask_engine is 'native'?
+write_tck_copies = False
+# also compute along-tract profiles (mean of every measure at profile_points points along each tract)?
+compute_profiles = True
+profile_points = 20
+# run the subjects as mask -> metrics jobs (job_backend.py): 'slurm' submits job arrays to the cluster, 'local'
+# runs the same jobs on this machine, None keeps the loop in main()
+job_backend = None
 
 """
 Further development ideas:
     
-Along tract profiling is possible, see Tractometry_draft_commands.py or ask Helen eventually
-
 Can visualize along-tract streamline points in mrview to validate that I'm doing what I want!
-
-Can save myself the trouble of recreating this whole data table by loading an old data table and filling in new values
 """
  
 def main():
@@ -277,66 +777,60 @@ def main():
 
     dir_data = getDataFolder()
 
-    for group in group_order_list:
+    # results from earlier runs; only missing or stale rows are computed below
+    store = openStore(dir_data+'/3_Tractometry/')
+    # the trace is saved even if a subject stops the run, like in scripts 2 and 3
+    try:
+        # every subject folder under dir_parent, looked up once in the subject index
+        all_subjects = getSubjectList(dir_parent)
+
+        if job_backend:
+            # each subject's masks and metrics as jobs; the gather step saves the results and writes the tables
+            subject_list = [folder for group in group_order_list for folder in all_subjects
+                            if folder.startswith(os.path.abspath(dir_parent+'/'+group)+os.sep)]
+            this_script = os.path.abspath(__file__)
+            dir_data_absolute = os.path.abspath(dir_data)
+            stages = [Stage('mask'), Stage('metrics', after=['mask'])]
+            taskCommand = lambda stage, subject_folder: [sys.executable, this_script, 'job', stage, subject_folder, dir_data_absolute]
+            job_dir = dir_data_absolute+'/3_Tractometry/jobs/'+time.strftime('%Y-%m-%d_%H%M%S')
+            store.close()
+            makeBackend(job_backend, job_dir).run(stages, subject_list, taskCommand, [[sys.executable, this_script, 'gather', dir_data_absolute]])
+            return
+
+        for group in group_order_list:
         
-        dir_group = dir_parent+'/'+group
-        # make a list of all subject folders in the group directory
-        subject_list = getSubjectList(dir_group)
+            dir_group = os.path.abspath(dir_parent+'/'+group)
+            # make a list of all subject folders in the group directory
+            subject_list = [folder for folder in all_subjects if folder.startswith(dir_group+os.sep)]
         
-        for subject_folder in subject_list:
+            for subject_folder in subject_list:
             
-            group, tag = getSubjectTag(subject_folder)
-            logging.info('Processing '+tag)
+                group, tag = getSubjectTag(subject_folder)
+                logging.info('Processing '+tag)
             
-            # --- 1 --- Convert trk files to tck files and produce binary .nii mask
-            logging.info('Step 1: Trk conversion')
-            #change working directory to tracts folder, so masks are saved in the right place
-            os.chdir(subject_folder+'/1_recox_tracts/')
-            convertAndMaskTrks(dir_data, subject_folder+'/1_recox_tracts/', group, tag)
-            
-            # --- 2 --- If NODDI available: register multishell to single shell tractoflow dataset
-            logging.info('Step 2: Checking for NODDI maps. If they exist, registering multishell to singleshell tractoflow maps.')
-            tractoflowRegistration(dir_data, group, tag)
-
-            # --- 3 --- Build lists up with measure means
-            logging.info('Step 3: Extracting measure means')
-            ### functions below: still to be finished.
-            calculateMetrics(dir_data, subject_folder, group, tag)
-
-    # --- 3 --- Create dataframe
-    logging.info('Step 3: Creating a dataframe with all measure means')
-    dataframe_dict = {'Group':list_group,'Subject':list_subj,'Tract':list_tract,'FA':list_FA_mean,\
-                      'MD':list_MD_mean,'AD':list_AD_mean,'RD':list_RD_mean,'NDI':list_NDI_mean,'ODI':list_ODI_mean}
-    dataframe = pd.DataFrame(dataframe_dict)
+                # --- 1 --- Convert trk files to tck files and produce binary .nii mask
+                maskSubject(dir_data, subject_folder, group, tag)
             
-    # --- 4 --- Save dataframe
-    csv_save = dir_data+'/3_Tractometry/tractometry_'+str(date.today())+'.csv'
-    if os.path.isfile(csv_save):
-        os.remove(csv_save)
-    dataframe.to_csv(csv_save)
-    logging.info('Script completed! Results saved at: '+csv_save)
+                # --- 2 to 4 --- NODDI registration, then the metrics and profiles missing or stale in the store
+                metrics, profiles = metricsSubject(dir_data, subject_folder, group, tag, store)
+                if metrics is not None:
+                    saveMetrics(store, group, tag, *metrics)
+                if profiles is not None:
+                    saveProfiles(store, group, tag, *profiles, profile_points)
+
+        # --- 5 --- Save tables from the result store
+        saveTables(dir_data, store)
+    finally:
+        store.close()
+        writeTrace(dir_data+'/3_Tractometry/', 'tractometry')
 
 if __name__ == '__main__':
-    #Initialize empty lists
-    list_subj = list()
-    list_group = list()
-    list_tract = list()
-    list_FA_mean = list()
-    list_MD_mean = list()
-    list_RD_mean = list()
-    list_AD_mean = list()
-    list_NDI_mean = list()
-    list_ODI_mean = list()
-    list_FA_std = list()
-    list_MD_std = list()
-    list_RD_std = list()
-    list_AD_std = list()
-    list_NDI_std = list()
-    list_ODI_std = list()
-    list_FA_count = list()
-    list_MD_count = list()
-    list_RD_count = list()
-    list_AD_count = list()
-    list_NDI_count = list()
-    list_ODI_count = list()
-    main()
+    if len(sys.argv) == 5 and sys.argv[1] == 'job':
+        runJob(sys.argv[2], sys.argv[3], sys.argv[4])
+    elif len(sys.argv) == 3 and sys.argv[1] == 'gather':
+        gather(sys.argv[2])
+    elif len(sys.argv) > 1:
+        logging.error('usage: python 4_tractometry_v4.py [job <mask|metrics> <subject folder> <data folder> | gather <data folder>]')
+        sys.exit(2)
+    else:
+        main()
@@ -0,0 +1,204 @@
+"""
+PURPOSE:
+ - time the python-side stages of the pipeline on synthetic data, so slowdowns show up before a cohort run
+ overruns its allocation.
+
+USAGE:
+    python benchmark_pipeline.py
+
+Builds synthetic subject trees in a temporary folder, in the layout the scripts expect:
+    1_Tractoflow_Singleshell/<group>/<tag>/Extract_DTI_Shell, DTI_Metrics, Tracking, 1_recox_tracts
+    4_NODDI/3_metric_maps_coregistered
+and an atlas-build tract folder for script 2. Every stage is timed for each combination of subject_counts and
+streamline_counts below (the scaling curves). Results are printed and saved to benchmark_<date>.csv in the
+current folder, one row per stage / subject count / streamline count.
+
+Stages timed:
+ - subject discovery: os.walk (the old getSubjectList) vs the subject index, cold and warm
+ - tck -> trk conversion (convertTrks, script 2) and trk -> tck conversion (convertAndMaskTrks, script 4)
+ - streaming read of the whole-brain Tracking/<tag>__tracking.trk
+ - mask generation (voxelizeTrks, script 4), plus tckmap if mrtrix is installed
+ - calculateMetrics (native engine, plus the mrstats engine if mrtrix is installed) and calculateProfiles
+ - tract renaming/copy (renameAtlasTracts, script 2)
+"""
+
+import os, re, csv, glob, time, shutil, logging, tempfile, importlib.util
+import numpy as np
+import nibabel as nib
+from datetime import date
+
+import subject_index
+from streamline_io import saveStreamlines, convertStreaming, iterStreamlineChunks
+from command_executor import runCommand
+
+"""
+VARIABLES THAT CONTROL THIS SCRIPT
+"""
+# number of subjects in the synthetic cohort (one scaling curve point each)
+subject_counts = [1, 4, 16]
+# streamlines per whole-brain tractogram; each RecoX tract gets tract_fraction of these
+streamline_counts = [10000, 100000]
+tract_fraction = 0.02
+points_per_streamline = 60
+# volume grid of the synthetic dwi / metric maps (2 mm voxels)
+volume_shape = (96, 114, 96)
+voxel_size = 2.0
+tract_names = ['AF_L_m','AF_R_m','UF_L_m','UF_R_m']
+measures = ['fa','md','ad','rd','ficvf','odi']
+
+"""
+SYNTHETIC DATA
+"""
+# Load one of the numbered pipeline scripts as a module (their names are not valid module names)
+def loadScript(filename, module_name):
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(os.path.dirname(os.path.abspath(__file__)), filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def syntheticAffine():
+    affine = np.diag([voxel_size, voxel_size, voxel_size, 1.0])
+    affine[:3, 3] = -np.asarray(volume_shape)*voxel_size/2
+    return affine
+
+# Bundle of n streamlines running roughly along direction through the middle of the volume (rasmm)
+def syntheticBundle(rng, n_streamlines, direction, offset):
+    direction = np.asarray(direction, dtype=np.float64)/np.linalg.norm(direction)
+    half_length = 0.35*min(volume_shape)*voxel_size
+    steps = np.linspace(-half_length, half_length, points_per_streamline)
+    starts = rng.normal(offset, 4.0, size=(n_streamlines, 1, 3))
+    wobble = np.cumsum(rng.normal(0, 0.3, size=(n_streamlines, points_per_streamline, 3)), axis=1)
+    points = starts + steps[None, :, None]*direction[None, None, :] + wobble
+    return nib.streamlines.ArraySequence(list(points.astype(np.float32)))
+
+def saveVolume(data, path):
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    nib.save(nib.Nifti1Image(data, syntheticAffine()), path)
+
+# One subject in the tractoflow/RecoX layout, plus its tck tracts and t1 reference in the atlas tract folder
+def makeSubject(rng, data_root, atlas_dir, group, tag, n_streamlines):
+    subject = data_root+'/1_Tractoflow_Singleshell/'+group+'/'+tag
+    mask = np.zeros(volume_shape, dtype=bool)
+    mask[8:-8, 8:-8, 8:-8] = True
+
+    saveVolume(np.where(mask, 1.0, 0).astype(np.float32), subject+'/Extract_DTI_Shell/'+tag+'__dwi_dti.nii.gz')
+    saveVolume(np.where(mask, rng.random(volume_shape), 0).astype(np.float32), subject+'/Register_T1/'+tag+'__t1_warped.nii.gz')
+    for measure in measures[:4]:
+        saveVolume(np.where(mask, rng.random(volume_shape), 0).astype(np.float32), subject+'/DTI_Metrics/'+tag+'__'+measure+'.nii.gz')
+    for measure in measures[4:]:
+        saveVolume(np.where(mask, rng.random(volume_shape), 0).astype(np.float32), data_root+'/4_NODDI/3_metric_maps_coregistered/'+tag+'_'+measure+'_coreg.nii')
+
+    reference = subject+'/Extract_DTI_Shell/'+tag+'__dwi_dti.nii.gz'
+    os.makedirs(subject+'/Tracking', exist_ok = True)
+    saveStreamlines(syntheticBundle(rng, n_streamlines, rng.normal(size=3), [0, 0, 0]), subject+'/Tracking/'+tag+'__tracking.trk', reference)
+
+    os.makedirs(subject+'/1_recox_tracts', exist_ok = True)
+    n_tract = max(10, int(n_streamlines*tract_fraction))
+    for i, tract in enumerate(tract_names):
+        side = -20 if '_L' in tract else 20
+        bundle = syntheticBundle(rng, n_tract, [0, 1, 0.3*i], [side, 0, 0])
+        saveStreamlines(bundle, subject+'/1_recox_tracts/'+tract+'.trk', reference)
+        saveStreamlines(bundle, atlas_dir+'/'+tag+'_'+tract+'.tck')
+        saveStreamlines(bundle, atlas_dir+'/coregistered/'+tag+'_'+tract+'_downsample_fuse_smooth_clean_coregistered.trk', reference)
+    shutil.copy(reference, atlas_dir+'/'+tag+'__t1_warped_trk_reference.nii.gz')
+    return subject
+
+"""
+TIMING
+"""
+results = list()
+
+def timeStage(stage, n_subjects, n_streamlines, function):
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+    results.append({'stage': stage, 'subjects': n_subjects, 'streamlines': n_streamlines,
+                    'seconds': round(seconds, 4), 'seconds_per_subject': round(seconds/n_subjects, 4)})
+    print('{:<45} {:>4} subjects {:>8} streamlines {:>10.3f} s'.format(stage, n_subjects, n_streamlines, seconds))
+
+def walkSubjects(data_dir):
+    subject_folder_regex = re.compile(r'\d\d-\d\d\d\d\Z')
+    return [x[0] for x in os.walk(data_dir) if subject_folder_regex.search(x[0])]
+
+def runBenchmark(script_2, script_4, work_dir, n_subjects, n_streamlines):
+    rng = np.random.default_rng(0)
+    data_root = work_dir+'/data'
+    atlas_dir = work_dir+'/atlas'
+    os.makedirs(atlas_dir+'/coregistered', exist_ok = True)
+    subjects = [makeSubject(rng, data_root, atlas_dir, ['TDC','AIS_L','PVI_L'][i % 3], '%02d-%04d' % (i % 100, i), n_streamlines)
+                for i in range(n_subjects)]
+    dir_data = data_root+'/1_Tractoflow_Singleshell'
+
+    subject_index.index_path = work_dir+'/subject_index.sqlite'
+    timeStage('subject discovery (os.walk)', n_subjects, n_streamlines, lambda: walkSubjects(data_root))
+    timeStage('subject discovery (index, cold)', n_subjects, n_streamlines, lambda: subject_index.getSubjectList(data_root))
+    timeStage('subject discovery (index, warm)', n_subjects, n_streamlines, lambda: subject_index.getSubjectList(data_root))
+
+    os.chdir(atlas_dir)
+    timeStage('tck -> trk conversion (convertTrks)', n_subjects, n_streamlines, lambda: script_2.convertTrks(script_2.loadManifest()))
+
+    def streamTracking():
+        for subject in subjects:
+            for chunk in iterStreamlineChunks(glob.glob(subject+'/Tracking/*.trk')[0]):
+                pass
+    timeStage('streaming read of tracking.trk', n_subjects, n_streamlines, streamTracking)
+
+    def trkToTck():
+        for subject in subjects:
+            for trk in glob.glob(subject+'/1_recox_tracts/*.trk'):
+                convertStreaming(trk, trk[:-4]+'.tck')
+    timeStage('trk -> tck conversion (convertAndMaskTrks)', n_subjects, n_streamlines, trkToTck)
+
+    def eachSubject(function):
+        for subject in subjects:
+            group, tag = script_4.getSubjectTag(subject)
+            os.chdir(subject+'/1_recox_tracts/')
+            function(subject, group, tag)
+
+    timeStage('mask generation (voxelizeTrks)', n_subjects, n_streamlines,
+              lambda: eachSubject(lambda subject, group, tag: script_4.voxelizeTrks(dir_data, subject+'/1_recox_tracts/', group, tag)))
+    if shutil.which('tckmap'):
+        def tckmap(subject, group, tag):
+            for tract in tract_names:
+                runCommand(['tckmap', tract+'.tck', tract+'_tckmap.nii', '-template', subject+'/Extract_DTI_Shell/'+tag+'__dwi_dti.nii.gz', '-force', '-quiet'], 'tckmap')
+        timeStage('mask generation (tckmap)', n_subjects, n_streamlines, lambda: eachSubject(tckmap))
+
+    timeStage('calculateMetrics (native)', n_subjects, n_streamlines,
+              lambda: eachSubject(lambda subject, group, tag: script_4.calculateMetricsNative(data_root, subject, group, tag)))
+    if shutil.which('mrstats'):
+        timeStage('calculateMetrics (mrstats)', n_subjects, n_streamlines,
+                  lambda: eachSubject(lambda subject, group, tag: script_4.calculateMetrics(data_root, subject, group, tag)))
+    timeStage('calculateProfiles', n_subjects, n_streamlines,
+              lambda: eachSubject(lambda subject, group, tag: script_4.calculateProfiles(data_root, group, tag, script_4.profile_points)))
+
+    os.chdir(atlas_dir)
+    for i in range(1,6):
+        os.makedirs('final_renamed/subj_'+str(i), exist_ok = True)
+    timeStage('tract renaming/copy (renameAtlasTracts)', n_subjects, n_streamlines, script_2.renameAtlasTracts)
+
+def main():
+    script_2 = loadScript('2_create_Recox_template_BG_v4.py', 'create_recox_template')
+    script_4 = loadScript('4_tractometry_v4.py', 'tractometry')
+    script_4.tract_order_list = tract_names
+    script_4.measure_means_list = measures
+    logging.getLogger().setLevel(logging.WARNING) # the scripts log every file at DEBUG level
+
+    start_dir = os.getcwd()
+    try:
+        for n_subjects in subject_counts:
+            for n_streamlines in streamline_counts:
+                with tempfile.TemporaryDirectory() as work_dir:
+                    runBenchmark(script_2, script_4, work_dir, n_subjects, n_streamlines)
+                    os.chdir(start_dir)
+    finally:
+        os.chdir(start_dir)
+
+    csv_save = 'benchmark_'+str(date.today())+'.csv'
+    with open(csv_save, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=['stage','subjects','streamlines','seconds','seconds_per_subject'])
+        writer.writeheader()
+        writer.writerows(results)
+    print('Benchmark results saved at: '+csv_save)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+PURPOSE:
+ - keep track of what every stage of the atlas build (2_create_Recox_template_BG_v4.py) has produced,
+ so a rerun only redoes the artifacts whose inputs or parameters actually changed.
+
+USAGE:
+    manifest = loadManifest()
+    if isStale(manifest, output, [input_1, input_2], params):
+        ... produce output ...
+        recordArtifact(manifest, output, 'stage name', [input_1, input_2], params)
+        saveManifest(manifest)
+
+The manifest is a json file (atlas_manifest.json) saved in the tract folder. For each artifact it records the
+stage that made it, the sha256 of every input, the parameters used, and the output paths. File hashes are
+cached against size and modification time so unchanged files are not re-read on every run.
+Stages may record artifacts from several threads at once (stage_graph.py): the manifest is only changed and
+written while holding manifest_lock, and hashes are computed outside it.
+"""
+
+import os, json, hashlib, logging, time, threading
+
+manifest_name = 'atlas_manifest.json'
+manifest_lock = threading.RLock()
+
+# Hash a file's contents (sha256). Directories hash the sorted names and hashes of the files inside them.
+# hash_cache maps path -> [size, mtime_ns, digest] and is updated in place.
+def hashFile(path, hash_cache=None):
+    if os.path.isdir(path):
+        digest = hashlib.sha256()
+        for name in sorted(os.listdir(path)):
+            digest.update(name.encode('utf-8'))
+            digest.update(hashFile(os.path.join(path, name), hash_cache).encode('utf-8'))
+        return digest.hexdigest()
+
+    stat = os.stat(path)
+    if hash_cache is not None:
+        cached = hash_cache.get(path)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    digest = digest.hexdigest()
+
+    if hash_cache is not None:
+        with manifest_lock:
+            hash_cache[path] = [stat.st_size, stat.st_mtime_ns, digest]
+    return digest
+
+def loadManifest(directory='.'):
+    manifest_path = os.path.join(directory, manifest_name)
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+    else:
+        manifest = dict()
+    manifest.setdefault('artifacts', dict())
+    manifest.setdefault('hashes', dict())
+    return manifest
+
+# Write to a temporary file first so an interrupted run never leaves a half-written manifest.
+def saveManifest(manifest, directory='.'):
+    manifest_path = os.path.join(directory, manifest_name)
+    with manifest_lock:
+        with open(manifest_path+'.tmp', 'w') as file:
+            json.dump(manifest, file, indent=1, sort_keys=True)
+        os.replace(manifest_path+'.tmp', manifest_path)
+
+# An artifact is stale if it has never been recorded, any of its outputs is missing, its parameters changed,
+# or any input hash differs from the recorded one. Outputs made before the manifest existed are adopted
+# (recorded as they are) if they are all newer than their inputs, so old builds are not redone from scratch.
+def isStale(manifest, artifact, inputs, params=None, outputs=None):
+    outputs = outputs or [artifact]
+    if not all(os.path.exists(output) for output in outputs):
+        return True
+    if not all(os.path.exists(path) for path in inputs):
+        logging.error('Missing input for '+artifact+': '+str([path for path in inputs if not os.path.exists(path)]))
+        return True
+
+    entry = manifest['artifacts'].get(artifact)
+    if entry is None:
+        newest_input = max([os.path.getmtime(path) for path in inputs], default=0)
+        if min(os.path.getmtime(output) for output in outputs) >= newest_input:
+            logging.info('Adopting existing '+artifact+' into the build manifest.')
+            recordArtifact(manifest, artifact, 'adopted', inputs, params, outputs)
+            return False
+        return True
+
+    if entry['params'] != (params or dict()):
+        return True
+    if sorted(entry['inputs']) != sorted(inputs):
+        return True
+    hashes = manifest['hashes']
+    return any(hashFile(path, hashes) != entry['inputs'][path] for path in inputs)
+
+def recordArtifact(manifest, artifact, stage, inputs, params=None, outputs=None):
+    hashes = manifest['hashes']
+    input_hashes = {path: hashFile(path, hashes) for path in inputs}
+    with manifest_lock:
+        manifest['artifacts'][artifact] = {'stage': stage,
+                                           'inputs': input_hashes,
+                                           'params': params or dict(),
+                                           'outputs': outputs or [artifact],
+                                           'built': time.strftime('%Y-%m-%d %H:%M:%S')}
@@ -0,0 +1,175 @@
+"""
+PURPOSE:
+ - summarise every QuickBundlesX cluster of a fused tract once, right after the clusters are computed, and use the
+ summaries to accept or reject the clear-cut clusters automatically, so the manual cluster check of the atlas build
+ (2_create_Recox_template_BG_v4.py) only shows the reviewer the clusters that need a person to look at them.
+
+USAGE:
+    summary = summarizeClusters('manually_clean/x_fuse', ipsilateral=streamlines, contralateral=flipped_streamlines,
+                                atlas_trk='triage_reference/x_fuse.trk')
+    saveSummary(summary, 'manually_clean/x_fuse_summary.json')
+    decisions = triageClusters(loadSummary('manually_clean/x_fuse_summary.json'))
+    -> cluster file -> ('accept' | 'reject' | 'review', reason)
+    python cluster_triage.py show manually_clean/x_fuse_summary.json   # the summaries and decisions, as a table
+
+A fused tract is the tract joined with its contralateral tract flipped across the midline (flipFuseTracts() in
+script 2). For each cluster the summary holds its number of streamlines, its length distribution (mm), its centroid
+(20 points), the MDF distance from that centroid to the closest streamline of each of the two (the downsampled tract,
+and the flipped contralateral tract), and the fraction of its voxels inside the atlas bundle, a fixed reference for
+the tract (in script 2, the tract as a person first checked it in full, kept in triage_reference/ and never updated
+by the build, so accepted clusters never feed back into the reference that accepted them). A part of a bundle found on both sides of the brain is close
+to both; a cluster only one side supports is usually a false continuation.
+
+A cluster is rejected when it is smaller than min_cluster_size (the size scil_clean_qbx_clusters.py drops anyway), or
+when it lies outside the atlas bundle and one side does not support it, or, with no atlas bundle yet, one
+side does not support it and it is much shorter than the rest of the tract. It is accepted when it lies inside the
+atlas bundle, both sides support it and it is not much shorter than the rest of the tract. Everything else
+is left for the reviewer.
+"""
+
+import os, sys, json, glob, logging
+import numpy as np
+from streamline_io import loadStreamlines, tractogramGrid
+from remove_similar import resampledPoints, mdfDistances
+
+# thresholds of the automatic decisions
+min_cluster_size = 5         # streamlines; what scil_clean_qbx_clusters.py --min_cluster_size 5 drops
+accept_overlap = 0.8         # fraction of the cluster's voxels inside the atlas bundle
+reject_overlap = 0.05
+accept_support_mm = 5        # centroid distance (MDF) to the closest streamline of the side supporting it least
+reject_support_mm = 15
+short_length_ratio = 0.5     # median length relative to the median length of the whole fused tract
+
+# The thresholds the decisions were made with, to record next to what was decided
+def triageSettings():
+    return {'min_cluster_size': min_cluster_size, 'accept_overlap': accept_overlap, 'reject_overlap': reject_overlap,
+            'accept_support_mm': accept_support_mm, 'reject_support_mm': reject_support_mm,
+            'short_length_ratio': short_length_ratio}
+
+def clusterFiles(cluster_dir):
+    return sorted(glob.glob(os.path.join(cluster_dir, '*.trk')))
+
+def streamlineLengths(streamlines):
+    if len(streamlines) == 0:
+        return np.zeros(0)
+    points = np.asarray(streamlines.get_data(), dtype=np.float64)
+    lengths = np.asarray(streamlines._lengths, dtype=np.int64)
+    steps = np.linalg.norm(np.diff(points, axis=0), axis=1)
+    # the step from the last point of one streamline to the first of the next is not part of either
+    steps[np.cumsum(lengths)[:-1] - 1] = 0
+    return np.add.reduceat(np.append(steps, 0), np.cumsum(lengths) - lengths)
+
+# Mean of the n_resample-point resampled streamlines, each one turned to run the same way as the first
+def clusterCentroid(streamlines):
+    streamlines = streamlines[np.flatnonzero(np.asarray(streamlines._lengths) > 1)]
+    if len(streamlines) == 0:
+        return None
+    points = resampledPoints(streamlines)
+    _, flipped = mdfDistances(points[0], points)
+    return np.where(flipped[:, None, None], points[:, ::-1], points).mean(axis=0)
+
+# Voxels (of the grid given by affine) the streamlines' points fall in, as one int64 key per voxel
+def voxelKeys(streamlines, affine):
+    if len(streamlines) == 0:
+        return np.zeros(0, dtype=np.int64)
+    voxels = np.rint(np.asarray(streamlines.get_data(), dtype=np.float64) @ np.linalg.inv(affine)[:3, :3].T
+                     + np.linalg.inv(affine)[:3, 3]).astype(np.int64) + (1 << 20)
+    return np.unique((voxels[:, 0] << 42) | (voxels[:, 1] << 21) | voxels[:, 2])
+
+def lengthSummary(lengths):
+    if len(lengths) == 0:
+        return None
+    percentiles = np.percentile(lengths, [5, 50, 95])
+    return {'mean': float(lengths.mean()), 'std': float(lengths.std()), 'min': float(lengths.min()), 'p5': float(percentiles[0]),
+            'median': float(percentiles[1]), 'p95': float(percentiles[2]), 'max': float(lengths.max())}
+
+# MDF distance from a centroid to the closest of the resampled streamlines points (None if there are none)
+def closestDistance(centroid, points):
+    if centroid is None or points is None or len(points) == 0:
+        return None
+    return float(mdfDistances(centroid, points)[0].min())
+
+# Summaries of every cluster in cluster_dir. ipsilateral and contralateral are the two tracts the fused tract was made
+# of (ArraySequences in rasmm, the contralateral one already flipped); atlas_trk is the fixed atlas bundle. All three
+# are optional.
+def summarizeClusters(cluster_dir, ipsilateral=None, contralateral=None, atlas_trk=None):
+    files = clusterFiles(cluster_dir)
+    sides = [resampledPoints(side[np.flatnonzero(np.asarray(side._lengths) > 1)]) if side is not None and len(side) else None
+             for side in [ipsilateral, contralateral]]
+
+    affine = tractogramGrid(files[0])[0] if files else np.eye(4)
+    atlas_voxels = voxelKeys(loadStreamlines(atlas_trk), affine) if atlas_trk and os.path.isfile(atlas_trk) else None
+
+    clusters = list()
+    all_lengths = list()
+    for file in files:
+        streamlines = loadStreamlines(file)
+        lengths = streamlineLengths(streamlines)
+        all_lengths.append(lengths)
+        centroid = clusterCentroid(streamlines)
+        overlap = None
+        if atlas_voxels is not None and len(streamlines):
+            overlap = float(np.isin(voxelKeys(streamlines, affine), atlas_voxels, assume_unique=True).mean())
+        clusters.append({'file': file, 'n_streamlines': len(streamlines), 'length_mm': lengthSummary(lengths),
+                         'ipsilateral_mm': closestDistance(centroid, sides[0]), 'contralateral_mm': closestDistance(centroid, sides[1]),
+                         'atlas_overlap': overlap, 'centroid': centroid.round(3).tolist() if centroid is not None else None})
+
+    all_lengths = np.concatenate(all_lengths) if all_lengths else np.zeros(0)
+    return {'cluster_dir': cluster_dir, 'atlas_trk': atlas_trk if atlas_voxels is not None else None,
+            'tract_median_length_mm': float(np.median(all_lengths)) if len(all_lengths) else None, 'clusters': clusters}
+
+def saveSummary(summary, path):
+    with open(path+'.tmp', 'w') as file:
+        json.dump(summary, file, indent=1)
+    os.replace(path+'.tmp', path)
+
+def loadSummary(path):
+    with open(path) as file:
+        return json.load(file)
+
+def triageCluster(cluster, tract_median_length):
+    if cluster['n_streamlines'] < min_cluster_size:
+        return 'reject', 'fewer than '+str(min_cluster_size)+' streamlines'
+    overlap = cluster['atlas_overlap']
+    # the distance to the side that supports the cluster least (unknown if either side was not available)
+    distances = [cluster['ipsilateral_mm'], cluster['contralateral_mm']]
+    support = max(distances) if None not in distances else None
+    short = bool(tract_median_length and cluster['length_mm'] and
+                 cluster['length_mm']['median'] < short_length_ratio*tract_median_length)
+    one_sided = support is not None and support > reject_support_mm
+    if overlap is not None:
+        if overlap >= accept_overlap and support is not None and support <= accept_support_mm and not short:
+            return 'accept', 'in the atlas bundle ({:.0%}), on both sides ({:.1f} mm)'.format(overlap, support)
+        if overlap <= reject_overlap and one_sided:
+            return 'reject', 'outside the atlas bundle ({:.0%}), one side only ({:.1f} mm)'.format(overlap, support)
+    elif one_sided and short:
+        return 'reject', 'one side only ({:.1f} mm) and short (median {:.0f} mm)'.format(support, cluster['length_mm']['median'])
+    return 'review', ''
+
+# cluster file -> (decision, reason) for every cluster of a summary
+def triageClusters(summary):
+    return {cluster['file']: triageCluster(cluster, summary['tract_median_length_mm']) for cluster in summary['clusters']}
+
+# The summaries of the given clusters (all by default) as a table, for the log and the reviewer
+def summaryTable(summary, files=None):
+    decisions = triageClusters(summary)
+    lines = ['{:<28} {:>6} {:>20} {:>14} {:>8}  {}'.format('cluster', 'count', 'length p5/50/95 mm', 'ipsi/contra mm', 'in atlas', 'decision')]
+    for cluster in summary['clusters']:
+        if files is not None and cluster['file'] not in files:
+            continue
+        length = cluster['length_mm']
+        decision, reason = decisions[cluster['file']]
+        lines.append('{:<28} {:>6} {:>20} {:>14} {:>8}  {}'.format(
+            os.path.basename(cluster['file']), cluster['n_streamlines'],
+            '{:.0f}/{:.0f}/{:.0f}'.format(length['p5'], length['median'], length['p95']) if length else '-',
+            '/'.join('{:.1f}'.format(distance) if distance is not None else '-' for distance in [cluster['ipsilateral_mm'], cluster['contralateral_mm']]),
+            '{:.0%}'.format(cluster['atlas_overlap']) if cluster['atlas_overlap'] is not None else '-',
+            decision+(' ('+reason+')' if reason else '')))
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+    if len(sys.argv) == 3 and sys.argv[1] == 'show':
+        print(summaryTable(loadSummary(sys.argv[2])))
+    else:
+        logging.error('usage: python cluster_triage.py show <summary json>')
@@ -0,0 +1,146 @@
+"""
+PURPOSE:
+ - keep the whole-brain clustering RecobundlesX computes for each subject, so reruns with a different atlas, config or
+ vote threshold load it from disk instead of running QuickBundlesX over the tractogram again.
+
+USAGE:
+    python recox_runner.py --cache_clustering <scil_recognize_multi_bundles.py> <its arguments...>
+    -> runs RecoX with installClusteringCache() in place (executeRecoX() in script 3 does this when reuse_clustering
+       is True)
+
+    python clustering_cache.py clean 90
+    -> removes cached clusterings that have not been used for 90 days
+
+RecoX clusters the tractogram with dipy's qbx_and_merge, once per clustering threshold set and seed. Every such call
+is looked up in cache_directory (RECOX_CLUSTER_CACHE, or ~/.recox_cluster_cache) under the sha256 of the streamlines
+themselves (so a re-tracked or re-cropped tractogram never matches an old entry), the thresholds, the number of points
+and the state of the random generator. An entry holds the indices and centroid of every cluster and the generator
+state after clustering, so a run that loads it continues exactly like one that clustered.
+"""
+
+import os, sys, glob, hashlib, logging, time, weakref
+import numpy as np
+
+cache_directory = os.environ.get('RECOX_CLUSTER_CACHE', os.path.expanduser('~/.recox_cluster_cache'))
+
+# hits and misses of this run, logged when RecoX finishes
+cache_counts = {'loaded': 0, 'computed': 0}
+# streamline hashes for this process (RecoX clusters the same tractogram several times), by object id together with
+# a weak reference to the object: an id can be reused once its object is freed, the weak reference tells them apart
+streamline_hashes = dict()
+# points hashed at a time, so the tractogram is never copied whole
+hash_chunk_points = 1 << 22
+
+def contentHash(streamlines):
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(streamlines._lengths, dtype=np.int64).tobytes())
+    data = streamlines.get_data()
+    for start in range(0, len(data), hash_chunk_points):
+        digest.update(np.ascontiguousarray(data[start:start+hash_chunk_points], dtype=np.float32).tobytes())
+    return digest.hexdigest()
+
+def streamlinesHash(streamlines):
+    entry = streamline_hashes.get(id(streamlines))
+    if entry is not None and entry[0]() is streamlines and entry[1] == len(streamlines):
+        return entry[2]
+    digest = contentHash(streamlines)
+    try:
+        streamline_hashes[id(streamlines)] = (weakref.ref(streamlines), len(streamlines), digest)
+    except TypeError:
+        pass # no weak references to this object: hashed again on every call
+    return digest
+
+def rngStateBytes(rng):
+    name, keys, position, has_gauss, cached_gaussian = rng.get_state()
+    return name.encode('utf-8')+np.asarray(keys).tobytes()+str((position, has_gauss, cached_gaussian)).encode('utf-8')
+
+def clusteringKey(streamlines, thresholds, nb_pts, select_randomly, rng):
+    parts = [streamlinesHash(streamlines), str([float(threshold) for threshold in thresholds]), str(nb_pts), str(select_randomly)]
+    parts.append(hashlib.sha256(rngStateBytes(rng)).hexdigest() if rng is not None else 'no rng')
+    return hashlib.sha256(' '.join(parts).encode('utf-8')).hexdigest()
+
+def saveClusterMap(entry_path, cluster_map, rng):
+    indices = [np.asarray(cluster.indices, dtype=np.int64) for cluster in cluster_map.clusters]
+    centroids = [np.asarray(cluster.centroid, dtype=np.float32) for cluster in cluster_map.clusters]
+    arrays = {'indices': np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64),
+              'index_counts': np.asarray([len(cluster_indices) for cluster_indices in indices], dtype=np.int64),
+              'centroids': np.stack(centroids) if centroids else np.zeros((0, 0, 3), dtype=np.float32)}
+    if rng is not None:
+        name, keys, position, has_gauss, cached_gaussian = rng.get_state()
+        arrays.update({'rng_keys': keys, 'rng_numbers': np.asarray([position, has_gauss, cached_gaussian], dtype=np.float64)})
+    # write under a private name and rename it into place, so an interrupted run never leaves half an entry
+    os.makedirs(cache_directory, exist_ok = True)
+    temporary = entry_path[:-4]+'.tmp'+str(os.getpid())+'.npz'
+    np.savez(temporary, **arrays)
+    os.replace(temporary, entry_path)
+
+def loadClusterMap(entry_path, streamlines, rng):
+    from dipy.segment.clustering import ClusterMapCentroid, ClusterCentroid
+    with np.load(entry_path) as entry:
+        cluster_map = ClusterMapCentroid(refdata=streamlines)
+        offsets = np.cumsum(entry['index_counts']) - entry['index_counts']
+        for offset, count, centroid in zip(offsets, entry['index_counts'], entry['centroids']):
+            cluster_map.add_cluster(ClusterCentroid(centroid, indices=entry['indices'][offset:offset+count].tolist()))
+        if rng is not None and 'rng_keys' in entry:
+            position, has_gauss, cached_gaussian = entry['rng_numbers']
+            rng.set_state(('MT19937', entry['rng_keys'], int(position), int(has_gauss), float(cached_gaussian)))
+    os.utime(entry_path) # the file mtime marks when the entry was last used (see cleanClusterCache)
+    return cluster_map
+
+# Wrap dipy's qbx_and_merge so every call is served from the cache when possible
+def cachedQbxAndMerge(qbx_and_merge):
+    def cached(streamlines, thresholds, nb_pts=20, select_randomly=None, rng=None, verbose=False):
+        if (select_randomly is not None and rng is None) or (rng is not None and not hasattr(rng, 'get_state')):
+            # random subset without a seeded RandomState: not reproducible, so not cached
+            return qbx_and_merge(streamlines, thresholds, nb_pts, select_randomly, rng, verbose)
+        entry_path = os.path.join(cache_directory, clusteringKey(streamlines, thresholds, nb_pts, select_randomly, rng)+'.npz')
+        if os.path.isfile(entry_path):
+            try:
+                cluster_map = loadClusterMap(entry_path, streamlines, rng)
+                cache_counts['loaded'] += 1
+                logging.info('Tractogram clustering '+str(list(thresholds))+' loaded from the cluster cache.')
+                return cluster_map
+            except (OSError, ValueError, KeyError):
+                logging.warning('Unreadable cluster cache entry '+entry_path+', clustering again.')
+        cluster_map = qbx_and_merge(streamlines, thresholds, nb_pts, select_randomly, rng, verbose)
+        saveClusterMap(entry_path, cluster_map, rng)
+        cache_counts['computed'] += 1
+        return cluster_map
+    return cached
+
+# Replace qbx_and_merge by the cached version everywhere RecoX can pick it up (dipy itself, and any
+# module that already imported it by name). Call before running the RecoX script in this process.
+def installClusteringCache():
+    import dipy.segment.clustering
+    original = dipy.segment.clustering.qbx_and_merge
+    cached = cachedQbxAndMerge(original)
+    dipy.segment.clustering.qbx_and_merge = cached
+    try:
+        import scilpy.segment.voting_scheme
+    except ImportError:
+        pass
+    for module in list(sys.modules.values()):
+        if getattr(module, 'qbx_and_merge', None) is original:
+            setattr(module, 'qbx_and_merge', cached)
+
+def logClusteringCache():
+    if cache_counts['loaded'] + cache_counts['computed'] == 0:
+        logging.warning('RecoX never called qbx_and_merge, nothing was cached (has scilpy changed how it clusters?)')
+    else:
+        logging.info('Tractogram clusterings: '+str(cache_counts['loaded'])+' loaded from the cache, '+
+                     str(cache_counts['computed'])+' computed and cached.')
+
+# Remove cached clusterings (and leftover unfinished writes) that have not been used for max_age_days.
+def cleanClusterCache(max_age_days):
+    cutoff = time.time() - max_age_days*24*60*60
+    for entry_path in sorted(glob.glob(os.path.join(cache_directory, '*.npz'))):
+        if os.path.getmtime(entry_path) < cutoff:
+            logging.info('Removing unused cluster cache entry '+os.path.basename(entry_path))
+            os.remove(entry_path)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+    if len(sys.argv) == 3 and sys.argv[1] == 'clean':
+        cleanClusterCache(float(sys.argv[2]))
+    else:
+        logging.error('usage: python clustering_cache.py clean <max age in days>')
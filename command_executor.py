@@ -0,0 +1,171 @@
+"""
+PURPOSE:
+ - one way for all four scripts to run external commands (ANTs, RecoX, scilpy, mrtrix): argument lists instead of
+ shell strings, exit codes checked, transient failures retried where asked for, and a limited number of commands per resource
+ running at once, so independent commands can run side by side without oversubscribing the machine.
+
+USAGE:
+    ok = runCommand(['ConvertTransformFile', '3', mat, txt, '--hm', '--ras'], 'ConvertTransformFile', outputs=[txt], subject=tag)
+    ok, output = runCommandOutput(['mrstats', measure_map, '-mask', tract_mask, ...], 'mrstats', subject=tag)
+    oks = runCommands([Command([...], 'AntsApplyTransforms', outputs=[ficvf_coreg], subject=tag),
+                       Command([...], 'AntsApplyTransforms', outputs=[odi_coreg], subject=tag)])   # run concurrently
+    runCommand([...], 'recobundlesX', cores=8, check=True)   # raises CommandError if it fails
+    runCommandOutput(['sbatch', '--parsable', script], 'sbatch', retries=transient_retries)   # retried if it fails
+
+Resources: a 'cpu' command (ANTs, RecoX, scilpy, tckgen) holds `cores` of the cpu slots while it runs, an 'io'
+command (copies, format conversions, mrstats; see io_programs) holds one of the io slots. The slots are shared by
+every thread of the process: all commands go through one asyncio event loop running in a background thread, which
+owns the semaphores. Limits come from RECOX_CPU_SLOTS / RECOX_IO_SLOTS or setResourceSlots().
+
+A command failed if its exit code is not 0 or one of its outputs is missing afterwards. It is then retried up to
+`retries` times (max_retries by default, 0: a failing registration or RecoX run would only fail again, and take
+as long doing it), waiting retry_delay, 2*retry_delay, ... seconds in between, unless the exit code says running it
+again cannot help (permanent_exit_codes). Callers pass retries=transient_retries for the commands whose failure can
+be transient: reads from the network volume, job submission. Every attempt is timed in the pipeline trace.
+"""
+
+import os, time, asyncio, logging, threading, subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pipeline_trace import traceCommand, addEvent
+
+resource_slots = {'cpu': int(os.environ.get('RECOX_CPU_SLOTS', os.cpu_count() or 1)),
+                  'io': int(os.environ.get('RECOX_IO_SLOTS', 4))}
+max_retries = int(os.environ.get('RECOX_COMMAND_RETRIES', 0))
+transient_retries = int(os.environ.get('RECOX_TRANSIENT_RETRIES', 2))
+retry_delay = 10 # seconds
+
+# exit codes of commands that are wrong in themselves (usage errors from argparse, missing programs)
+permanent_exit_codes = {2: 'bad arguments', 126: 'not executable', 127: 'command not found'}
+# programs that mostly move data around rather than compute
+io_programs = {'cp', 'mv', 'rm', 'mrconvert', 'mrstats', 'ConvertTransformFile'}
+
+class CommandError(Exception):
+    pass
+
+# CLASS: one external command and, once it has run, its result (succeeded, exit_code, output).
+# labels (subject=..., tract=...) go to the pipeline trace.
+class Command:
+    def __init__(self, args, stage, resource=None, cores=1, outputs=None, retries=None, capture_output=False, **labels):
+        self.args = [str(arg) for arg in args]
+        self.stage = stage
+        self.resource = resource or ('io' if os.path.basename(self.args[0]) in io_programs else 'cpu')
+        self.cores = cores
+        self.outputs = outputs or list()
+        self.retries = max_retries if retries is None else retries
+        self.capture_output = capture_output
+        self.labels = labels
+        self.succeeded = None
+        self.exit_code = None
+        self.output = None
+
+    def __str__(self):
+        return ' '.join(self.args)
+
+# CLASS: the slots of one resource. A command waits until enough slots are free, so the commands
+# holding slots never add up to more than the resource's limit. Only used on the event loop thread.
+class ResourceSlots:
+    def __init__(self, resource):
+        self.resource = resource
+        self.in_use = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self, slots):
+        slots = max(1, min(slots, resource_slots[self.resource])) # a single command can never ask for more than the limit
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_use + slots <= resource_slots[self.resource])
+            self.in_use += slots
+        return slots
+
+    async def release(self, slots):
+        async with self.condition:
+            self.in_use -= slots
+            self.condition.notify_all()
+
+loop = None
+loop_pid = None
+loop_lock = threading.Lock()
+slots = dict()
+
+# The event loop every command of this process runs on, started on first use. A worker process (fork or spawn)
+# gets its own loop, with its own slots.
+def eventLoop():
+    global loop, loop_pid
+    with loop_lock:
+        if loop is None or loop_pid != os.getpid():
+            loop = asyncio.new_event_loop()
+            loop_pid = os.getpid()
+            slots.clear()
+            # each running command waits for its process in one of these threads (wait4 gives its CPU time and
+            # peak RSS for the trace); the slots, not this pool, limit how many run at once
+            loop.set_default_executor(ThreadPoolExecutor(max_workers=256, thread_name_prefix='command'))
+            threading.Thread(target=loop.run_forever, name='command_executor', daemon=True).start()
+        return loop
+
+# Change how many slots a resource has, e.g. the total_cores of script 3
+def setResourceSlots(resource, n_slots):
+    resource_slots[resource] = max(1, int(n_slots))
+
+def resourceSlots(resource):
+    if resource not in slots:
+        slots[resource] = ResourceSlots(resource)
+    return slots[resource]
+
+def failureReason(command):
+    if command.exit_code:
+        return 'exit code '+str(command.exit_code)+' ('+permanent_exit_codes.get(command.exit_code, 'failed')+')'
+    return 'missing outputs '+str([output for output in command.outputs if not os.path.exists(output)])
+
+async def runAsync(command):
+    pool = resourceSlots(command.resource)
+    for attempt in range(command.retries + 1):
+        if attempt:
+            logging.warning(command.stage+' failed ('+failureReason(command)+'), retry '+str(attempt)+' of '+
+                            str(command.retries)+' in '+str(retry_delay*attempt)+' s: '+str(command))
+            await asyncio.sleep(retry_delay*attempt)
+        labels = dict(command.labels, attempt=attempt+1) if attempt else command.labels
+        held = await pool.acquire(command.cores)
+        try:
+            command.exit_code, command.output = await asyncio.get_running_loop().run_in_executor(
+                None, traceCommand, command.args, command.stage, command.capture_output, labels)
+        finally:
+            await pool.release(held)
+
+        command.succeeded = command.exit_code == 0 and all(os.path.exists(output) for output in command.outputs)
+        if command.succeeded or command.exit_code in permanent_exit_codes:
+            break
+
+    if not command.succeeded:
+        logging.error(command.stage+' failed after '+str(attempt+1)+' attempt(s), '+failureReason(command)+': '+str(command))
+    return command
+
+async def gatherCommands(commands):
+    return await asyncio.gather(*[runAsync(command) for command in commands])
+
+# Run commands concurrently (within the resource limits) and wait for all of them. Returns whether each one
+# succeeded; with check=True a CommandError is raised instead if any failed. Safe to call from any thread.
+def runCommands(commands, check=False):
+    asyncio.run_coroutine_threadsafe(gatherCommands(commands), eventLoop()).result()
+    failed = [command for command in commands if not command.succeeded]
+    if check and failed:
+        raise CommandError(', '.join(command.stage+' ('+failureReason(command)+')' for command in failed))
+    return [command.succeeded for command in commands]
+
+def runCommand(args, stage, resource=None, cores=1, outputs=None, retries=None, check=False, **labels):
+    return runCommands([Command(args, stage, resource, cores, outputs, retries, **labels)], check)[0]
+
+# Like runCommand, and also returns the decoded stdout of the last attempt
+def runCommandOutput(args, stage, resource=None, cores=1, outputs=None, retries=None, check=False, **labels):
+    command = Command(args, stage, resource, cores, outputs, retries, capture_output=True, **labels)
+    runCommands([command], check)
+    return command.succeeded, command.output
+
+# Start an interactive program (e.g. mrview) and return straight away, leaving it open after the script ends
+def startDetached(args, stage, **labels):
+    args = [str(arg) for arg in args]
+    try:
+        subprocess.Popen(args, start_new_session=True)
+    except OSError as error:
+        logging.error('Could not start '+args[0]+': '+str(error))
+        return False
+    addEvent(stage, 'command', time.time(), 0, 0, 0, labels=labels, command=' '.join(args))
+    return True
@@ -0,0 +1,166 @@
+"""
+PURPOSE:
+ - a compact file format (.cstr) for intermediate tracts of the atlas build that only the pipeline's own python code
+ reads (validated/ and downsample/ in script 2), instead of full float32 .trk copies.
+
+USAGE:
+    packTrk('downsample/x.trk', 'downsample/x.cstr', remove=True)     # or: python compact_streamlines.py pack in.trk out.cstr --remove
+    streamlines = loadCompact('downsample/x.cstr')                      # ArraySequence in rasmm, like loadStreamlines()
+    tract = CompactStreamlines('downsample/x.cstr'); tract[10:20]      # random access, only the blocks needed are read
+    exportTrk('downsample/x.cstr', 'x.trk')                            # or: python compact_streamlines.py export in.cstr out.trk
+
+Layout: a JSON header (quantum, counts, the .trk header of the source so exports keep their grid), the number of points
+of every streamline (int32), then the points in blocks of block_size streamlines. Coordinates are rounded to a grid of
+quantum mm (1/64 mm, far below any voxel size) and stored as int32 differences between consecutive points, which are
+small and compress well; each block is zlib-compressed on its own. The file is memory-mapped, so reading a few
+streamlines only decompresses the blocks holding them.
+"""
+
+import os, sys, json, zlib, struct, logging
+import numpy as np
+import nibabel as nib
+from nibabel.streamlines import ArraySequence, Field
+from streamline_io import iterStreamlineChunks, saveStreamlineChunks
+
+magic = b'CSTR\x01\n'
+quantum_mm = 1/64
+block_size = 4096
+
+def encodeBlock(points):
+    quantized = np.round(np.asarray(points, dtype=np.float64)/quantum_mm).astype(np.int64)
+    deltas = np.diff(quantized, axis=0, prepend=np.zeros((1, 3), dtype=np.int64))
+    return zlib.compress(deltas.astype(np.int32).tobytes(), 6)
+
+def decodeBlock(data, n_points):
+    deltas = np.frombuffer(zlib.decompress(data), dtype=np.int32, count=n_points*3).reshape(n_points, 3)
+    return (np.cumsum(deltas, axis=0, dtype=np.int64)*quantum_mm).astype(np.float32)
+
+# .trk header fields as plain lists, so they fit in the JSON header
+def jsonHeader(header):
+    if not header:
+        return None
+    return {'voxel_to_rasmm': np.asarray(header[Field.VOXEL_TO_RASMM]).tolist(),
+            'dimensions': [int(size) for size in header[Field.DIMENSIONS]],
+            'voxel_sizes': [float(size) for size in header[Field.VOXEL_SIZES]],
+            'voxel_order': header[Field.VOXEL_ORDER].decode('utf-8') if isinstance(header[Field.VOXEL_ORDER], bytes) else str(header[Field.VOXEL_ORDER])}
+
+# Write chunks of streamlines (rasmm) to path. header is the .trk header to restore on export (optional).
+def saveCompactChunks(chunks, path, header=None):
+    lengths = list()
+    blocks = list()
+    pending_lengths = np.zeros(0, dtype=np.int64)
+    pending_points = np.zeros((0, 3), dtype=np.float32)
+    for chunk in chunks:
+        pending_lengths = np.concatenate([pending_lengths, np.asarray(chunk._lengths, dtype=np.int64)])
+        pending_points = np.concatenate([pending_points, np.asarray(chunk.get_data(), dtype=np.float32).reshape(-1, 3)])
+        # every full block of block_size streamlines is encoded straight away
+        while len(pending_lengths) >= block_size:
+            n_points = int(pending_lengths[:block_size].sum())
+            lengths.append(pending_lengths[:block_size].astype(np.int32))
+            blocks.append(encodeBlock(pending_points[:n_points]))
+            pending_lengths, pending_points = pending_lengths[block_size:], pending_points[n_points:]
+    if len(pending_lengths):
+        lengths.append(pending_lengths.astype(np.int32))
+        blocks.append(encodeBlock(pending_points))
+
+    lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int32)
+    block_offsets = np.concatenate([[0], np.cumsum([len(block) for block in blocks])]).astype(np.int64)
+    info = json.dumps({'quantum_mm': quantum_mm, 'block_size': block_size, 'n_streamlines': int(len(lengths)),
+                       'n_points': int(lengths.sum()), 'n_blocks': len(blocks), 'trk_header': jsonHeader(header)}).encode('utf-8')
+    # write under a temporary name, so an interrupted write never leaves a file that looks complete
+    with open(path+'.tmp', 'wb') as file:
+        file.write(magic)
+        file.write(struct.pack('<I', len(info)))
+        file.write(info)
+        file.write(lengths.tobytes())
+        file.write(block_offsets.tobytes())
+        for block in blocks:
+            file.write(block)
+    os.replace(path+'.tmp', path)
+
+def saveCompact(streamlines, path, header=None):
+    saveCompactChunks([streamlines], path, header)
+
+# CLASS: a .cstr file opened for reading. Indexing with an int returns one streamline (points array), with a
+# slice or an array of indices an ArraySequence. Only the blocks holding the requested streamlines are decompressed.
+class CompactStreamlines:
+    def __init__(self, path):
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        if bytes(self.data[:len(magic)]) != magic:
+            raise ValueError(path+' is not a compact streamline file')
+        info_size = struct.unpack('<I', bytes(self.data[len(magic):len(magic)+4]))[0]
+        position = len(magic)+4
+        self.info = json.loads(bytes(self.data[position:position+info_size]).decode('utf-8'))
+        position += info_size
+        n_streamlines, n_blocks = self.info['n_streamlines'], self.info['n_blocks']
+        self.lengths = np.frombuffer(self.data, dtype=np.int32, count=n_streamlines, offset=position).astype(np.int64)
+        position += 4*n_streamlines
+        self.block_offsets = np.frombuffer(self.data, dtype=np.int64, count=n_blocks+1, offset=position) + position + 8*(n_blocks+1)
+        self.block_size = self.info['block_size']
+        self.offsets = np.cumsum(self.lengths) - self.lengths # first point of each streamline
+        self.cached_block = (None, None)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def block(self, block_id):
+        if self.cached_block[0] != block_id:
+            first = block_id*self.block_size
+            last = min(first+self.block_size, len(self.lengths))
+            n_points = int(self.lengths[first:last].sum())
+            compressed = bytes(self.data[self.block_offsets[block_id]:self.block_offsets[block_id+1]])
+            self.cached_block = (block_id, decodeBlock(compressed, n_points))
+        return self.cached_block[1]
+
+    def streamline(self, index):
+        block_id = index // self.block_size
+        start = self.offsets[index] - self.offsets[block_id*self.block_size]
+        return self.block(block_id)[start:start+self.lengths[index]]
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.streamline(int(key) % len(self))
+        indices = np.arange(len(self))[key]
+        return ArraySequence([self.streamline(index) for index in indices])
+
+    # All streamlines, block by block (ArraySequence chunks of block_size streamlines)
+    def iterBlocks(self):
+        for block_id in range(self.info['n_blocks']):
+            first = block_id*self.block_size
+            lengths = self.lengths[first:first+self.block_size]
+            yield ArraySequence(np.split(self.block(block_id), np.cumsum(lengths)[:-1]))
+
+    def trkHeader(self):
+        header = self.info['trk_header']
+        if header is None:
+            return None
+        return {Field.VOXEL_TO_RASMM: np.asarray(header['voxel_to_rasmm']), Field.DIMENSIONS: tuple(header['dimensions']),
+                Field.VOXEL_SIZES: tuple(header['voxel_sizes']), Field.VOXEL_ORDER: header['voxel_order']}
+
+def loadCompact(path):
+    streamlines = ArraySequence()
+    for chunk in CompactStreamlines(path).iterBlocks():
+        streamlines.extend(chunk)
+    return streamlines
+
+# .trk/.tck to .cstr, streamed chunk by chunk. The .trk header is kept for exportTrk().
+def packTrk(in_path, out_path, remove=False):
+    header = nib.streamlines.load(in_path, lazy_load=True).header if in_path.endswith('.trk') else None
+    saveCompactChunks(iterStreamlineChunks(in_path), out_path, header)
+    if remove:
+        os.remove(in_path)
+
+# .cstr to .trk (or .tck), with the grid of the tract it was packed from, or of a reference image
+def exportTrk(in_path, out_path, reference=None):
+    compact = CompactStreamlines(in_path)
+    saveStreamlineChunks(compact.iterBlocks, out_path, reference, None if reference else compact.trkHeader())
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+    if len(sys.argv) in [4, 5] and sys.argv[1] == 'pack':
+        packTrk(sys.argv[2], sys.argv[3], '--remove' in sys.argv[4:])
+    elif len(sys.argv) in [4, 5] and sys.argv[1] == 'export':
+        exportTrk(sys.argv[2], sys.argv[3], sys.argv[4] if len(sys.argv) == 5 else None)
+    else:
+        logging.error('usage: python compact_streamlines.py pack <in.trk> <out.cstr> [--remove] | export <in.cstr> <out.trk> [reference]')
@@ -0,0 +1,188 @@
+"""
+PURPOSE:
+ - run the per-subject work of scripts 3 and 4 as a dependency DAG of stages (registration -> RecoX -> mask ->
+ metrics), either as SLURM job arrays on the cluster or on this machine, through the same interface.
+
+USAGE:
+    stages = [Stage('register', cores=4, memory_gb=8, hours=2),
+              Stage('recox', after=['register'], cores=8, memory_gb=32, hours=8)]
+    backend = makeBackend('slurm', job_dir)      # or 'local'
+    backend.run(stages, subject_folders, taskCommand, gather_commands=[[...]])
+    -> taskCommand(stage_name, subject_folder) gives the argument list that runs one stage for one subject
+       (the scripts' own 'job' modes, e.g. python 3_recobundlesX_tractography_v6.py job recox <subject> <dir_RecoX>)
+
+    python job_backend.py task <job_dir>/recox.tasks 12    # what each array task runs (one line of the tasks file)
+
+Every stage becomes one job array with one task per subject, task i of every array being subject i. SlurmBackend
+submits the arrays with sbatch, each with the stage's cores, memory and time, and chains them with
+--dependency=aftercorr, so subject i's RecoX starts as soon as subject i's registration succeeded and a failed task
+cancels that subject's later tasks only. The gather commands (e.g. writing the tractometry table) run as one last
+job once every task has ended. SlurmBackend.run() returns after submitting; the logs of each task are in
+<job_dir>/logs/.
+
+LocalBackend runs the same tasks files on this machine: each subject's stages run in dependency order, subjects side
+by side, and every task holds its stage's cores of the command executor's cpu slots (command_executor.py), so the
+machine is shared the way the cluster shares nodes. It returns when the gather commands have finished.
+Each task runs with RECOX_CPU_SLOTS set to its stage's cores, so the commands inside it stay within its request.
+"""
+
+import os, sys, json, shlex, logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from command_executor import runCommand, runCommandOutput, CommandError, transient_retries
+from stage_graph import stageOrder
+
+# resources requested per stage (cores, memory in GB, wall time in hours)
+stage_resources = {'register': {'cores': 4, 'memory_gb': 8, 'hours': 2},
+                   'recox': {'cores': 8, 'memory_gb': 32, 'hours': 8},
+                   'mask': {'cores': 1, 'memory_gb': 8, 'hours': 1},
+                   'metrics': {'cores': 2, 'memory_gb': 8, 'hours': 1},
+                   'gather': {'cores': 1, 'memory_gb': 4, 'hours': 1}}
+
+# CLASS: one stage of the per-subject DAG, run for every subject after the stages named in after
+class Stage:
+    def __init__(self, name, after=None, cores=None, memory_gb=None, hours=None):
+        defaults = stage_resources.get(name, stage_resources['gather'])
+        self.name = name
+        self.after = list(after or list())
+        self.cores = cores or defaults['cores']
+        self.memory_gb = memory_gb or defaults['memory_gb']
+        self.hours = hours or defaults['hours']
+
+# Write <job_dir>/<stage>.tasks for every stage: line i is subject i's task (its arguments and cores).
+# Returns the path of each stage's tasks file.
+def writeTaskFiles(job_dir, stages, subjects, task_command):
+    os.makedirs(job_dir+'/logs', exist_ok = True)
+    tasks_files = dict()
+    for stage in stages:
+        tasks_files[stage.name] = os.path.join(job_dir, stage.name+'.tasks')
+        with open(tasks_files[stage.name], 'w') as file:
+            for subject in subjects:
+                args = [str(arg) for arg in task_command(stage.name, subject)]
+                file.write(json.dumps({'subject': subject, 'cores': stage.cores, 'args': args})+'\n')
+    return tasks_files
+
+def taskArgs(tasks_file, index):
+    return [sys.executable, os.path.abspath(__file__), 'task', tasks_file, str(index)]
+
+# CLASS: runs the DAG on this machine, subjects side by side within the executor's cpu slots
+class LocalBackend:
+    def __init__(self, job_dir, max_subjects=None):
+        self.job_dir = os.path.abspath(job_dir)
+        self.max_subjects = max_subjects or os.cpu_count() or 1
+
+    # One subject's stages in dependency order; a stage whose dependencies failed is skipped.
+    # Returns the names of the stages that succeeded.
+    def runSubject(self, ordered, tasks_files, index, subject):
+        succeeded = set()
+        for stage in ordered:
+            if not all(name in succeeded for name in stage.after):
+                logging.warning('Skipping '+stage.name+' for '+subject+', an earlier stage failed.')
+                continue
+            # the task's own commands retry themselves where that can help, the task is not run again
+            if runCommand(taskArgs(tasks_files[stage.name], index), 'job '+stage.name, cores=stage.cores, retries=0,
+                          subject=os.path.basename(subject.rstrip('/'))):
+                succeeded.add(stage.name)
+        return succeeded
+
+    def run(self, stages, subjects, task_command, gather_commands=None):
+        ordered = stageOrder(stages)
+        tasks_files = writeTaskFiles(self.job_dir, ordered, subjects, task_command)
+        logging.info('Local job backend: '+str(len(subjects))+' subjects x '+str(len(ordered))+' stages ('+
+                     ' -> '.join(stage.name for stage in ordered)+')')
+
+        n_done = 0
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_subjects, len(subjects)))) as pool:
+            futures = {pool.submit(self.runSubject, ordered, tasks_files, index, subject): subject
+                       for index, subject in enumerate(subjects)}
+            for future in as_completed(futures):
+                n_done += 1
+                succeeded = future.result()
+                failed = [stage.name for stage in ordered if stage.name not in succeeded]
+                logging.info('['+str(n_done)+'/'+str(len(subjects))+'] '+futures[future]+
+                             (': failed or skipped '+str(failed) if failed else ': all stages done'))
+
+        for command in gather_commands or list():
+            runCommand(command, 'job gather', retries=0)
+
+# CLASS: submits the DAG to SLURM as one job array per stage, chained per task with aftercorr
+class SlurmBackend:
+    def __init__(self, job_dir, partition=None, account=None, max_parallel=None):
+        self.job_dir = os.path.abspath(job_dir)
+        self.partition = partition
+        self.account = account
+        self.max_parallel = max_parallel # tasks of one array running at once (sbatch --array=...%N)
+
+    def batchScript(self, name, resources, lines, array_size=None, dependency=None):
+        options = ['--job-name=recox_'+name,
+                   '--cpus-per-task='+str(resources.cores), '--mem='+str(resources.memory_gb)+'G',
+                   '--time='+str(int(round(resources.hours*60))), # minutes
+                   '--output='+self.job_dir+'/logs/'+name+('_%a' if array_size else '')+'.log']
+        if array_size:
+            options.append('--array=0-'+str(array_size-1)+('%'+str(self.max_parallel) if self.max_parallel else ''))
+        if dependency:
+            options += ['--dependency='+dependency, '--kill-on-invalid-dep=yes']
+        if self.partition:
+            options.append('--partition='+self.partition)
+        if self.account:
+            options.append('--account='+self.account)
+
+        script = os.path.join(self.job_dir, name+'.sbatch')
+        with open(script, 'w') as file:
+            file.write('#!/bin/bash\n'+''.join('#SBATCH '+option+'\n' for option in options)+'\n'+'\n'.join(lines)+'\n')
+        return script
+
+    def submit(self, script):
+        # a busy scheduler refuses submissions now and then
+        ok, output = runCommandOutput(['sbatch', '--parsable', script], 'sbatch', retries=transient_retries)
+        if not ok:
+            raise CommandError('sbatch could not submit '+script)
+        return output.strip().split(';')[0] # --parsable prints <job id>[;<cluster>]
+
+    def run(self, stages, subjects, task_command, gather_commands=None):
+        ordered = stageOrder(stages)
+        tasks_files = writeTaskFiles(self.job_dir, ordered, subjects, task_command)
+
+        job_ids = dict()
+        for stage in ordered:
+            command = taskArgs(tasks_files[stage.name], 0)[:-1] + ['$SLURM_ARRAY_TASK_ID']
+            dependency = 'aftercorr:'+':'.join(job_ids[name] for name in stage.after) if stage.after else None
+            script = self.batchScript(stage.name, stage, [' '.join(shlex.quote(arg) for arg in command[:-1])+' '+command[-1]],
+                                      len(subjects), dependency)
+            job_ids[stage.name] = self.submit(script)
+            logging.info('Submitted '+stage.name+' for '+str(len(subjects))+' subjects as job array '+job_ids[stage.name]+
+                         (' ('+dependency+')' if dependency else ''))
+
+        if gather_commands:
+            # afterany: the table is written from whatever finished, failed subjects just have no new rows
+            lines = [' '.join(shlex.quote(str(arg)) for arg in command) for command in gather_commands]
+            script = self.batchScript('gather', Stage('gather'), lines, dependency='afterany:'+':'.join(job_ids.values()))
+            job_ids['gather'] = self.submit(script)
+            logging.info('Submitted the gather step as job '+job_ids['gather']+', it runs when every array has ended.')
+        logging.info('Task logs will be in '+self.job_dir+'/logs/ (squeue -u $USER to follow the jobs)')
+        return job_ids
+
+# Backend by name, as set in the scripts' job_backend variable
+def makeBackend(name, job_dir):
+    if name == 'local':
+        return LocalBackend(job_dir)
+    if name == 'slurm':
+        return SlurmBackend(job_dir, os.environ.get('RECOX_SLURM_PARTITION'), os.environ.get('RECOX_SLURM_ACCOUNT'),
+                            int(os.environ['RECOX_SLURM_MAX_PARALLEL']) if os.environ.get('RECOX_SLURM_MAX_PARALLEL') else None)
+    raise ValueError('Unknown job backend '+str(name)+" (expected 'local' or 'slurm')")
+
+# Run line index of a tasks file, replacing this process, with the commands inside it limited to the task's cores
+def runTask(tasks_file, index):
+    with open(tasks_file) as file:
+        task = json.loads(file.read().splitlines()[index])
+    os.environ['RECOX_CPU_SLOTS'] = str(task['cores'])
+    logging.info('Task '+str(index)+' of '+tasks_file+' ('+task['subject']+'): '+' '.join(task['args']))
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execvp(task['args'][0], task['args'])
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+    if len(sys.argv) == 4 and sys.argv[1] == 'task':
+        runTask(sys.argv[2], int(sys.argv[3]))
+    else:
+        logging.error('usage: python job_backend.py task <tasks file> <index>')
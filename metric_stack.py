@@ -0,0 +1,85 @@
+"""
+PURPOSE:
+ - decompress a subject's measure maps (fa, md, ad, rd, ficvf, odi) once into one uncompressed, memory-mapped array,
+ so every tractometry stage (whole-tract metrics, profiles) reads voxels straight from it instead of decompressing
+ each .nii.gz again for every stage and every run.
+
+USAGE:
+    stack = metricStack(dir_data+'/3_Tractometry/metric_stacks/', group, tag, {'fa': fa_path, 'odi': odi_path, ...})
+    if stack.has('fa'):
+        fa = stack.volume('fa')        # read-only memmap view (x, y, z), nothing is copied until voxels are read
+    stack.affine                       # voxel to rasmm affine of the maps
+
+A stack is <group>_<tag>.npy (measures x X x Y x Z, float32 or float64 if a map needs it) with <group>_<tag>.json
+next to it (measures, affine, fingerprint). The fingerprint covers the size and modification time of every source
+map, including the ones that do not exist yet, so the stack is rebuilt when a map changes or a NODDI map appears.
+The json is written last: a stack without it is never used. Maps that are missing or not on the grid of the first
+map are left out and reported.
+"""
+
+import os, json, logging
+import numpy as np
+import nibabel as nib
+from result_store import inputFingerprint
+
+# CLASS: one subject's stack, opened read-only
+class MetricStack:
+    def __init__(self, stack_path):
+        with open(stack_path[:-4]+'.json') as file:
+            info = json.load(file)
+        self.measures = info['measures']
+        self.affine = np.asarray(info['affine'])
+        self.fingerprint = info['fingerprint']
+        self.data = np.load(stack_path, mmap_mode='r') if self.measures else None
+
+    def has(self, measure):
+        return measure in self.measures
+
+    def volume(self, measure):
+        return self.data[self.measures.index(measure)]
+
+def buildStack(stack_path, measure_paths, fingerprint):
+    measures, images = list(), list()
+    for measure, path in measure_paths.items():
+        if not os.path.isfile(path):
+            continue
+        image = nib.load(path)
+        # the stack has one affine, so a map on another grid (same shape, different voxel size or origin) cannot join it
+        if images and (image.shape[:3] != images[0].shape[:3] or not np.allclose(image.affine, images[0].affine, atol=1e-4)):
+            logging.error(measure+' map '+path+' is not on the grid of the '+measures[0]+' map, left out of the metric stack')
+            continue
+        measures.append(measure)
+        images.append(image)
+
+    if images:
+        dtype = np.result_type(np.float32, *[image.get_data_dtype() for image in images])
+        dtype = np.float64 if dtype == np.float64 else np.float32
+        # written under a temporary name and moved into place, so a reader never maps half a stack
+        stack = np.lib.format.open_memmap(stack_path+'.tmp', mode='w+', dtype=dtype, shape=(len(images),)+images[0].shape[:3])
+        for position, image in enumerate(images):
+            stack[position] = np.asanyarray(image.dataobj).reshape(image.shape[:3])
+        stack.flush()
+        del stack
+        os.replace(stack_path+'.tmp', stack_path)
+    with open(stack_path[:-4]+'.json', 'w') as file:
+        json.dump({'measures': measures, 'affine': (images[0].affine if images else np.eye(4)).tolist(),
+                   'fingerprint': fingerprint, 'sources': {measure: measure_paths[measure] for measure in measures}}, file, indent=1)
+
+# The subject's stack, (re)built first if it is missing or any source map changed
+def metricStack(dir_stacks, group, tag, measure_paths):
+    os.makedirs(dir_stacks, exist_ok = True)
+    stack_path = os.path.join(dir_stacks, group+'_'+tag+'.npy')
+    fingerprint = inputFingerprint([measure_paths[measure] for measure in sorted(measure_paths)], {'measures': sorted(measure_paths)})
+    try:
+        stack = MetricStack(stack_path)
+        if stack.fingerprint == fingerprint:
+            return stack
+    except (OSError, ValueError, KeyError):
+        pass
+
+    logging.info('Building the metric stack of '+group+' '+tag)
+    # the old json goes first, so an interrupted rebuild is never taken for a finished one
+    if os.path.isfile(stack_path[:-4]+'.json'):
+        os.remove(stack_path[:-4]+'.json')
+    buildStack(stack_path, measure_paths, fingerprint)
+    return MetricStack(stack_path)
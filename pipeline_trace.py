@@ -0,0 +1,120 @@
+"""
+PURPOSE:
+ - time every external command (ANTs, RecoX, scilpy, mrtrix) and every python stage of the pipeline, so we can
+ see which tools dominate wall time and which subjects are outliers.
+
+USAGE:
+    exit_code, output = traceCommand(['mrstats', ...], 'mrstats', True, {'subject': tag, 'tract': tract})
+    with traceStage('voxelize', subject=tag):
+        ...
+    writeTrace(directory, 'tractometry')   # at the end of main()
+
+Every command or stage becomes one event with its wall time, CPU time, peak RSS, exit code and labels
+(subject, tract, ...). writeTrace() saves the events of the run as trace_<name>_<date>_<time>.json in Chrome
+trace format (open it in chrome://tracing or https://ui.perfetto.dev) and logs the slowest stages and subjects.
+The scripts run their commands through command_executor.py, which calls traceCommand() for every attempt.
+"""
+
+import os, sys, json, time, logging, resource, threading, subprocess
+from contextlib import contextmanager
+
+events = list()
+events_lock = threading.Lock()
+run_start = time.time()
+
+# ru_maxrss is in kilobytes on linux and in bytes on macOS
+def rssMegabytes(maxrss):
+    return round(maxrss/(1024*1024) if sys.platform == 'darwin' else maxrss/1024, 1)
+
+def addEvent(stage, category, start, wall, cpu, peak_rss_mb, exit_code=None, labels=None, command=None):
+    args = {key: value for key, value in (labels or dict()).items() if value is not None}
+    args.update({'wall_s': round(wall, 3), 'cpu_s': round(cpu, 3), 'peak_rss_mb': peak_rss_mb})
+    if exit_code is not None:
+        args['exit_code'] = exit_code
+    if command is not None:
+        args['command'] = command
+    # absolute timestamps, so events recorded in worker processes line up with the main process
+    event = {'name': stage, 'cat': category, 'ph': 'X', 'ts': int(start*1e6), 'dur': int(wall*1e6),
+             'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args}
+    with events_lock:
+        events.append(event)
+    if exit_code:
+        logging.error(stage+' exited with code '+str(exit_code)+': '+str(command))
+
+# Run one command (a shell string, or an argument list run without a shell) and record it. wait4 gives the
+# CPU time and peak RSS of that command alone (with everything it waited for), even with other commands
+# running in other threads. Returns (exit code, stdout or None); a program that cannot be started gets 127 like in a shell.
+def traceCommand(command, stage, capture_output, labels):
+    start = time.time()
+    command_text = command if isinstance(command, str) else ' '.join(command)
+    try:
+        process = subprocess.Popen(command, shell=isinstance(command, str), stdout=subprocess.PIPE if capture_output else None)
+    except OSError as error:
+        addEvent(stage, 'command', start, time.time() - start, 0, 0, 127, labels, command_text+' ('+str(error)+')')
+        return 127, '' if capture_output else None
+    output = process.stdout.read().decode('utf-8') if capture_output else None
+    pid, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if capture_output:
+        process.stdout.close()
+    addEvent(stage, 'command', start, time.time() - start, usage.ru_utime + usage.ru_stime, rssMegabytes(usage.ru_maxrss),
+             process.returncode, labels, command_text)
+    return process.returncode, output
+
+# Record a python stage. CPU time is for the calling thread; peak RSS is the peak of the whole process so far.
+@contextmanager
+def traceStage(stage, **labels):
+    start = time.time()
+    cpu_start = time.thread_time()
+    try:
+        yield
+    finally:
+        addEvent(stage, 'python', start, time.time() - start, time.thread_time() - cpu_start,
+                 rssMegabytes(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss), labels=labels)
+
+# Events recorded in a worker process (returned from eventsSince() there) are added to this run
+def addEvents(worker_events):
+    with events_lock:
+        events.extend(worker_events)
+
+def eventsSince(n_events):
+    with events_lock:
+        return list(events[n_events:])
+
+# Log the slowest single events, the total wall time per stage and the slowest subjects
+def summarizeTrace(n_slowest=10):
+    with events_lock:
+        run_events = list(events)
+    if not run_events:
+        return
+
+    logging.info('Slowest stages this run:')
+    for event in sorted(run_events, key=lambda event: -event['dur'])[:n_slowest]:
+        labels = {key: value for key, value in event['args'].items() if key in ['subject','tract','group']}
+        logging.info('  {:>9.1f} s  {} {}'.format(event['dur']/1e6, event['name'], labels))
+
+    totals = dict()
+    subjects = dict()
+    for event in run_events:
+        totals[event['name']] = totals.get(event['name'], 0) + event['dur']/1e6
+        if 'subject' in event['args']:
+            subjects[event['args']['subject']] = subjects.get(event['args']['subject'], 0) + event['dur']/1e6
+    logging.info('Total wall time per stage:')
+    for stage, seconds in sorted(totals.items(), key=lambda item: -item[1]):
+        logging.info('  {:>9.1f} s  {}'.format(seconds, stage))
+    if subjects:
+        logging.info('Slowest subjects:')
+        for subject, seconds in sorted(subjects.items(), key=lambda item: -item[1])[:n_slowest]:
+            logging.info('  {:>9.1f} s  {}'.format(seconds, subject))
+
+# Save this run's events as a Chrome trace in directory, log the summary, and return the trace path
+def writeTrace(directory, name):
+    os.makedirs(directory, exist_ok = True)
+    trace_path = os.path.join(directory, 'trace_'+name+'_'+time.strftime('%Y-%m-%d_%H%M%S', time.localtime(run_start))+'.json')
+    with events_lock:
+        trace = {'traceEvents': list(events), 'displayTimeUnit': 'ms'}
+    with open(trace_path, 'w') as file:
+        json.dump(trace, file)
+    summarizeTrace()
+    logging.info('Trace saved at: '+trace_path)
+    return trace_path
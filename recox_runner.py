@@ -0,0 +1,50 @@
+"""
+PURPOSE:
+ - run scil_recognize_multi_bundles.py (RecobundlesX) inside this python process instead of as its own script, so the
+ pipeline can hook into it: reuse the tractogram clustering of earlier runs (clustering_cache.py) and keep the votes
+ of every streamline (recox_votes.py).
+
+USAGE:
+    python recox_runner.py [--cache_clustering] [--votes_dir <folder>] <scil_recognize_multi_bundles.py> <its arguments...>
+
+The RecoX arguments are passed on untouched; --minimal_vote is read from them for the vote recorder.
+executeRecoX() in script 3 builds this command when reuse_clustering or record_votes is True.
+"""
+
+import sys, runpy, logging
+from clustering_cache import installClusteringCache, logClusteringCache
+from recox_votes import installVoteRecorder
+
+# --minimal_vote of the RecoX arguments (scilpy's default if not given)
+def minimalVote(arguments):
+    if '--minimal_vote' in arguments:
+        return float(arguments[arguments.index('--minimal_vote')+1])
+    return 0.5
+
+def runRecoX(recox_script, arguments, cache_clustering=False, votes_dir=None):
+    if cache_clustering:
+        installClusteringCache()
+    if votes_dir:
+        installVoteRecorder(votes_dir, minimalVote(arguments))
+
+    sys.argv = [recox_script] + arguments
+    try:
+        runpy.run_path(recox_script, run_name='__main__')
+    finally:
+        if cache_clustering:
+            logClusteringCache()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+    arguments = sys.argv[1:]
+    cache_clustering = '--cache_clustering' in arguments[:3]
+    if cache_clustering:
+        arguments.remove('--cache_clustering')
+    votes_dir = None
+    if arguments[:1] == ['--votes_dir']:
+        votes_dir = arguments[1]
+        arguments = arguments[2:]
+    if not arguments:
+        logging.error('usage: python recox_runner.py [--cache_clustering] [--votes_dir <folder>] <recox script> <arguments...>')
+    else:
+        runRecoX(arguments[0], arguments[1:], cache_clustering, votes_dir)
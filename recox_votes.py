@@ -0,0 +1,198 @@
+"""
+PURPOSE:
+ - keep the vote every RecoX candidate streamline got for every bundle, so the bundles for another minimal_vote can be
+ written in seconds, and the streamline counts of a range of thresholds compared, without running RecoX again.
+
+USAGE:
+    python recox_runner.py --votes_dir <subject>/2_recox_votes/ <scil_recognize_multi_bundles.py> <its arguments...>
+    -> runs RecoX with installVoteRecorder() in place (executeRecoX() in script 3 does this when record_votes is True)
+       The recorder reads the arguments of VotingScheme._save_recognized_bundles by name, as scilpy 2.x names them
+       (supported_arguments), and raises before RecoX starts with any other scilpy.
+
+    python recox_votes.py materialize <subject>/2_recox_votes/ 0.4 [out_dir]
+    -> writes one .trk per bundle with the streamlines that reached a minimal vote of 0.4
+       (default out_dir: <subject>/2_recox_votes/minimal_vote_0.40/)
+
+    python recox_votes.py report <dir_RecoX> [0.1 0.2 ...]
+    -> recox_vote_report_<date>.csv in dir_RecoX: streamlines per subject, bundle and threshold
+
+When RecoX saves its bundles, the recorder writes to the votes folder:
+    recox_votes.npz         for each bundle: the candidate streamlines with at least one vote, their number of votes,
+                            and the number of RecoX runs that voted on it (scilpy's bundle_count: one per atlas model)
+    recox_candidates.trk    every streamline with a vote for any bundle, in the order recox_votes.npz refers to
+A streamline is kept when its votes reach minimumVotes(runs, minimal_vote), the truncated minimum scilpy's
+VotingScheme computes; materializing applies the same truncation, so any threshold gives the bundles a rerun at
+that minimal_vote would give (the minimal_vote RecoX ran with gives the same bundles). The candidates are a small part
+of the tractogram, so materializing never reads the whole-brain tractogram.
+"""
+
+import os, sys, csv, glob, inspect, logging
+import numpy as np
+from datetime import date
+
+votes_name = 'recox_votes.npz'
+candidates_name = 'recox_candidates.trk'
+default_thresholds = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
+
+# The arguments of VotingScheme._save_recognized_bundles the recorder is written for (scilpy 2.x). The votes are
+# read by these names; installVoteRecorder() refuses any other signature.
+supported_arguments = ['input_tractograms_path', 'reference', 'bundle_names', 'bundles_wise_vote',
+                       'bundles_wise_score', 'minimum_vote', 'extension']
+
+# Votes a streamline needs out of runs to be kept at minimal_vote, as scilpy's VotingScheme.__call__ computes them:
+# the number of runs times minimal_vote, 1 if that is between 0 and 1, truncated to a whole vote (astype(np.uint8))
+def minimumVotes(runs, minimal_vote):
+    minimum = np.atleast_1d(np.asarray(runs, dtype=np.float64)*minimal_vote)
+    minimum[(minimum > 0) & (minimum < 1)] = 1
+    return np.floor(minimum)
+
+# The number of runs of each bundle, checked against the minimum votes scilpy computed from it. None (nothing can be
+# materialized correctly) if they were not recorded or do not give those minimum votes.
+def recordedRuns(voting_scheme, minimum_votes, minimal_vote):
+    runs = getattr(voting_scheme, 'recorded_bundle_count', None)
+    if runs is None or len(runs) != len(minimum_votes):
+        logging.error('The number of RecoX runs per bundle was not recorded, no votes saved.')
+        return None
+    mismatch = np.flatnonzero(minimumVotes(runs, minimal_vote) != minimum_votes)
+    if len(mismatch):
+        logging.error('The minimum votes of RecoX do not follow from its runs per bundle (bundles '+str(mismatch.tolist())+
+                      '), no votes saved.')
+        return None
+    return runs
+
+# tractograms and reference as RecoX got them; votes is the bundle x streamline vote matrix (dense or sparse)
+def saveVotes(votes_dir, tractograms, reference, bundle_names, votes, runs):
+    from scipy.sparse import csr_matrix
+    votes = csr_matrix(votes)
+    candidates = np.unique(votes.nonzero()[1])
+    position = np.full(votes.shape[1], -1, dtype=np.int64)
+    position[candidates] = np.arange(len(candidates))
+
+    indices, counts, n_votes = list(), list(), list()
+    for bundle_id in range(len(bundle_names)):
+        row = votes[bundle_id]
+        streamline_ids = np.asarray(row.nonzero()[1], dtype=np.int64)
+        indices.append(position[streamline_ids])
+        n_votes.append(np.asarray(row[:, streamline_ids].toarray()).ravel())
+        counts.append(len(streamline_ids))
+
+    # the candidates of each input tractogram in turn, reloaded one at a time as scilpy does to save its bundles
+    from dipy.io.streamline import load_tractogram, save_tractogram
+    from dipy.io.stateful_tractogram import StatefulTractogram
+    from nibabel.streamlines import ArraySequence
+    streamlines, first_sft, offset = ArraySequence(), None, 0
+    for tractogram in tractograms:
+        sft = load_tractogram(tractogram, reference, bbox_valid_check=False)
+        sft.to_rasmm()
+        streamlines.extend(sft.streamlines[candidates[(candidates >= offset) & (candidates < offset+len(sft))] - offset])
+        if first_sft is None:
+            first_sft = sft
+        offset += len(sft)
+
+    os.makedirs(votes_dir, exist_ok = True)
+    save_tractogram(StatefulTractogram.from_sft(streamlines, first_sft), os.path.join(votes_dir, candidates_name), bbox_valid_check=False)
+    np.savez_compressed(os.path.join(votes_dir, votes_name),
+                        bundle_names=np.asarray(bundle_names),
+                        indices=np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64),
+                        votes=np.concatenate(n_votes).astype(np.float32) if n_votes else np.zeros(0, dtype=np.float32),
+                        counts=np.asarray(counts, dtype=np.int64),
+                        runs=np.asarray(runs[:len(bundle_names)], dtype=np.int64), n_streamlines=votes.shape[1])
+    logging.info('Saved the votes of '+str(len(candidates))+' candidate streamlines for '+str(len(bundle_names))+' bundles in '+votes_dir)
+
+# Wrap VotingScheme._save_recognized_bundles so the votes are saved in votes_dir before RecoX keeps the
+# bundles at minimal_vote (the --minimal_vote RecoX was given). Call before running the RecoX script.
+def installVoteRecorder(votes_dir, minimal_vote):
+    from scilpy.segment.voting_scheme import VotingScheme
+    original = VotingScheme._save_recognized_bundles
+    original_load = getattr(VotingScheme, '_load_bundles_dictionary', None)
+    signature = inspect.signature(original)
+    if list(signature.parameters)[1:] != supported_arguments or original_load is None:
+        raise RuntimeError('Cannot record the RecoX votes with this scilpy: VotingScheme._save_recognized_bundles'+
+                           str(signature)+' is not the supported '+str(supported_arguments)+'. Set record_votes = False.')
+    # the number of runs of each bundle is the bundle_count the minimum vote is computed from
+    def loading(self, *args, **kwargs):
+        loaded = original_load(self, *args, **kwargs)
+        self.recorded_bundle_count = np.asarray(loaded[2], dtype=np.int64)
+        return loaded
+    def recording(self, *args, **kwargs):
+        # recording the votes must never stop RecoX from saving its bundles
+        try:
+            arguments = signature.bind(self, *args, **kwargs).arguments
+            bundle_names = [str(name) for name in arguments['bundle_names']]
+            minimum_votes = np.asarray(arguments['minimum_vote'], dtype=np.float64).ravel()
+            runs = recordedRuns(self, minimum_votes, getattr(self, 'minimal_vote_ratio', minimal_vote))
+            if runs is not None:
+                saveVotes(votes_dir, arguments['input_tractograms_path'], arguments['reference'], bundle_names,
+                          arguments['bundles_wise_vote'], runs)
+        except Exception:
+            logging.exception('Recording the RecoX votes failed, no votes saved.')
+        return original(self, *args, **kwargs)
+    VotingScheme._load_bundles_dictionary = loading
+    VotingScheme._save_recognized_bundles = recording
+
+def loadVotes(votes_path):
+    with np.load(votes_path) as votes:
+        return {key: votes[key] for key in votes.files}
+
+# Per bundle, the candidate indices that reach a minimal vote of threshold
+def bundlesAtThreshold(votes, threshold):
+    offsets = np.cumsum(votes['counts']) - votes['counts']
+    # votes files from before the number of runs was stored kept minimum/minimal_vote instead
+    runs = votes['runs'] if 'runs' in votes else np.round(votes['maximum_votes'])
+    bundles = dict()
+    for bundle_id, name in enumerate(votes['bundle_names']):
+        start, count = offsets[bundle_id], votes['counts'][bundle_id]
+        keep = votes['votes'][start:start+count] >= minimumVotes(runs[bundle_id], threshold)
+        bundles[os.path.splitext(os.path.basename(str(name)))[0]] = votes['indices'][start:start+count][keep]
+    return bundles
+
+def materializeBundles(votes_dir, threshold, out_dir=None):
+    import nibabel as nib
+    from streamline_io import loadStreamlines, saveStreamlineChunks
+    out_dir = out_dir or os.path.join(votes_dir, 'minimal_vote_'+'{:.2f}'.format(threshold))
+    os.makedirs(out_dir, exist_ok = True)
+    candidates_path = os.path.join(votes_dir, candidates_name)
+    candidates = loadStreamlines(candidates_path)
+    header = nib.streamlines.load(candidates_path, lazy_load=True).header
+    for bundle, indices in bundlesAtThreshold(loadVotes(os.path.join(votes_dir, votes_name)), threshold).items():
+        saveStreamlineChunks(lambda: [candidates[np.sort(indices)]], os.path.join(out_dir, bundle+'.trk'), header=header)
+        logging.info(bundle+': '+str(len(indices))+' streamlines at minimal vote '+str(threshold))
+    return out_dir
+
+# One row per subject, bundle and threshold with the number of streamlines RecoX would keep, for every subject
+# with a votes folder under dir_RecoX. Saved as recox_vote_report_<date>.csv in dir_RecoX.
+def voteReport(dir_RecoX, thresholds=None):
+    thresholds = thresholds or default_thresholds
+    rows = list()
+    for votes_path in sorted(glob.glob(os.path.join(dir_RecoX, '4_RecoX_outputs', '*', '*', '2_recox_votes', votes_name))):
+        subject_dir = os.path.dirname(os.path.dirname(votes_path))
+        group, tag = os.path.basename(os.path.dirname(subject_dir)), os.path.basename(subject_dir)
+        votes = loadVotes(votes_path)
+        for threshold in thresholds:
+            for bundle, indices in bundlesAtThreshold(votes, threshold).items():
+                rows.append({'group': group, 'subject': tag, 'bundle': bundle, 'minimal_vote': threshold, 'streamlines': len(indices)})
+    if not rows:
+        logging.info('No RecoX votes found under '+dir_RecoX)
+        return None
+
+    report_save = os.path.join(dir_RecoX, 'recox_vote_report_'+str(date.today())+'.csv')
+    with open(report_save, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=['group','subject','bundle','minimal_vote','streamlines'])
+        writer.writeheader()
+        writer.writerows(rows)
+    # the question that used to need a full rerun: at which threshold do bundles come back empty?
+    for threshold in thresholds:
+        empty = [row for row in rows if row['minimal_vote'] == threshold and row['streamlines'] == 0]
+        logging.info('minimal vote '+str(threshold)+': '+str(len(empty))+' empty bundles '+
+                     str(sorted(set(row['subject']+' '+row['bundle'] for row in empty))[:10]))
+    logging.info('Vote report saved at: '+report_save)
+    return report_save
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+    if len(sys.argv) in [4, 5] and sys.argv[1] == 'materialize':
+        materializeBundles(sys.argv[2], float(sys.argv[3]), sys.argv[4] if len(sys.argv) == 5 else None)
+    elif len(sys.argv) >= 3 and sys.argv[1] == 'report':
+        voteReport(sys.argv[2], [float(threshold) for threshold in sys.argv[3:]])
+    else:
+        logging.error('usage: python recox_votes.py materialize <votes dir> <minimal vote> [out dir] | report <dir_RecoX> [thresholds...]')
@@ -0,0 +1,125 @@
+"""
+PURPOSE:
+ - one cache of ANTs registrations shared by every script in the pipeline (antsRegistration() in script 3,
+ t1FlipRegister() and coregisterSmoothedTracts() in script 2, tractoflowRegistration() in script 4), so the
+ same fixed/moving pair is never registered twice.
+
+USAGE:
+    affine = cachedRegistration(fixed, moving, 'a', output_prefix)
+    -> output_prefix+'0GenericAffine.mat' (and the Warped / InverseWarped images) exist afterwards
+
+    python registration_cache.py clean 90
+    -> removes cache entries that have not been used for 90 days
+
+Entries are keyed by the sha256 of the fixed and moving images, the transform type and the ANTs script, and
+live in cache_directory (RECOX_REGISTRATION_CACHE, or ~/.recox_registration_cache). A hit copies the stored
+outputs to output_prefix instead of running ANTs again. Each entry keeps its own entry.json, so scripts running
+side by side never rewrite a shared index.
+
+A registration already at output_prefix (from before the cache, or with the cache cleaned) is adopted as the entry
+instead of being run again, the way build_manifest.isStale() adopts existing outputs. ANTs does not give the same
+affine twice, and the RecoX bundles and coregistered tracts on disk were made with the one there, so an existing
+affine is never overwritten: if it differs from the cached one, the existing transforms are kept and a warning logged.
+"""
+
+import os, sys, json, glob, shutil, filecmp, hashlib, logging, threading, time
+from build_manifest import hashFile
+from command_executor import runCommand
+
+cache_directory = os.environ.get('RECOX_REGISTRATION_CACHE', os.path.expanduser('~/.recox_registration_cache'))
+
+# the files antsRegistrationSyN(Quick).sh writes after its output prefix
+ants_outputs = ['0GenericAffine.mat', '1Warp.nii.gz', '1InverseWarp.nii.gz', 'Warped.nii.gz', 'InverseWarped.nii.gz']
+
+# file hashes for this process, cached against size and modification time (see hashFile)
+hash_cache = dict()
+hash_lock = threading.Lock()
+
+def registrationKey(fixed, moving, transform, script):
+    with hash_lock:
+        fixed_hash = hashFile(fixed, hash_cache)
+        moving_hash = hashFile(moving, hash_cache)
+    key = hashlib.sha256((fixed_hash+moving_hash+transform+os.path.basename(script)).encode('utf-8'))
+    return key.hexdigest()
+
+# Copy the outputs of a cached entry that are missing at output_prefix. Existing files are never replaced, and
+# nothing is copied next to an existing affine that differs from the cached one (it would not match its warps).
+# copy2 keeps the cached modification times, so restored files look unchanged to mtime checks downstream.
+def restoreEntry(entry_dir, output_prefix):
+    affine = output_prefix+'0GenericAffine.mat'
+    if os.path.isfile(affine) and not filecmp.cmp(entry_dir+'/out_0GenericAffine.mat', affine, shallow=True):
+        logging.warning(affine+' differs from the cached registration ('+os.path.basename(entry_dir)[:12]+'), keeping the existing transforms.')
+        return
+    for cached_file in sorted(glob.glob(entry_dir+'/out_*')):
+        output = output_prefix+os.path.basename(cached_file)[len('out_'):]
+        if not os.path.isfile(output):
+            shutil.copy2(cached_file, output)
+
+# Move a finished build folder into the cache as entry_dir, with its entry.json
+def saveEntry(build_dir, entry_dir, description):
+    with open(build_dir+'/entry.json', 'w') as file:
+        json.dump(dict(description, created=time.strftime('%Y-%m-%d %H:%M:%S')), file, indent=1)
+    try:
+        os.rename(build_dir, entry_dir)
+    except OSError:
+        # another process cached the same registration first, use theirs
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+# Make sure the registration of moving to fixed exists at output_prefix, running ANTs only if no cache entry
+# matches the image contents, transform type and script. Returns the path of the generic affine (.mat).
+# ANTs holds n_threads cpu slots of the command executor while it runs; labels (subject=..., group=...) are passed
+# on to the trace of the ANTs command.
+def cachedRegistration(fixed, moving, transform, output_prefix, script='antsRegistrationSyNQuick.sh', n_threads=4, **labels):
+    missing = [path for path in [fixed, moving] if not os.path.isfile(path)]
+    if missing:
+        logging.error('Cannot register '+moving+' to '+fixed+', missing: '+str(missing))
+        return output_prefix+'0GenericAffine.mat'
+
+    key = registrationKey(fixed, moving, transform, script)
+    entry_dir = os.path.join(cache_directory, key)
+    description = {'fixed': os.path.abspath(fixed), 'moving': os.path.abspath(moving), 'transform': transform,
+                   'script': os.path.basename(script)}
+    # build in a private folder and rename it into place, so an interrupted run never leaves a half entry
+    build_dir = entry_dir+'.tmp'+str(os.getpid())+'_'+str(threading.get_ident())
+
+    if os.path.isfile(entry_dir+'/entry.json'):
+        logging.info('Registration of '+moving+' to '+fixed+' found in the registration cache ('+key[:12]+').')
+    elif os.path.isfile(output_prefix+'0GenericAffine.mat'):
+        logging.info('Adopting the existing registration at '+output_prefix+' into the registration cache ('+key[:12]+').')
+        os.makedirs(build_dir, exist_ok = True)
+        for suffix in ants_outputs:
+            if os.path.isfile(output_prefix+suffix):
+                shutil.copy2(output_prefix+suffix, build_dir+'/out_'+suffix)
+        saveEntry(build_dir, entry_dir, dict(description, adopted=os.path.abspath(output_prefix)))
+    else:
+        logging.info('Registering '+moving+' to '+fixed+' ('+script+' -t '+transform+'), saving to the registration cache.')
+        os.makedirs(build_dir, exist_ok = True)
+        command = [script, '-d', '3', '-f', fixed, '-m', moving, '-o', build_dir+'/out_', '-t', transform, '-n', str(n_threads)]
+        runCommand(command, os.path.basename(script), cores=n_threads, outputs=[build_dir+'/out_0GenericAffine.mat'], **labels)
+        if not os.path.isfile(build_dir+'/out_0GenericAffine.mat'):
+            logging.error('Registration of '+moving+' to '+fixed+' failed, nothing was cached.')
+            shutil.rmtree(build_dir, ignore_errors=True)
+            return output_prefix+'0GenericAffine.mat'
+        saveEntry(build_dir, entry_dir, description)
+
+    os.utime(entry_dir) # the folder mtime marks when the entry was last used (see cleanRegistrationCache)
+    restoreEntry(entry_dir, output_prefix)
+    return output_prefix+'0GenericAffine.mat'
+
+# Remove cache entries (and leftover unfinished builds) that have not been used for max_age_days.
+def cleanRegistrationCache(max_age_days):
+    if not os.path.isdir(cache_directory):
+        return
+    cutoff = time.time() - max_age_days*24*60*60
+    for name in sorted(os.listdir(cache_directory)):
+        entry_dir = os.path.join(cache_directory, name)
+        if os.path.isdir(entry_dir) and os.path.getmtime(entry_dir) < cutoff:
+            logging.info('Removing unused registration cache entry '+name)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+    if len(sys.argv) == 3 and sys.argv[1] == 'clean':
+        cleanRegistrationCache(float(sys.argv[2]))
+    else:
+        logging.error('usage: python registration_cache.py clean <max age in days>')
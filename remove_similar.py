@@ -0,0 +1,212 @@
+"""
+PURPOSE:
+ - remove near-duplicate streamlines from a tract, or replace each group of similar streamlines by their average,
+ in this process: the job of scil_remove_similar_streamlines.py (same arguments and thresholds) without comparing
+ every pair of streamlines.
+
+USAGE:
+    kept = removeSimilarStreamlines(streamlines, 2)                   # ArraySequence in rasmm, like loadStreamlines()
+    averaged = removeSimilarStreamlines(streamlines, 1, average=True, min_cluster_size=2, processes=1)
+    python remove_similar.py in.trk 2 out.trk [--avg] [--min_cluster_size 5] [--clustering_thr 6] [--convergence 100] [--processes N]
+    -> in and out can be .trk, .tck or .cstr (compact_streamlines.py); a .trk output gets the grid of the input
+    python remove_similar.py --compare fixture.trk 2 [--avg] ...     # exit 0 when scilpy keeps the same streamlines
+
+As in scilpy, each pass splits the streamlines left with QuickBundlesX (thresholds 40, 30, 20 and clustering_thr mm,
+streamlines resampled to 20 points) and drops the clusters smaller than min_cluster_size. Within each cluster the
+streamlines are taken in the order QuickBundlesX lists them, and every later streamline closer than min_distance is
+removed: the MDF distance, the mean distance between the 20 resampled points in whichever direction is closer. With
+average, each kept streamline is replaced by the centroid of a QuickBundles cluster of itself and the streamlines it
+removed, in that order, as scilpy averages them, which gives 20-point streamlines. Passes are repeated on what is
+left, clustered again, until one removes fewer than convergence streamlines.
+
+QuickBundlesX visits the streamlines in random order: scilpy does not seed it, this module seeds it (cluster_seed).
+Where the result depends on that order (which of two overlapping groups keeps a streamline) two scilpy runs differ as
+much as scilpy and this module do, so --compare, and tests/test_remove_similar.py when scilpy is installed, check
+the two on a fixture whose groups of similar streamlines are far apart. Script 2 keeps scilpy as its default engine
+(similar_engine) until that comparison has passed with the scilpy that built the atlas.
+
+Why it is fast: streamlines are resampled once. The means of two streamlines' points are never further apart than
+their MDF, so only the streamlines whose point means lie within min_distance (found with a KD-tree) are compared. The
+clusters are processed side by side in worker processes.
+"""
+
+import os, sys, logging
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy.spatial import cKDTree
+from nibabel.streamlines import ArraySequence
+
+n_resample = 20
+cluster_thresholds = [40, 30, 20] # mm, followed by clustering_thr
+cluster_seed = 0 # QuickBundlesX visits streamlines in random order; a fixed seed keeps atlas builds reproducible
+
+def resampledPoints(streamlines):
+    from dipy.tracking.streamline import set_number_of_points
+    return np.asarray(set_number_of_points(streamlines, n_resample).get_data(), dtype=np.float64).reshape(-1, n_resample, 3)
+
+# MDF distance from one resampled streamline to each of candidates
+def mdfDistances(points, candidates):
+    direct = np.linalg.norm(candidates - points, axis=2).mean(axis=1)
+    flipped = np.linalg.norm(candidates[:, ::-1] - points, axis=2).mean(axis=1)
+    return np.minimum(direct, flipped)
+
+# The average of a group of similar streamlines as scilpy takes it: the centroid of a single QuickBundles cluster
+# (threshold 100 mm), which turns each member, in order, to run the way of the centroid so far
+def averageStreamlines(members):
+    from dipy.segment.clustering import QuickBundles
+    from dipy.segment.metric import AveragePointwiseEuclideanMetric
+    if len(members) == 1:
+        return members[0]
+    cluster_map = QuickBundles(threshold=100, metric=AveragePointwiseEuclideanMetric()).cluster(list(members))
+    return np.asarray(cluster_map.centroids[0], dtype=np.float64)
+
+# One pass over a cluster (run in a worker process), its streamlines in the order QuickBundlesX listed them. Returns
+# the indices of the kept streamlines and, with average, their averaged points.
+def similarityPass(points, min_distance, average):
+    centres = points.mean(axis=1)
+    tree = cKDTree(centres)
+    remaining = np.ones(len(points), dtype=bool)
+    kept = list()
+    averaged = list()
+    for index in range(len(points)):
+        if not remaining[index]:
+            continue
+        remaining[index] = False
+        candidates = np.sort(np.asarray(tree.query_ball_point(centres[index], min_distance), dtype=np.int64))
+        candidates = candidates[remaining[candidates]]
+        similar = candidates[mdfDistances(points[index], points[candidates]) < min_distance]
+        remaining[similar] = False
+        kept.append(index)
+        if average:
+            averaged.append(averageStreamlines(points[np.concatenate([[index], similar])]))
+    return np.asarray(kept, dtype=np.int64), np.asarray(averaged).reshape(-1, n_resample, 3)
+
+# The clusters of at least min_cluster_size streamlines, as arrays of indices in QuickBundlesX order, and how many
+# clusters there were
+def qbxClusters(points, clustering_thr, min_cluster_size, rng):
+    from dipy.segment.clustering import qbx_and_merge
+    cluster_map = qbx_and_merge(ArraySequence(list(points)), cluster_thresholds+[clustering_thr], nb_pts=n_resample,
+                                rng=rng, verbose=False)
+    clusters = [np.asarray(cluster.indices, dtype=np.int64) for cluster in cluster_map if len(cluster) >= min_cluster_size]
+    return clusters, len(cluster_map)
+
+def removeSimilarStreamlines(streamlines, min_distance, average=False, min_cluster_size=5, clustering_thr=6, convergence=100, processes=None):
+    lengths = np.asarray(streamlines._lengths, dtype=np.int64)
+    streamlines = streamlines[np.flatnonzero(lengths > 1)] # a single point has no direction to resample along
+    if len(streamlines) == 0:
+        return ArraySequence()
+
+    points = resampledPoints(streamlines)
+    indices = np.arange(len(points)) # into streamlines, for the kept streamlines without average
+    rng = np.random.RandomState(cluster_seed)
+    processes = processes or os.cpu_count() or 1
+    pool = ProcessPoolExecutor(max_workers=processes) if processes > 1 else None
+    n_passes = 0
+    try:
+        while len(points):
+            clusters, n_clusters = qbxClusters(points, clustering_thr, min_cluster_size, rng)
+            jobs = [(points[cluster], min_distance, average) for cluster in clusters]
+            if pool is not None and len(jobs) > 1:
+                # biggest clusters first, so a large one never starts last
+                order = sorted(range(len(jobs)), key=lambda job: -len(clusters[job]))
+                futures = {job: pool.submit(similarityPass, *jobs[job]) for job in order}
+                results = [futures[job].result() for job in range(len(jobs))]
+            else:
+                results = [similarityPass(*job) for job in jobs]
+            n_passes += 1
+            n_left = len(points)
+            kept = np.concatenate([cluster[cluster_kept] for cluster, (cluster_kept, cluster_averaged) in zip(clusters, results)]) if clusters else np.zeros(0, dtype=np.int64)
+            points = np.concatenate([cluster_averaged for cluster_kept, cluster_averaged in results]) if average and results else points[kept]
+            indices = indices[kept]
+            logging.info('Remove similar streamlines, pass '+str(n_passes)+': '+str(n_left)+' streamlines in '+str(n_clusters)+' clusters ('+
+                         str(len(clusters))+' of at least '+str(min_cluster_size)+'), '+str(len(points))+' left')
+            if n_left - len(points) < convergence:
+                break
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    if average:
+        return ArraySequence([streamline.astype(np.float32) for streamline in points])
+    return streamlines[indices] if len(indices) else ArraySequence()
+
+# Whether two sets of streamlines are the same, in any order and direction: each streamline of one has its own
+# partner in the other within tolerance mm at every resampled point
+def sameStreamlines(streamlines, others, tolerance=0.001):
+    if len(streamlines) != len(others):
+        return False
+    if len(streamlines) == 0:
+        return True
+    points = resampledPoints(streamlines)
+    other_points = resampledPoints(others)
+    # each direction as its own candidate, so a flipped copy still matches
+    candidates = np.concatenate([other_points, other_points[:, ::-1]]).reshape(2*len(others), -1)
+    nearest = cKDTree(candidates).query(points.reshape(len(streamlines), -1))[1]
+    partners = nearest % len(others)
+    matched = np.linalg.norm((candidates[nearest] - points.reshape(len(streamlines), -1)).reshape(-1, n_resample, 3), axis=2).max(axis=1) < tolerance
+    return bool(matched.all() and len(np.unique(partners)) == len(others))
+
+# Runs scil_remove_similar_streamlines.py and this module on the same tract and reports whether they keep the same
+# streamlines; None when the scilpy script is not installed. scilpy's QuickBundlesX order is not seeded, so on a
+# tract whose result depends on that order two scilpy runs differ too: compare on a fixture whose groups of similar
+# streamlines are far apart (more than clustering_thr), which any order keeps or averages the same way.
+def compareWithScilpy(path, min_distance, average=False, min_cluster_size=5, clustering_thr=6, convergence=100):
+    import shutil, subprocess, tempfile
+    if shutil.which('scil_remove_similar_streamlines.py') is None:
+        logging.error('scil_remove_similar_streamlines.py is not installed, nothing to compare with')
+        return None
+    streamlines, header = loadTract(path)
+    with tempfile.TemporaryDirectory() as tmp:
+        scilpy_output = os.path.join(tmp, 'scilpy.trk')
+        command = ['scil_remove_similar_streamlines.py', path, str(min_distance), scilpy_output, '-f', '--processes', '1',
+                   '--min_cluster_size', str(min_cluster_size), '--clustering_thr', str(clustering_thr), '--convergence', str(convergence)]
+        subprocess.run(command + (['--avg'] if average else []), check=True)
+        scilpy_result, scilpy_header = loadTract(scilpy_output)
+    result = removeSimilarStreamlines(streamlines, min_distance, average, min_cluster_size, clustering_thr, convergence, processes=1)
+    same = sameStreamlines(result, scilpy_result)
+    logging.info('scilpy: '+str(len(scilpy_result))+' streamlines, remove_similar.py: '+str(len(result))+', '+('the same' if same else 'NOT the same'))
+    return same
+
+# The streamlines of a .trk, .tck or .cstr file, with the .trk header to write them back with (None for .tck)
+def loadTract(path):
+    import nibabel as nib
+    from streamline_io import loadStreamlines
+    from compact_streamlines import CompactStreamlines, loadCompact
+    if path.endswith('.cstr'):
+        return loadCompact(path), CompactStreamlines(path).trkHeader()
+    header = nib.streamlines.load(path, lazy_load=True).header if path.endswith('.trk') else None
+    return loadStreamlines(path), header
+
+def saveTract(streamlines, path, header):
+    from streamline_io import saveStreamlineChunks
+    from compact_streamlines import saveCompact
+    if path.endswith('.cstr'):
+        saveCompact(streamlines, path, header)
+    else:
+        saveStreamlineChunks(lambda: [streamlines], path, header=header)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+    arguments = sys.argv[1:]
+    options = {'--min_cluster_size': 5, '--clustering_thr': 6, '--convergence': 100, '--processes': None}
+    for option in options:
+        if option in arguments:
+            position = arguments.index(option)
+            options[option] = float(arguments[position+1])
+            del arguments[position:position+2]
+    average = '--avg' in arguments
+    compare = '--compare' in arguments
+    arguments = [argument for argument in arguments if argument not in ['--avg', '--compare']]
+    if len(arguments) != (2 if compare else 3):
+        logging.error('usage: python remove_similar.py <in> <min distance mm> <out> [--avg] [--min_cluster_size N] [--clustering_thr mm] [--convergence N] [--processes N]')
+        logging.error('   or: python remove_similar.py --compare <in> <min distance mm> [--avg] [--min_cluster_size N] [--clustering_thr mm] [--convergence N]')
+        sys.exit(2)
+    if compare:
+        same = compareWithScilpy(arguments[0], float(arguments[1]), average, int(options['--min_cluster_size']),
+                                 options['--clustering_thr'], int(options['--convergence']))
+        sys.exit(0 if same else 1)
+    streamlines, header = loadTract(arguments[0])
+    result = removeSimilarStreamlines(streamlines, float(arguments[1]), average, int(options['--min_cluster_size']),
+                                      options['--clustering_thr'], int(options['--convergence']),
+                                      int(options['--processes']) if options['--processes'] else None)
+    saveTract(result, arguments[2], header)
@@ -0,0 +1,88 @@
+"""
+PURPOSE:
+ - keep tractometry results between runs of 4_tractometry_v4.py, so a run only computes the rows that are
+ missing or whose inputs changed, and appends them to what is already there.
+
+USAGE:
+    connection = openStore(dir_data+'/3_Tractometry/')
+    fingerprints = {(tract, measure): inputFingerprint([tract_mask, measure_map], {'engine': 'native'}), ...}
+    stale = staleKeys(connection, 'metrics', group, tag, fingerprints)
+    ... compute results for the stale keys ...
+    saveMetrics(connection, group, tag, results, fingerprints)
+
+Results live in a SQLite file (tractometry_results.sqlite), one row per (group, subject, tract, measure) in the
+metrics table (mean, std, count, and the streamline density weighted mean where the engine computes it) and one row per profile point in the profiles table. Each row keeps the fingerprint of the inputs
+it was computed from: the size and modification time of every input file plus the parameters used. A row is
+stale when its fingerprint no longer matches, e.g. a mask was rebuilt or a NODDI map appeared. Rows where the
+tract or map was missing are kept with status 'no tract' / 'no map', like the old csv.
+"""
+
+import os, json, sqlite3, hashlib, time
+
+store_name = 'tractometry_results.sqlite'
+
+def openStore(directory):
+    os.makedirs(directory, exist_ok = True)
+    connection = sqlite3.connect(os.path.join(directory, store_name))
+    connection.execute('CREATE TABLE IF NOT EXISTS metrics (group_name TEXT, subject TEXT, tract TEXT, measure TEXT, '
+                       'mean REAL, std REAL, count INTEGER, status TEXT, fingerprint TEXT, computed TEXT, weighted_mean REAL, '
+                       'PRIMARY KEY (group_name, subject, tract, measure))')
+    # stores from before the weighted mean get the column added
+    if 'weighted_mean' not in [column[1] for column in connection.execute('PRAGMA table_info(metrics)')]:
+        connection.execute('ALTER TABLE metrics ADD COLUMN weighted_mean REAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS profiles (group_name TEXT, subject TEXT, tract TEXT, measure TEXT, '
+                       'point INTEGER, value REAL, status TEXT, fingerprint TEXT, computed TEXT, '
+                       'PRIMARY KEY (group_name, subject, tract, measure, point))')
+    return connection
+
+# Fingerprint of a set of input files and parameters. Uses size and modification time rather than the file
+# contents, so checking a whole cohort costs one stat per file. Missing files are part of the fingerprint too.
+def inputFingerprint(paths, params=None):
+    state = list()
+    for path in paths:
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            state.append([path, stat.st_size, stat.st_mtime_ns])
+        else:
+            state.append([path, None])
+    state.append(params or dict())
+    return hashlib.sha256(json.dumps(state, sort_keys=True).encode('utf-8')).hexdigest()
+
+# The (tract, measure) keys whose stored fingerprint is missing or differs from fingerprints
+def staleKeys(connection, table, group, subject, fingerprints):
+    stored = dict()
+    for tract, measure, fingerprint in connection.execute('SELECT DISTINCT tract, measure, fingerprint FROM '+table+
+                                                          ' WHERE group_name = ? AND subject = ?', (group, subject)):
+        # profiles have one row per point; a key with mixed fingerprints is always stale
+        stored[(tract, measure)] = fingerprint if (tract, measure) not in stored else None
+    return [key for key, fingerprint in fingerprints.items() if stored.get(key) != fingerprint]
+
+# results maps (tract, measure) to (mean, std, count) or (mean, std, count, weighted mean), or to 'no tract' / 'no map'
+def saveMetrics(connection, group, subject, results, fingerprints):
+    computed = time.strftime('%Y-%m-%d %H:%M:%S')
+    rows = list()
+    for (tract, measure), values in results.items():
+        if isinstance(values, str):
+            rows.append((group, subject, tract, measure, None, None, None, None, values, fingerprints[(tract, measure)], computed))
+        else:
+            weighted_mean = values[3] if len(values) > 3 else None
+            rows.append((group, subject, tract, measure, values[0], values[1], values[2], weighted_mean, 'ok', fingerprints[(tract, measure)], computed))
+    connection.executemany('INSERT OR REPLACE INTO metrics (group_name, subject, tract, measure, mean, std, count, weighted_mean, '
+                           'status, fingerprint, computed) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    connection.commit()
+
+# profiles maps (tract, measure) to a list of values (one per point), or to 'no tract' / 'no map' with
+# n_points. Old points of a key are removed first, so changing the number of points leaves no leftovers.
+def saveProfiles(connection, group, subject, profiles, fingerprints, n_points):
+    computed = time.strftime('%Y-%m-%d %H:%M:%S')
+    rows = list()
+    for (tract, measure), values in profiles.items():
+        connection.execute('DELETE FROM profiles WHERE group_name = ? AND subject = ? AND tract = ? AND measure = ?',
+                           (group, subject, tract, measure))
+        for point in range(n_points):
+            if isinstance(values, str):
+                rows.append((group, subject, tract, measure, point+1, None, values, fingerprints[(tract, measure)], computed))
+            else:
+                rows.append((group, subject, tract, measure, point+1, values[point], 'ok', fingerprints[(tract, measure)], computed))
+    connection.executemany('INSERT OR REPLACE INTO profiles VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    connection.commit()
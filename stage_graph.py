@@ -0,0 +1,118 @@
+"""
+PURPOSE:
+ - run the per-artifact steps of the atlas build (2_create_Recox_template_BG_v4.py) as a dependency graph instead of
+ stage after stage: every step starts as soon as the steps it needs are done, with at most a set number at once.
+
+USAGE:
+    graph = StageGraph()
+    graph.add('t1 fix 01-1234', t1Fix, manifest, '01-1234', outputs=['01-1234__t1_warped_trk_reference.nii.gz'])
+    graph.add('convert x', convertTrk, manifest, 'x.tck', after=['t1 fix 01-1234'], outputs=['x.trk'])
+    graph.add('cluster check x', checkTract, manifest, 'x', review, after=['clusters x'], outputs=[...], gate=True)
+    status = graph.run(workers=8)     # step name -> 'done', 'failed' or 'skipped'
+
+A step has failed if its function raised, returned False, or left any of its outputs missing. The steps that depend
+on a failed step are skipped, and so are theirs; everything else still runs. Gate steps wait on something outside
+the machine (a person checking clusters), so they run on threads of their own and never take up one of the workers.
+External commands stay within the command executor's slots (command_executor.py) whatever the number of workers.
+"""
+
+import os, logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Stages sorted so every stage comes after the stages it depends on. A stage is anything with a name and the names
+# of the stages it comes after: a Step here, a Stage of job_backend.py.
+def stageOrder(stages):
+    by_name = {stage.name: stage for stage in stages}
+    ordered = list()
+    visited = set()
+    def visit(stage, path):
+        if stage.name in visited:
+            return
+        if stage.name in path:
+            raise ValueError('Stage dependencies form a cycle: '+' -> '.join(path+[stage.name]))
+        for name in stage.after:
+            if name not in by_name:
+                raise ValueError('Stage '+stage.name+' depends on unknown stage '+name)
+            visit(by_name[name], path+[stage.name])
+        visited.add(stage.name)
+        ordered.append(stage)
+    for stage in stages:
+        visit(stage, list())
+    return ordered
+
+# CLASS: one step of the graph, run once the steps named in after are done
+class Step:
+    def __init__(self, name, function, args, after=None, outputs=None, gate=False):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.after = list(after or list())
+        self.outputs = list(outputs or list())
+        self.gate = gate
+
+# CLASS: the steps of one run and the order they depend on each other in
+class StageGraph:
+    def __init__(self):
+        self.steps = dict()
+
+    def add(self, name, function, *args, after=None, outputs=None, gate=False):
+        if name in self.steps:
+            raise ValueError('Step '+name+' is in the graph twice')
+        self.steps[name] = Step(name, function, args, after, outputs, gate)
+
+    def has(self, name):
+        return name in self.steps
+
+    # Run one step. Returns True if it succeeded.
+    def runStep(self, step):
+        if step.function(*step.args) is False:
+            return False
+        missing = [output for output in step.outputs if not os.path.exists(output)]
+        if missing:
+            logging.error(step.name+' did not produce '+str(missing))
+            return False
+        return True
+
+    def run(self, workers):
+        stageOrder(list(self.steps.values())) # raises on unknown dependencies and cycles
+        status = dict()
+        waiting = list(self.steps.values())
+        running = dict()
+        n_gates = len([step for step in waiting if step.gate])
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool, ThreadPoolExecutor(max_workers=max(1, n_gates)) as gate_pool:
+            # start every step whose dependencies are done, and skip the ones that can no longer run
+            def release():
+                changed = True
+                while changed:
+                    changed = False
+                    for step in list(waiting):
+                        if not all(name in status for name in step.after):
+                            continue
+                        waiting.remove(step)
+                        changed = True
+                        failed = [name for name in step.after if status[name] != 'done']
+                        if failed:
+                            logging.warning('Skipping '+step.name+', it needs '+str(failed))
+                            status[step.name] = 'skipped'
+                        else:
+                            running[(gate_pool if step.gate else pool).submit(self.runStep, step)] = step
+
+            release()
+            while running:
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    try:
+                        status[step.name] = 'done' if future.result() else 'failed'
+                    except Exception:
+                        logging.exception(step.name+' failed.')
+                        status[step.name] = 'failed'
+                    if status[step.name] == 'failed':
+                        logging.error(step.name+' failed, the steps after it are skipped.')
+                release()
+
+        not_done = sorted(name for name in status if status[name] != 'done')
+        logging.info('Stage graph: '+str(len(status)-len(not_done))+' of '+str(len(status))+' steps done'+
+                     (', failed or skipped: '+str(not_done) if not_done else ''))
+        return status
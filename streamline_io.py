@@ -0,0 +1,100 @@
+"""
+PURPOSE:
+ - read and write .trk/.tck tractograms in fixed-size chunks of streamlines, so the pipeline's own conversion,
+ masking and profile stages use the same amount of memory for a 5 000 or a 5 000 000 streamline tractogram.
+
+USAGE:
+    for chunk in iterStreamlineChunks('tract.trk'):     # ArraySequence of up to chunk_size streamlines, rasmm
+        ...
+    convertStreaming('tract.tck', 'tract.trk', reference='t1.nii.gz')   # reference needed when writing .trk
+    affine, shape = tractogramGrid('tract.trk')          # voxel grid stored in a .trk header
+    saveStreamlineChunks(lambda: (chunk[keep(chunk)] for chunk in iterStreamlineChunks('in.trk')), 'out.trk', header=header)
+    points, streamline_ids = densePoints(chunk, 0.25, per_axis=True)   # points along every segment, for rasterizing
+
+Files are opened with nibabel's lazy loading, which reads one streamline at a time from disk. Only the current
+chunk is ever held in memory, and the writers stream straight to disk as well.
+"""
+
+import numpy as np
+import nibabel as nib
+from nibabel.streamlines import ArraySequence, LazyTractogram, Field
+
+# streamlines per chunk: about 100 MB for typical whole-brain tracking (~80 points per streamline)
+chunk_size = 100000
+
+def iterStreamlineChunks(path, size=None):
+    size = size or chunk_size
+    chunk = list()
+    for streamline in nib.streamlines.load(path, lazy_load=True).streamlines:
+        chunk.append(streamline)
+        if len(chunk) == size:
+            yield ArraySequence(chunk)
+            chunk = list()
+    if chunk:
+        yield ArraySequence(chunk)
+
+# Voxel-to-rasmm affine and grid shape from a .trk header (tck files do not store a grid)
+def tractogramGrid(path):
+    header = nib.streamlines.load(path, lazy_load=True).header
+    return np.asarray(header[Field.VOXEL_TO_RASMM]), tuple(int(size) for size in header[Field.DIMENSIONS])
+
+# Header for writing a .trk on the grid of a reference image, like dipy does when saving with a reference
+def trkHeader(reference):
+    image = nib.load(reference)
+    return {Field.VOXEL_TO_RASMM: image.affine,
+            Field.VOXEL_SIZES: image.header.get_zooms()[:3],
+            Field.DIMENSIONS: image.shape[:3],
+            Field.VOXEL_ORDER: ''.join(nib.aff2axcodes(image.affine))}
+
+# Copy the streamlines of in_path to out_path (format from the extension), one streamline at a time.
+# Writing a .trk needs a reference image for the header; per-point and per-streamline data are not copied.
+def convertStreaming(in_path, out_path, reference=None):
+    header = trkHeader(reference) if reference is not None else None
+    tractogram = LazyTractogram(lambda: nib.streamlines.load(in_path, lazy_load=True).streamlines, affine_to_rasmm=np.eye(4))
+    nib.streamlines.save(tractogram, out_path, header=header)
+
+# Write the streamlines of every chunk that chunk_iterator() yields (rasmm) to out_path, one chunk in memory at a time.
+# The .trk header comes from a reference image, or is given as is (e.g. the header of the tractogram being filtered).
+def saveStreamlineChunks(chunk_iterator, out_path, reference=None, header=None):
+    if reference is not None:
+        header = trkHeader(reference)
+    streamlines = lambda: (streamline for chunk in chunk_iterator() for streamline in chunk)
+    nib.streamlines.save(LazyTractogram(streamlines, affine_to_rasmm=np.eye(4)), out_path, header=header)
+
+# All points of a set of streamlines, with points added along every segment so consecutive points are at most step
+# apart (in distance, or in every coordinate if per_axis), and the index of the streamline each point belongs to.
+# Rasterizing the points hits every voxel a streamline passes through when step is small enough for the grid.
+def densePoints(streamlines, step, per_axis=False):
+    points = np.asarray(streamlines.get_data(), dtype=np.float64)
+    lengths = np.asarray(streamlines._lengths, dtype=np.int64)
+    lengths = lengths[lengths > 0]
+    if points.shape[0] == 0:
+        return np.zeros((0, 3)), np.zeros(0, dtype=np.int64)
+
+    streamline_ids = np.repeat(np.arange(len(lengths)), lengths)
+    # a segment joins point k to point k+1 of the same streamline
+    is_segment_start = np.ones(points.shape[0], dtype=bool)
+    is_segment_start[np.cumsum(lengths) - 1] = False
+    starts = np.flatnonzero(is_segment_start)
+    steps = points[starts + 1] - points[starts]
+    sizes = np.abs(steps).max(axis=1) if per_axis else np.linalg.norm(steps, axis=1)
+    n_sub = np.maximum(np.ceil(sizes/step).astype(np.int64), 1)
+
+    segment_index = np.repeat(np.arange(len(starts)), n_sub)
+    fraction = (np.arange(segment_index.size) - np.repeat(np.cumsum(n_sub) - n_sub, n_sub))/np.repeat(n_sub, n_sub)
+    # and the last point of every streamline, which no segment starts from
+    last = np.cumsum(lengths) - 1
+    return (np.concatenate([points[starts][segment_index] + fraction[:, None]*steps[segment_index], points[last]]),
+            np.concatenate([streamline_ids[starts][segment_index], streamline_ids[last]]))
+
+# Whole tractogram as one ArraySequence in rasmm, read chunk by chunk. For tracts that fit in memory.
+def loadStreamlines(path):
+    streamlines = ArraySequence()
+    for chunk in iterStreamlineChunks(path):
+        streamlines.extend(chunk)
+    return streamlines
+
+# Write streamlines (rasmm) to path, with the grid of a reference image in the header when writing a .trk
+def saveStreamlines(streamlines, path, reference=None):
+    header = trkHeader(reference) if reference is not None else None
+    nib.streamlines.save(nib.streamlines.Tractogram(streamlines, affine_to_rasmm=np.eye(4)), path, header=header)
@@ -0,0 +1,87 @@
+"""
+PURPOSE:
+ - find subject folders (paths ending in a XX-XXXX subject tag) without walking the whole data tree every run.
+ Used by 3_recobundlesX_tractography_v6.py and 4_tractometry_v4.py in place of their own os.walk loops.
+
+USAGE:
+    subject_folders = getSubjectList(data_dir)      # same result as the old os.walk version, sorted
+
+The index is a SQLite file (RECOX_SUBJECT_INDEX, or ~/.recox_subject_index.sqlite). For every folder above the
+subject level it stores the folder's modification time and its sub-folders, so a refresh only lists the folders
+that changed since the last run and reuses the stored sub-folders for the rest. Subject folders themselves are
+never listed: everything under them is pipeline output, not more subjects.
+"""
+
+import os, re, json, sqlite3, logging
+
+index_path = os.environ.get('RECOX_SUBJECT_INDEX', os.path.expanduser('~/.recox_subject_index.sqlite'))
+
+subject_folder_regex = re.compile(r'\d\d-\d\d\d\d\Z') #2 digits, dash, 4 digits at very end of string (\Z)
+identifier_regex = re.compile(r'(TDC|AIS_L|PVI_L|AIS_R|PVI_R).*(\d\d-\d\d\d\d)')
+
+def openIndex():
+    connection = sqlite3.connect(index_path)
+    connection.execute('CREATE TABLE IF NOT EXISTS folders (path TEXT PRIMARY KEY, mtime_ns INTEGER, children TEXT)')
+    connection.execute('CREATE TABLE IF NOT EXISTS subjects (folder TEXT PRIMARY KEY, group_name TEXT, tag TEXT)')
+    return connection
+
+# Bring the index up to date for everything under data_dir. A folder is only listed again if its
+# modification time changed (a sub-folder was added, removed or renamed).
+def refreshIndex(connection, data_dir):
+    root = os.path.abspath(data_dir)
+    under_root = lambda path: path == root or path.startswith(root+os.sep)
+    known = {path: (mtime_ns, json.loads(children)) for path, mtime_ns, children in
+             connection.execute('SELECT path, mtime_ns, children FROM folders') if under_root(path)}
+    known_subjects = {folder for (folder,) in connection.execute('SELECT folder FROM subjects') if under_root(folder)}
+
+    seen_folders = set()
+    seen_subjects = set()
+    n_listed = 0
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+
+        if directory != root and subject_folder_regex.search(directory):
+            seen_subjects.add(directory)
+            if directory not in known_subjects:
+                group = identifier_regex.findall(directory)
+                group = group[0][0] if group else None
+                tag = subject_folder_regex.search(directory).group(0)
+                # named columns, so an index written by an older version (with a paths column) still takes the row
+                connection.execute('INSERT OR REPLACE INTO subjects (folder, group_name, tag) VALUES (?, ?, ?)',
+                                   (directory, group, tag))
+            continue
+
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError:
+            continue
+        seen_folders.add(directory)
+
+        if directory in known and known[directory][0] == mtime_ns:
+            children = known[directory][1]
+        else:
+            n_listed += 1
+            try:
+                children = sorted(entry.path for entry in os.scandir(directory) if entry.is_dir())
+            except OSError:
+                children = list()
+            connection.execute('INSERT OR REPLACE INTO folders VALUES (?, ?, ?)', (directory, mtime_ns, json.dumps(children)))
+        stack.extend(children)
+
+    # forget folders and subjects that are gone
+    connection.executemany('DELETE FROM folders WHERE path = ?', [(path,) for path in known if path not in seen_folders])
+    connection.executemany('DELETE FROM subjects WHERE folder = ?', [(folder,) for folder in known_subjects - seen_subjects])
+    connection.commit()
+    logging.info('Subject index refreshed for '+root+': '+str(len(seen_subjects))+' subjects, '+str(n_listed)+' folders listed.')
+    return root
+
+# FUNCTION: for all folders in a directory, if the full path ends with
+# a subject tag, add that full path to a list
+def getSubjectList(data_dir):
+    connection = openIndex()
+    try:
+        root = refreshIndex(connection, data_dir)
+        return [folder for (folder,) in connection.execute('SELECT folder FROM subjects ORDER BY folder') if folder.startswith(root+os.sep)]
+    finally:
+        connection.close()
@@ -0,0 +1,28 @@
+import os, sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from recox_votes import minimumVotes, bundlesAtThreshold
+
+# the minimum vote as scilpy's VotingScheme.__call__ computes it (scilpy 2.3.0)
+def scilpyMinimumVote(bundle_count, minimal_vote_ratio):
+    minimum_vote = np.array(bundle_count) * minimal_vote_ratio
+    minimum_vote[np.logical_and(minimum_vote > 0, minimum_vote < 1)] = 1
+    return minimum_vote.astype(np.uint8)
+
+def test_minimum_votes_match_scilpy():
+    runs = np.arange(0, 60)
+    for ratio in [0.05, 0.1, 0.25, 0.3, 0.4, 0.5, 0.6, 0.7, 0.75, 0.9, 1.0]:
+        assert np.array_equal(minimumVotes(runs, ratio), scilpyMinimumVote(runs, ratio))
+
+def test_minimum_votes_truncate():
+    # 18 runs at 0.7 is 12.6 votes: scilpy keeps streamlines with 12
+    assert minimumVotes(18, 0.7)[0] == 12
+
+def test_bundles_at_threshold():
+    votes = {'bundle_names': np.asarray(['AF_L.trk', 'CST_R.trk']), 'counts': np.asarray([3, 2]),
+             'indices': np.asarray([0, 1, 2, 1, 3]), 'votes': np.asarray([12, 13, 11, 1, 2], dtype=np.float32),
+             'runs': np.asarray([18, 2])}
+    bundles = bundlesAtThreshold(votes, 0.7)
+    assert bundles['AF_L'].tolist() == [0, 1]
+    assert bundles['CST_R'].tolist() == [1, 3]
@@ -0,0 +1,78 @@
+import os, sys, shutil
+import numpy as np
+import pytest
+from nibabel.streamlines import ArraySequence
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from remove_similar import removeSimilarStreamlines, sameStreamlines, compareWithScilpy
+
+# Six bundles 50 mm apart, each of two groups 4 mm apart of six near-identical straight streamlines, every other one
+# running backwards: which streamline of a group comes first does not change what is kept or averaged.
+def fixtureTract():
+    rng = np.random.RandomState(1)
+    streamlines = list()
+    for bundle in range(6):
+        for group in range(2):
+            for member in range(6):
+                x = np.linspace(20, 60, 30 + member)
+                line = np.column_stack([x, np.full_like(x, 20 + 50*bundle), np.full_like(x, 40 + 4*group)])
+                line[:, 1:] += rng.uniform(-0.2, 0.2, 2)
+                streamlines.append(line[::-1] if member % 2 else line)
+    return ArraySequence(streamlines)
+
+# scil_remove_similar_streamlines.py's algorithm as written, comparing every pair within each cluster, with the
+# QuickBundlesX order left unseeded as scilpy leaves it
+def scilpyRemoveSimilar(streamlines, min_distance, average, min_cluster_size=5, clustering_thr=6, convergence=100):
+    from dipy.segment.clustering import qbx_and_merge, QuickBundles
+    from dipy.segment.metric import AveragePointwiseEuclideanMetric
+    from dipy.tracking.distances import bundles_distances_mdf
+    from dipy.tracking.streamline import set_number_of_points
+    streamlines = list(streamlines)
+    while True:
+        cluster_map = qbx_and_merge(ArraySequence(streamlines), [40, 30, 20, clustering_thr], nb_pts=20, verbose=False)
+        left = list()
+        for cluster in cluster_map:
+            if len(cluster) < min_cluster_size:
+                continue
+            members = [streamlines[index] for index in cluster.indices]
+            sample = set_number_of_points(members, 20)
+            distances = bundles_distances_mdf(sample, sample)
+            removed = np.zeros(len(members), dtype=bool)
+            for index in range(len(members)):
+                if removed[index]:
+                    continue
+                similar = [other for other in np.flatnonzero(distances[index] < min_distance) if not removed[other]]
+                removed[similar] = True
+                if not average:
+                    left.append(members[index])
+                elif len(similar) > 1:
+                    qb = QuickBundles(threshold=100, metric=AveragePointwiseEuclideanMetric())
+                    left.append(qb.cluster([sample[other] for other in similar]).centroids[0])
+                else:
+                    left.append(sample[index])
+        n_removed = len(streamlines) - len(left)
+        streamlines = left
+        if n_removed < convergence or not streamlines:
+            return ArraySequence(streamlines)
+
+@pytest.mark.parametrize('average', [False, True])
+def test_remove_similar_matches_scilpy_algorithm(average):
+    streamlines = fixtureTract()
+    result = removeSimilarStreamlines(streamlines, 2, average, processes=1)
+    assert len(result) == 12
+    assert sameStreamlines(result, scilpyRemoveSimilar(streamlines, 2, average), tolerance=0.001 if average else 1)
+
+def test_remove_similar_keeps_one_per_group():
+    result = removeSimilarStreamlines(fixtureTract(), 2, processes=1)
+    groups = sorted((round(streamline[0, 1]), round(streamline[0, 2])) for streamline in result)
+    assert groups == sorted((20 + 50*bundle, 40 + 4*group) for bundle in range(6) for group in range(2))
+
+@pytest.mark.skipif(shutil.which('scil_remove_similar_streamlines.py') is None, reason='scilpy 1.x is not installed')
+@pytest.mark.parametrize('average', [False, True])
+def test_remove_similar_matches_scilpy(tmp_path, average):
+    import nibabel as nib
+    from nibabel.streamlines import Field, Tractogram
+    header = {Field.VOXEL_TO_RASMM: np.eye(4), Field.DIMENSIONS: (200, 340, 100), Field.VOXEL_SIZES: (1, 1, 1), Field.VOXEL_ORDER: 'RAS'}
+    path = str(tmp_path/'fixture.trk')
+    nib.streamlines.save(Tractogram(fixtureTract(), affine_to_rasmm=np.eye(4)), path, header=header)
+    assert compareWithScilpy(path, 2, average)